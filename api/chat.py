@@ -9,12 +9,17 @@ import openai
 from dotenv import load_dotenv
 import logging
 
+from context_packer import pack_context
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 
+# Token-budsjett for konteksten som sendes til LLM
+CONTEXT_TOKEN_BUDGET = int(os.getenv("RAG_CONTEXT_TOKEN_BUDGET", "1500"))
+
 # --- Pydantic Models ---
 class ChatRequest(BaseModel):
     message: str
@@ -97,8 +102,21 @@ def search_documents(query: str, k: int = 5):
 def generate_response(query: str, context_docs: list):
     """Generer svar med OpenAI basert på kontekst"""
     try:
-        # Bygg kontekst fra dokumenter
-        context = "\n\n".join([doc["content"] for doc in context_docs])
+        # Bygg kontekst innenfor token-budsjettet; hybrid-søket gir treffene i rangert rekkefølge
+        packed = pack_context(
+            [
+                {
+                    "text": doc["content"],
+                    "score": -rank,
+                    "source": doc["metadata"].get("filename", "Ukjent fil"),
+                    "filename": doc["metadata"].get("filename", "Ukjent fil"),
+                    "position": None
+                }
+                for rank, doc in enumerate(context_docs)
+            ],
+            token_budget=CONTEXT_TOKEN_BUDGET
+        )
+        context = packed["context"]
         
         # Lag prompt
         system_prompt = """Du er en ekspert på GPS og u-blox-teknologi. Svar på spørsmålet kun basert på følgende kontekst. 
@@ -120,7 +138,7 @@ Spørsmål: {query}"""
             max_tokens=1000
         )
         
-        return response.choices[0].message.content
+        return response.choices[0].message.content, packed["stats"]
     except Exception as e:
         logger.error(f"Feil under OpenAI kall: {e}")
         raise
@@ -147,7 +165,7 @@ async def chat_handler(request: ChatRequest):
             })
         
         # Generer svar
-        response_text = generate_response(query, documents)
+        response_text, context_stats = generate_response(query, documents)
         logger.info(f"Genererte svar: {response_text[:100]}...")
 
         # Lag kilder
@@ -161,7 +179,7 @@ async def chat_handler(request: ChatRequest):
                 "relevance_score": metadata.get("score", 0)
             })
 
-        return JSONResponse(content={"response": response_text, "sources": sources})
+        return JSONResponse(content={"response": response_text, "sources": sources, "context_stats": context_stats})
 
     except Exception as e:
         logger.error(f"❌ Feil under chat-behandling: {str(e)}")
@@ -35,6 +35,12 @@ class Settings(BaseSettings):
     # Redis Cache
     redis_url: str = "redis://redis:6379"
     
+    # Idempotency-Key for chat: "memory" (i prosessen) eller "redis" (delt via redis_url)
+    idempotency_backend: str = os.getenv("IDEMPOTENCY_BACKEND", "memory")
+    idempotency_ttl_seconds: float = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", 600))
+    # Hvor lenge en tur får fortsette uten klient før den avbrytes, i påvente av et nytt forsøk
+    idempotency_grace_seconds: float = float(os.getenv("IDEMPOTENCY_GRACE_SECONDS", 10))
+    
     # AI/ML
     huggingface_api_key: Optional[str] = None
     
@@ -58,6 +64,34 @@ class Settings(BaseSettings):
     max_tokens: int = 4000
     temperature: float = 0.7
     
+    # Tidsbudsjett for én chat-tur (SLO); resten av fristen sendes videre til rag-engine
+    chat_deadline_ms: int = int(os.getenv("CHAT_DEADLINE_MS", 4000))
+    # Tid som holdes av til å lagre svaret og eventuelt lage fallback etter rag-engine
+    chat_deadline_reserve_ms: int = int(os.getenv("CHAT_DEADLINE_RESERVE_MS", 300))
+    
+    # Circuit breaker for rag-engine: åpnes etter N feil på rad, prøver igjen etter reset-tiden
+    rag_engine_breaker_failures: int = int(os.getenv("RAG_ENGINE_BREAKER_FAILURES", 5))
+    rag_engine_breaker_reset_seconds: float = float(os.getenv("RAG_ENGINE_BREAKER_RESET_SECONDS", 30))
+    # Hedging: start fallback parallelt når rag-engine bruker lenger enn p95 av nylige svartider
+    rag_engine_hedging: bool = os.getenv("RAG_ENGINE_HEDGING", "false").lower() == "true"
+    rag_engine_hedge_percentile: float = float(os.getenv("RAG_ENGINE_HEDGE_PERCENTILE", 95))
+    rag_engine_hedge_min_samples: int = int(os.getenv("RAG_ENGINE_HEDGE_MIN_SAMPLES", 20))
+    rag_engine_hedge_min_delay_ms: int = int(os.getenv("RAG_ENGINE_HEDGE_MIN_DELAY_MS", 500))
+    # Delt keep-alive-pool mot rag-engine; RAG_ENGINE_POOLING=false gir ny klient per kall (for sammenligning)
+    rag_engine_pooling: bool = os.getenv("RAG_ENGINE_POOLING", "true").lower() == "true"
+    rag_engine_max_connections: int = int(os.getenv("RAG_ENGINE_MAX_CONNECTIONS", 20))
+    rag_engine_max_keepalive: int = int(os.getenv("RAG_ENGINE_MAX_KEEPALIVE", 10))
+    rag_engine_keepalive_seconds: float = float(os.getenv("RAG_ENGINE_KEEPALIVE_SECONDS", 30))
+    rag_engine_retries: int = int(os.getenv("RAG_ENGINE_RETRIES", 2))
+    # Be om msgpack i stedet for JSON for kilder/chunks (krever msgpack på begge sider)
+    rag_engine_msgpack: bool = os.getenv("RAG_ENGINE_MSGPACK", "false").lower() == "true"
+    
+    # Samtaleminne: siste N turer ordrett + rullerende sammendrag (oppdateres i bakgrunnen)
+    chat_memory_recent_turns: int = int(os.getenv("CHAT_MEMORY_RECENT_TURNS", 4))
+    chat_memory_message_chars: int = int(os.getenv("CHAT_MEMORY_MESSAGE_CHARS", 600))
+    chat_memory_summary_chars: int = int(os.getenv("CHAT_MEMORY_SUMMARY_CHARS", 1200))
+    chat_memory_summarize_every_turns: int = int(os.getenv("CHAT_MEMORY_SUMMARIZE_EVERY_TURNS", 2))
+    
     # External Services - Disabled for Railway
     rag_engine_url: str = os.getenv("RAG_ENGINE_URL", "http://localhost:8002")
     visualization_url: str = os.getenv("VISUALIZATION_URL", "http://localhost:8003")
@@ -2,15 +2,18 @@
 Database konfigurasjon og modeller for GPSRAG
 """
 
-from sqlalchemy import create_engine, Column, String, Integer, DateTime, Boolean, Text, JSON, DECIMAL, ForeignKey
+from sqlalchemy import create_engine, inspect, text, Column, String, Integer, DateTime, Boolean, Text, JSON, DECIMAL, ForeignKey
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session, relationship
+import logging
 import uuid
 from datetime import datetime
 from typing import Generator
 
 from .config import settings
 
+logger = logging.getLogger(__name__)
+
 # Create database engine
 # SQLite configuration for Railway deployment
 if settings.database_url.startswith("sqlite"):
@@ -98,6 +101,10 @@ class ChatSession(Base):
     id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
     user_id = Column(String(36), ForeignKey("users.id"))
     title = Column(String(255))
+    # Rullerende sammendrag av meldingene før de siste turene, og hvor mange meldinger det dekker
+    summary = Column(Text)
+    summary_message_count = Column(Integer, default=0)
+    summary_updated_at = Column(DateTime)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -146,6 +153,41 @@ class Visualization(Base):
     chart_config = Column(JSON)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+# Kolonner som er lagt til etter at tabellene ble opprettet: (navn, type i PostgreSQL, type i SQLite)
+ADDED_COLUMNS = {
+    "chat_sessions": [
+        ("summary", "TEXT", "TEXT"),
+        ("summary_message_count", "INTEGER DEFAULT 0", "INTEGER DEFAULT 0"),
+        ("summary_updated_at", "TIMESTAMP WITH TIME ZONE", "DATETIME"),
+    ]
+}
+
+def migrate_database():
+    """
+    Legger til kolonnene i ADDED_COLUMNS i eksisterende databaser. PostgreSQL bruker
+    ADD COLUMN IF NOT EXISTS; SQLite har ikke det, så kolonnene sjekkes med inspect først.
+    """
+    sqlite = engine.dialect.name == "sqlite"
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table, columns in ADDED_COLUMNS.items():
+            if not inspector.has_table(table):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table)}
+            for name, postgres_type, sqlite_type in columns:
+                if name in existing:
+                    continue
+                if sqlite:
+                    connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {sqlite_type}"))
+                else:
+                    connection.execute(text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {name} {postgres_type}"))
+                logger.info(f"La til kolonnen {table}.{name}")
+
+try:
+    migrate_database()
+except Exception as e:
+    logger.error(f"Databasemigrering feilet: {e}")
+
 def get_db() -> Generator[Session, None, None]:
     """Database dependency for FastAPI"""
     db = SessionLocal()
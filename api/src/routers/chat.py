@@ -3,7 +3,9 @@ Chat API endepunkter for GPSRAG
 Håndterer chat-sessioner og meldinger med RAG-funksjonalitet
 """
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session
 from typing import List, Optional
 from uuid import UUID
@@ -12,10 +14,24 @@ import logging
 from pydantic import BaseModel
 import json
 import uuid
+import time
 from datetime import datetime
 
-from ..database import get_db, ChatSession, ChatMessage, User
+from ..database import get_db, ChatSession, ChatMessage, SessionLocal, User
 from ..config import settings
+from ..services.deadline import Deadline
+from ..services.disconnect import CLIENT_CLOSED_REQUEST, ClientDisconnected, cancel_on_disconnect
+from ..services.circuit_breaker import CircuitBreaker, CircuitOpenError
+from ..services.hedging import BACKUP, LatencyWindow, hedged
+from ..services.rag_engine_client import rag_engine_client
+from ..services.conversation_memory import conversation_memory
+from ..services.idempotency import (
+    IDEMPOTENCY_HEADER,
+    REPLAYED_HEADER,
+    IdempotencyConflict,
+    IdempotencyStore,
+    request_fingerprint
+)
 from ..schemas.chat import (
     ChatSessionCreate,
     ChatSessionResponse,
@@ -29,6 +45,24 @@ from ..schemas.chat import (
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/chat", tags=["chat"])
 
+# Delt mellom alle forespørsler i prosessen: er rag-engine nede, vet neste forespørsel det allerede
+rag_engine_breaker = CircuitBreaker(
+    "rag-engine",
+    failure_threshold=settings.rag_engine_breaker_failures,
+    reset_timeout=settings.rag_engine_breaker_reset_seconds
+)
+# Resultater per Idempotency-Key (i prosessen, eller delt via Redis)
+idempotency_store = IdempotencyStore(
+    ttl=settings.idempotency_ttl_seconds,
+    grace=settings.idempotency_grace_seconds,
+    redis_url=settings.redis_url if settings.idempotency_backend == "redis" else None
+)
+rag_engine_latency = LatencyWindow(
+    percentile=settings.rag_engine_hedge_percentile,
+    min_samples=settings.rag_engine_hedge_min_samples,
+    min_delay=settings.rag_engine_hedge_min_delay_ms / 1000
+)
+
 @router.post("/sessions", response_model=ChatSessionResponse)
 async def create_chat_session(
     session_data: ChatSessionCreate,
@@ -138,9 +172,13 @@ async def get_chat_messages(
 async def send_chat_message(
     session_id: UUID,
     chat_request: ChatRequest,
+    http_request: Request,
     db: Session = Depends(get_db)
 ):
-    """Send en melding og få RAG-basert svar"""
+    """Send en melding og få RAG-basert svar innenfor chat-fristen"""
+    
+    # Fristen starter før databasearbeidet, så hele turen holder seg innenfor SLO-en
+    deadline = Deadline(settings.chat_deadline_ms)
     try:
         # Verifiser at session eksisterer
         session = db.query(ChatSession).filter(ChatSession.id == session_id).first()
@@ -160,22 +198,28 @@ async def send_chat_message(
         db.add(user_message)
         db.commit()
         
-        # Kall RAG-engine for å få svar
+        # Kall RAG-engine for å få svar; lukker klienten forbindelsen, avbrytes kallet
         try:
-            async with httpx.AsyncClient() as client:
-                rag_response = await client.post(
-                    f"{settings.rag_engine_url}/query",
-                    json={
-                        "query": chat_request.message,
-                        "session_id": str(session_id),
-                        "include_gps": chat_request.include_gps_data,
-                        "metadata": chat_request.metadata
-                    },
-                    timeout=30.0
-                )
-                rag_response.raise_for_status()
-                rag_data = rag_response.json()
+            rag_response = await cancel_on_disconnect(http_request, rag_engine_client.post(
+                f"{settings.rag_engine_url}/query",
+                json={
+                    "query": chat_request.message,
+                    "session_id": str(session_id),
+                    "include_gps": chat_request.include_gps_data,
+                    "metadata": chat_request.metadata,
+                    "filters": jsonable_encoder(chat_request.filters, exclude_none=True),
+                    # rag-engine får det som er igjen, minus tiden vi trenger etterpå
+                    "deadline_ms": max(deadline.remaining_ms() - settings.chat_deadline_reserve_ms, 0)
+                },
+                timeout=deadline.stage_timeout(reserve_ms=settings.chat_deadline_reserve_ms // 3)
+            ))
+            rag_response.raise_for_status()
+            rag_data = rag_engine_client.decode(rag_response)
+        except ClientDisconnected:
+            raise
         except Exception as e:
+            if isinstance(e, httpx.TimeoutException):
+                deadline.degrade("rag_engine_timeout")
             logger.error(f"Feil ved kall til RAG-engine: {e}")
             # Fallback-svar hvis RAG-engine ikke er tilgjengelig
             rag_data = {
@@ -198,6 +242,12 @@ async def send_chat_message(
         db.add(assistant_message)
         db.commit()
         
+        # Degraderingene fra rag-engine og fra denne ruten rapporteres samlet
+        metadata = rag_data.get("metadata", {})
+        for name in (metadata.get("deadline") or {}).get("degradations", []):
+            deadline.degrade(name)
+        metadata["deadline"] = deadline.metadata()
+        
         # Konverter kilder til riktig format
         formatted_sources = []
         if isinstance(rag_data.get("sources", []), list):
@@ -227,9 +277,12 @@ async def send_chat_message(
             response=rag_data["response"],
             session_id=str(session_id),
             sources=formatted_sources,
-            metadata=rag_data.get("metadata", {})
+            metadata=metadata
         )
         
+    except ClientDisconnected:
+        # Ingen mottaker - svaret verken genereres ferdig eller lagres
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
     except HTTPException:
         raise
     except Exception as e:
@@ -256,6 +309,7 @@ async def delete_chat_session(
         # Slett alle meldinger (cascade skal håndtere dette)
         db.delete(session)
         db.commit()
+        conversation_memory.forget(session_id)
         
         return {"message": "Chat-session slettet"}
     except HTTPException:
@@ -270,165 +324,302 @@ async def delete_chat_session(
 @router.post("/", response_model=ChatResponse)
 async def send_message(
     request: ChatRequest,
+    http_request: Request,
     db: Session = Depends(get_db)
 ):
-    """Send en melding til RAG-systemet og få svar"""
+    """Send en melding til RAG-systemet og få svar innenfor chat-fristen"""
+    
+    # Fristen starter før databasearbeidet, så hele turen holder seg innenfor SLO-en
+    deadline = Deadline(settings.chat_deadline_ms)
+    
+    # Nye forsøk med samme Idempotency-Key kobles på den første turen i stedet for å kjøre den igjen
+    idempotency_key = http_request.headers.get(IDEMPOTENCY_HEADER)
+    if idempotency_key:
+        return await send_message_idempotent(request, http_request, idempotency_key, deadline)
     
     try:
-        # Opprett eller finn eksisterende chat-sesjon
-        session_id = request.session_id or str(uuid.uuid4())
-        
-        chat_session = db.query(ChatSession).filter(
-            ChatSession.id == uuid.UUID(session_id)
-        ).first()
-        
-        if not chat_session:
-            chat_session = ChatSession(
-                id=uuid.UUID(session_id),
-                user_id=None,  # TODO: Implementer brukerautentisering
-                title=request.message[:50] + "..." if len(request.message) > 50 else request.message
-            )
-            db.add(chat_session)
-            db.commit()
-            db.refresh(chat_session)
-        
-        # Lagre brukermelding
-        user_message = ChatMessage(
-            id=uuid.uuid4(),
-            session_id=chat_session.id,
-            role="user",
-            content=request.message,
-            message_metadata={"timestamp": datetime.utcnow().isoformat()}
-        )
-        db.add(user_message)
-        db.commit()
-        
-        # Send til RAG-motoren (med forbedret error handling for Railway)
-        ai_response = None
-        sources = []
-        metadata = {"fallback": True, "platform": "Railway"}
-        
-        try:
-            # Først prøv lokal RAG-engine (for Docker Compose)
-            async with httpx.AsyncClient() as client:
-                rag_response = await client.post(
-                    f"http://rag-engine:8002/query",
-                    json={
-                        "question": request.message,
-                        "session_id": session_id,
-                        "include_sources": True
-                    },
-                    timeout=5.0  # Kort timeout for Railway
-                )
-                
-                if rag_response.status_code == 200:
-                    rag_data = rag_response.json()
-                    logger.info(f"RAG Response: {rag_data}")
-                    ai_response = rag_data.get("answer", "")
-                    sources = rag_data.get("sources", [])
-                    metadata = rag_data.get("metadata", {})
-                    logger.info(f"Sources: {sources}")
-                else:
-                    ai_response = None
-                    
-        except Exception as e:
-            logger.info(f"RAG engine ikke tilgjengelig (forventet på Railway): {e}")
-            ai_response = None
-        
-        # Hvis RAG-engine ikke svarte, bruk fallback
-        if not ai_response:
-            ai_response = generate_fallback_response(request.message)
-            metadata.update({"fallback_reason": "RAG engine ikke tilgjengelig på Railway"})
-        
-        # Lagre AI-respons
-        ai_message = ChatMessage(
-            id=uuid.uuid4(),
-            session_id=chat_session.id,
-            role="assistant",
-            content=ai_response,
-            message_metadata={
-                "timestamp": datetime.utcnow().isoformat(),
-                "sources": sources,
-                "metadata": metadata
-            }
-        )
-        db.add(ai_message)
-        db.commit()
-        
-        # Konverter kilder til riktig format
-        formatted_sources = []
-        if isinstance(sources, list):
-            for source in sources:
-                try:
-                    # Handle both dict and object formats
-                    if isinstance(source, dict):
-                        formatted_sources.append(DocumentSource(
-                            filename=source.get("filename", "Ukjent dokument"),
-                            page=source.get("page"),
-                            relevance_score=source.get("score", 0.0),  # RAG engine uses "score"
-                            excerpt=source.get("excerpt", "")
-                        ))
-                    else:
-                        # If it's already a source object, extract the data
-                        formatted_sources.append(DocumentSource(
-                            filename=getattr(source, "filename", "Ukjent dokument"),
-                            page=getattr(source, "page", None),
-                            relevance_score=getattr(source, "score", 0.0),
-                            excerpt=getattr(source, "excerpt", "")
-                        ))
-                except Exception as e:
-                    logger.error(f"Error formatting source: {e}, source: {source}")
-                    continue
-        
-        return ChatResponse(
-            response=ai_response,
-            session_id=session_id,
-            sources=formatted_sources,
-            metadata=metadata
-        )
-        
+        return await run_chat_turn(request, db, deadline, http_request)
+    except ClientDisconnected:
+        # Ingen mottaker - svaret verken genereres ferdig eller lagres
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
     except Exception as e:
         logger.error(f"Chat error: {e}")
         # Returner fallback i stedet for å krasje
-        fallback_response = generate_fallback_response(request.message if hasattr(request, 'message') else "Hei")
+        fallback_response = await generate_fallback_response(request.message if hasattr(request, 'message') else "Hei", deadline)
         return ChatResponse(
             response=fallback_response,
             session_id=request.session_id or str(uuid.uuid4()),
             sources=[],
-            metadata={"fallback": True, "error": str(e), "platform": "Railway"}
+            metadata={"fallback": True, "error": str(e), "platform": "Railway", "deadline": deadline.metadata()}
         )
 
-def generate_fallback_response(message: str) -> str:
-    """Generer en fallback-respons når RAG-motoren ikke er tilgjengelig"""
+async def send_message_idempotent(request: ChatRequest, http_request: Request, idempotency_key: str, deadline: Deadline):
+    """
+    Kjører chat-turen høyst én gang per Idempotency-Key. Meldingene lagres bare én gang,
+    og et nytt forsøk får samme svar (med Idempotent-Replayed: true).
+    """
+    async def turn():
+        # Egen DB-sesjon: turen kan fortsette en stund etter at den første klienten har gitt opp
+        db = SessionLocal()
+        try:
+            try:
+                response = await run_chat_turn(request, db, deadline)
+            except Exception as e:
+                logger.error(f"Chat error: {e}")
+                response = ChatResponse(
+                    response=await generate_fallback_response(request.message, deadline),
+                    session_id=request.session_id or str(uuid.uuid4()),
+                    sources=[],
+                    metadata={"fallback": True, "error": str(e), "platform": "Railway", "deadline": deadline.metadata()}
+                )
+        finally:
+            db.close()
+        return jsonable_encoder(response)
     
-    # På Railway: Bruk OpenAI direkte for å gi smarte svar
+    try:
+        body, replayed = await cancel_on_disconnect(
+            http_request,
+            idempotency_store.run(idempotency_key, request_fingerprint("chat", jsonable_encoder(request)), turn)
+        )
+    except ClientDisconnected:
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+    except IdempotencyConflict:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"{IDEMPOTENCY_HEADER} er allerede brukt med en annen melding"
+        )
+    return JSONResponse(content=body, headers={REPLAYED_HEADER: "true"} if replayed else None)
+
+async def run_chat_turn(
+    request: ChatRequest,
+    db: Session,
+    deadline: Deadline,
+    http_request: Optional[Request] = None
+) -> ChatResponse:
+    """
+    Én chat-tur: lagrer brukermeldingen, henter svaret og lagrer det. Med http_request
+    avbrytes turen (ClientDisconnected) hvis klienten kobler fra underveis.
+    """
+    # Opprett eller finn eksisterende chat-sesjon
+    session_id = request.session_id or str(uuid.uuid4())
+    
+    chat_session = db.query(ChatSession).filter(
+        ChatSession.id == uuid.UUID(session_id)
+    ).first()
+    
+    if not chat_session:
+        chat_session = ChatSession(
+            id=uuid.UUID(session_id),
+            user_id=None,  # TODO: Implementer brukerautentisering
+            title=request.message[:50] + "..." if len(request.message) > 50 else request.message
+        )
+        db.add(chat_session)
+        db.commit()
+        db.refresh(chat_session)
+    
+    # Historikk med fast størrelse (siste turer + sammendrag), hentet før denne meldingen lagres
+    history = conversation_memory.context(db, chat_session)
+    
+    # Lagre brukermelding
+    user_message = ChatMessage(
+        id=uuid.uuid4(),
+        session_id=chat_session.id,
+        role="user",
+        content=request.message,
+        message_metadata={"timestamp": datetime.utcnow().isoformat()}
+    )
+    db.add(user_message)
+    db.commit()
+    
+    # Lukker klienten forbindelsen, avbrytes kallet til rag-engine (som da stopper OpenAI-strømmen)
+    if http_request is not None:
+        ai_response, sources, metadata = await cancel_on_disconnect(
+            http_request,
+            fetch_rag_answer(request, session_id, deadline, history)
+        )
+        # Klienten kan ha gått etter at svaret kom - da er det ingen grunn til å lagre det
+        if await http_request.is_disconnected():
+            logger.info("Klienten koblet fra før svaret ble lagret - hopper over lagring")
+            raise ClientDisconnected()
+    else:
+        ai_response, sources, metadata = await fetch_rag_answer(request, session_id, deadline, history)
+    
+    # Lagre AI-respons
+    ai_message = ChatMessage(
+        id=uuid.uuid4(),
+        session_id=chat_session.id,
+        role="assistant",
+        content=ai_response,
+        message_metadata={
+            "timestamp": datetime.utcnow().isoformat(),
+            "sources": sources,
+            "metadata": metadata
+        }
+    )
+    db.add(ai_message)
+    db.commit()
+    # Sammendraget oppdateres i bakgrunnen når nok meldinger har falt ut av vinduet
+    conversation_memory.record_turn(db, chat_session, request.message, ai_response)
+    
+    # Konverter kilder til riktig format
+    formatted_sources = []
+    if isinstance(sources, list):
+        for source in sources:
+            try:
+                # Handle both dict and object formats
+                if isinstance(source, dict):
+                    formatted_sources.append(DocumentSource(
+                        filename=source.get("filename", "Ukjent dokument"),
+                        page=source.get("page"),
+                        relevance_score=source.get("score", 0.0),  # RAG engine uses "score"
+                        excerpt=source.get("excerpt", "")
+                    ))
+                else:
+                    # If it's already a source object, extract the data
+                    formatted_sources.append(DocumentSource(
+                        filename=getattr(source, "filename", "Ukjent dokument"),
+                        page=getattr(source, "page", None),
+                        relevance_score=getattr(source, "score", 0.0),
+                        excerpt=getattr(source, "excerpt", "")
+                    ))
+            except Exception as e:
+                logger.error(f"Error formatting source: {e}, source: {source}")
+                continue
+    
+    return ChatResponse(
+        response=ai_response,
+        session_id=session_id,
+        sources=formatted_sources,
+        metadata=metadata
+    )
+
+async def query_rag_engine(request: ChatRequest, session_id: str, deadline: Deadline, history: Optional[dict] = None) -> Optional[dict]:
+    """Ett kall til rag-engine gjennom circuit breakeren; None hvis forespørselen ble avvist"""
+    async with rag_engine_breaker.guard():
+        started = time.monotonic()
+        # Først prøv lokal RAG-engine (for Docker Compose)
+        rag_response = await rag_engine_client.post(
+            f"http://rag-engine:8002/query",
+            json={
+                "question": request.message,
+                "session_id": session_id,
+                "include_sources": True,
+                "filters": jsonable_encoder(request.filters, exclude_none=True),
+                "history": history,
+                # rag-engine får det som er igjen, minus tiden vi trenger etterpå
+                "deadline_ms": max(deadline.remaining_ms() - settings.chat_deadline_reserve_ms, 0)
+            },
+            timeout=deadline.stage_timeout(reserve_ms=settings.chat_deadline_reserve_ms // 3)
+        )
+        # 5xx betyr at motoren har problemer; 4xx er vår feil og skal ikke åpne bryteren
+        if rag_response.status_code >= 500:
+            rag_response.raise_for_status()
+        if rag_response.status_code != 200:
+            return None
+        rag_engine_latency.record(time.monotonic() - started)
+        return rag_engine_client.decode(rag_response)
+
+async def fetch_rag_answer(request: ChatRequest, session_id: str, deadline: Deadline, history: Optional[dict] = None):
+    """Henter svar fra rag-engine, eller fallback; returnerer (svar, kilder, metadata)"""
+    # Send til RAG-motoren (med forbedret error handling for Railway)
+    ai_response = None
+    sources = []
+    metadata = {"fallback": True, "platform": "Railway"}
+    
+    # Asynkront og strømmet: taper fallbacken et hedge, lukkes forbindelsen og OpenAI slutter å generere
+    def fallback():
+        return generate_fallback_response(request.message, deadline)
+    
+    try:
+        # Med hedging startes fallback parallelt når rag-engine er tregere enn p95
+        hedge_delay = rag_engine_latency.hedge_delay() if settings.rag_engine_hedging else None
+        result, winner = await hedged(
+            lambda: query_rag_engine(request, session_id, deadline, history),
+            fallback,
+            hedge_delay,
+            rag_engine_latency
+        )
+        if winner == BACKUP:
+            logger.info(f"Fallback svarte før rag-engine (hedge etter {hedge_delay * 1000:.0f}ms)")
+            deadline.degrade("hedged_fallback")
+            ai_response = result
+            metadata.update({"fallback_reason": "RAG engine tregere enn p95 - fallback svarte først"})
+        elif result:
+            rag_data = result
+            logger.info(f"RAG Response: {rag_data}")
+            ai_response = rag_data.get("answer", "")
+            sources = rag_data.get("sources", [])
+            metadata = rag_data.get("metadata", {})
+            logger.info(f"Sources: {sources}")
+    
+    except CircuitOpenError as e:
+        # Motoren er kjent nede - ingen grunn til å vente på en ny timeout
+        logger.info(f"Hopper over RAG engine: {e}")
+        deadline.degrade("circuit_open")
+    except httpx.TimeoutException:
+        logger.warning(f"RAG engine svarte ikke innen fristen på {settings.chat_deadline_ms}ms")
+        deadline.degrade("rag_engine_timeout")
+    except Exception as e:
+        logger.info(f"RAG engine ikke tilgjengelig (forventet på Railway): {e}")
+    
+    # Hvis RAG-engine ikke svarte, bruk fallback
+    if not ai_response:
+        ai_response = await fallback()
+        metadata.update({"fallback_reason": "RAG engine ikke tilgjengelig på Railway"})
+    
+    # Degraderingene fra rag-engine og fra denne ruten rapporteres samlet
+    for name in (metadata.get("deadline") or {}).get("degradations", []):
+        deadline.degrade(name)
+    metadata["deadline"] = deadline.metadata()
+    
+    return ai_response, sources, metadata
+
+async def generate_fallback_response(message: str, deadline: Optional[Deadline] = None) -> str:
+    """
+    Generer en fallback-respons når RAG-motoren ikke er tilgjengelig. OpenAI-kallet er
+    asynkront og strømmet, så det kan kanselleres (tapt hedge, klienten koblet fra).
+    """
+    
+    # På Railway: Bruk OpenAI direkte for å gi smarte svar - med mindre fristen ikke gir tid til det
     try:
         import openai
         import os
         
         # Sett OpenAI API key
         openai_api_key = os.getenv("OPENAI_API_KEY")
-        if openai_api_key and openai_api_key != "your_openai_api_key_here":
+        if deadline is not None and not deadline.allows("llm"):
+            deadline.degrade("static_fallback")
+        elif openai_api_key and openai_api_key != "your_openai_api_key_here":
             
-            from openai import OpenAI
-            client = OpenAI(api_key=openai_api_key)
+            from openai import AsyncOpenAI
+            client = AsyncOpenAI(api_key=openai_api_key, max_retries=0 if deadline is not None else 2)
             
             # Lag en smart respons basert på GPS/GNSS kontekst
             system_prompt = """Du er en ekspert på GPS/GNSS teknologi og u-blox moduler. 
             Du hjelper brukere med tekniske spørsmål om posisjonering, NMEA-protokoller, 
             u-blox konfigurasjon og GPS-relaterte emner. Svar på norsk med teknisk presisjon."""
             
-            response = client.chat.completions.create(
+            stream = await client.chat.completions.create(
                 model="gpt-3.5-turbo",
                 messages=[
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": message}
                 ],
                 max_tokens=500,
-                temperature=0.7
+                temperature=0.7,
+                stream=True,
+                **({"timeout": deadline.stage_timeout()} if deadline is not None else {})
             )
             
-            return response.choices[0].message.content.strip()
+            parts = []
+            try:
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        parts.append(chunk.choices[0].delta.content)
+            finally:
+                await stream.close()
+            
+            return "".join(parts).strip()
             
     except Exception as e:
         logger.info(f"OpenAI fallback feilet: {e}")
@@ -580,6 +771,7 @@ async def delete_chat_session(session_id: str, db: Session = Depends(get_db)):
         # Slett sesjonen
         db.delete(session)
         db.commit()
+        conversation_memory.forget(session_id)
         
         return {"message": "Chat-sesjon slettet"}
         
@@ -11,6 +11,9 @@ from typing import Dict, Any
 
 from ..database import get_db
 from ..config import settings
+from .chat import rag_engine_breaker, rag_engine_latency
+from ..services.rag_engine_client import rag_engine_client
+from ..services.conversation_memory import conversation_memory
 
 router = APIRouter()
 
@@ -64,17 +67,24 @@ async def detailed_health_check(db: Session = Depends(get_db)):
         health_status["status"] = "degraded"
     
     # Test RAG Engine connection
+    # Tilstanden til circuit breakeren og svartidene chat-ruten ser, uavhengig av sjekken under
+    health_status["rag_engine_resilience"] = {
+        "circuit_breaker": rag_engine_breaker.stats(),
+        "latency": rag_engine_latency.stats(),
+        "hedging_enabled": settings.rag_engine_hedging,
+        "client": rag_engine_client.stats()
+    }
+    health_status["conversation_memory"] = conversation_memory.stats()
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{settings.rag_engine_url}/health", timeout=5.0)
-            if response.status_code == 200:
-                health_status["services"]["rag_engine"] = {"status": "healthy"}
-            else:
-                health_status["services"]["rag_engine"] = {
-                    "status": "unhealthy",
-                    "error": f"HTTP {response.status_code}"
-                }
-                health_status["status"] = "degraded"
+        response = await rag_engine_client.get(f"{settings.rag_engine_url}/health", timeout=5.0)
+        if response.status_code == 200:
+            health_status["services"]["rag_engine"] = {"status": "healthy"}
+        else:
+            health_status["services"]["rag_engine"] = {
+                "status": "unhealthy",
+                "error": f"HTTP {response.status_code}"
+            }
+            health_status["status"] = "degraded"
     except Exception as e:
         health_status["services"]["rag_engine"] = {
             "status": "unhealthy",
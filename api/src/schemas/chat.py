@@ -39,12 +39,22 @@ class ChatMessageResponse(BaseModel):
     class Config:
         from_attributes = True
 
+class SearchFilters(BaseModel):
+    """Schema for filtre som skyves ned i vektorsøket"""
+    document_id: Optional[str] = None
+    filename: Optional[str] = None
+    page_from: Optional[int] = None
+    page_to: Optional[int] = None
+    uploaded_after: Optional[datetime] = None
+    uploaded_before: Optional[datetime] = None
+
 class ChatRequest(BaseModel):
     """Schema for chat-forespørsel"""
     message: str
     session_id: Optional[str] = None
     include_gps_data: bool = False
     metadata: Optional[Dict[str, Any]] = None
+    filters: Optional[SearchFilters] = None
 
 class DocumentSource(BaseModel):
     """Schema for dokument-kilde"""
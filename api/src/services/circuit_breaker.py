@@ -0,0 +1,111 @@
+"""
+Circuit breaker - hopper over en tjeneste som er kjent nede
+Etter failure_threshold feil på rad åpnes bryteren, og kall avvises umiddelbart i
+reset_timeout sekunder. Deretter slippes ett prøvekall gjennom (half-open): lykkes det,
+lukkes bryteren igjen; feiler det, åpnes den for en ny periode.
+"""
+
+import asyncio
+import contextlib
+import logging
+import time
+from typing import Any, AsyncIterator, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Kallet ble avvist fordi bryteren er åpen (eller et prøvekall allerede pågår)"""
+
+
+class CircuitBreaker:
+    """Tilstandsmaskin closed -> open -> half_open -> closed/open for én avhengighet"""
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = max(failure_threshold, 1)
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self._probe_in_flight = False
+        # Tellere for metrikker
+        self.successes = 0
+        self.failures = 0
+        self.rejected = 0
+        self.opened = 0
+
+    def _acquire(self) -> bool:
+        """Slipper kallet gjennom eller kaster CircuitOpenError; True hvis det er prøvekallet"""
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                self.rejected += 1
+                raise CircuitOpenError(f"{self.name} er markert nede")
+            self.state = HALF_OPEN
+            logger.info(f"Circuit breaker for {self.name} er half-open - sender ett prøvekall")
+        if self.state == HALF_OPEN:
+            if self._probe_in_flight:
+                self.rejected += 1
+                raise CircuitOpenError(f"{self.name} prøves allerede")
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self.successes += 1
+        self.consecutive_failures = 0
+        if self.state != CLOSED:
+            logger.info(f"Circuit breaker for {self.name} er lukket igjen")
+        self.state = CLOSED
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != OPEN:
+                self.opened += 1
+                logger.warning(
+                    f"Circuit breaker for {self.name} åpnet etter {self.consecutive_failures} feil - "
+                    f"hopper over i {self.reset_timeout:.0f}s"
+                )
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+    @contextlib.asynccontextmanager
+    async def guard(self) -> AsyncIterator[None]:
+        """
+        Omslutter ett kall. Unntak teller som feil; kansellering (f.eks. når et hedget
+        kall vinner) teller ikke, men frigjør prøveplassen så neste kall kan prøve.
+        """
+        probe = self._acquire()
+        try:
+            yield
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.record_failure()
+            raise
+        else:
+            self.record_success()
+        finally:
+            if probe:
+                self._probe_in_flight = False
+
+    def stats(self) -> Dict[str, Any]:
+        retry_in = None
+        if self.state == OPEN:
+            retry_in = round(max(self.reset_timeout - (time.monotonic() - self.opened_at), 0.0), 1)
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "retry_in_seconds": retry_in,
+            "successes": self.successes,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "opened": self.opened
+        }
@@ -0,0 +1,228 @@
+"""
+Samtaleminne per chat-sesjon med fast størrelse
+Prompten får de siste N turene ordrett (hver melding avkortet) pluss et komprimert
+sammendrag av alt som kom før. Sammendraget oppdateres inkrementelt - bare meldingene
+som har falt ut av vinduet siden sist foldes inn - og alltid i bakgrunnen, aldri mens
+brukeren venter. Det lagres på ChatSession (summary, summary_message_count), og
+vinduet holdes i en cache så en tur ikke trenger å lese historikken fra databasen.
+"""
+
+import asyncio
+import collections
+import logging
+from datetime import datetime
+from typing import Any, Deque, Dict, List, Optional
+
+from ..config import settings
+from ..database import ChatMessage, ChatSession, SessionLocal
+from .rag_engine_client import rag_engine_client
+
+logger = logging.getLogger(__name__)
+
+ROLE_LABELS = {"user": "Bruker", "assistant": "Assistent"}
+
+
+class _SessionMemory:
+    def __init__(self, summary: str, summarized_count: int, recent: List[Dict[str, str]], total: int, window: int):
+        self.summary = summary
+        self.summarized_count = summarized_count
+        self.recent: Deque[Dict[str, str]] = collections.deque(recent, maxlen=window)
+        self.total = total
+
+
+class ConversationMemory:
+    """Siste recent_turns turer ordrett + rullerende sammendrag, per sesjon"""
+
+    def __init__(
+        self,
+        recent_turns: int = 4,
+        message_chars: int = 600,
+        summary_chars: int = 1200,
+        summarize_every_turns: int = 2,
+        max_sessions: int = 1000
+    ):
+        self.window = max(recent_turns, 1) * 2  # Én tur = brukermelding + svar
+        self.message_chars = message_chars
+        self.summary_chars = summary_chars
+        self.summarize_every = max(summarize_every_turns, 1) * 2
+        self.max_sessions = max_sessions
+        self.sessions: "collections.OrderedDict[str, _SessionMemory]" = collections.OrderedDict()
+        self._updating: Dict[str, asyncio.Task] = {}
+        # Tellere for metrikker
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.summaries = 0
+        self.summary_fallbacks = 0
+
+    def _clip(self, text: str, limit: int) -> str:
+        return text if len(text) <= limit else text[:limit].rsplit(" ", 1)[0] + " ..."
+
+    def _load(self, db, chat_session: ChatSession) -> _SessionMemory:
+        """Leser sammendraget og bare de siste meldingene (aldri hele historikken)"""
+        total = db.query(ChatMessage).filter(ChatMessage.session_id == chat_session.id).count()
+        latest = db.query(ChatMessage)\
+            .filter(ChatMessage.session_id == chat_session.id)\
+            .order_by(ChatMessage.timestamp.desc())\
+            .limit(self.window)\
+            .all()
+        recent = [{"role": message.role, "content": message.content} for message in reversed(latest)]
+        return _SessionMemory(chat_session.summary or "", chat_session.summary_message_count or 0, recent, total, self.window)
+
+    def _memory(self, db, chat_session: ChatSession) -> _SessionMemory:
+        key = str(chat_session.id)
+        memory = self.sessions.get(key)
+        if memory is None:
+            self.cache_misses += 1
+            memory = self._load(db, chat_session)
+            self.sessions[key] = memory
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        else:
+            self.cache_hits += 1
+        self.sessions.move_to_end(key)
+        return memory
+
+    def context(self, db, chat_session: ChatSession) -> Dict[str, Any]:
+        """
+        Historikken som sendes med spørsmålet: {"summary", "recent"}. Størrelsen er
+        begrenset av summary_chars + recent_turns * 2 * message_chars, uansett hvor
+        lang sesjonen er. Kalles før brukermeldingen legges til.
+        """
+        memory = self._memory(db, chat_session)
+        return {
+            "summary": memory.summary,
+            "recent": [
+                {"role": message["role"], "content": self._clip(message["content"], self.message_chars)}
+                for message in memory.recent
+            ]
+        }
+
+    def record_turn(self, db, chat_session: ChatSession, user_message: str, assistant_message: str):
+        """
+        Legger turen til i vinduet og starter en bakgrunnsoppdatering når nok har falt ut av
+        det. Kalles etter at begge meldingene er lagret.
+        """
+        cached = str(chat_session.id) in self.sessions
+        memory = self._memory(db, chat_session)
+        # Ble sesjonen kastet ut av cachen etter context(), er vinduet nettopp lest fra
+        # databasen - og der står turen allerede
+        if cached:
+            memory.recent.append({"role": "user", "content": user_message})
+            memory.recent.append({"role": "assistant", "content": assistant_message})
+            memory.total += 2
+        if memory.total - self.window - memory.summarized_count >= self.summarize_every:
+            self.schedule_update(str(chat_session.id))
+
+    def schedule_update(self, session_id: str):
+        running = self._updating.get(session_id)
+        if running is not None and not running.done():
+            return  # Oppdateringen som pågår tar med seg alt som har falt ut når den er ferdig
+        self._updating[session_id] = asyncio.ensure_future(self._update(session_id))
+
+    async def _update(self, session_id: str):
+        try:
+            while True:
+                pending = await asyncio.to_thread(self._pending, session_id)
+                if pending is None:
+                    return
+                summary, summarized_count, messages = pending
+                new_summary = await self._summarize(summary, messages)
+                await asyncio.to_thread(self._save, session_id, new_summary, summarized_count + len(messages))
+                self.summaries += 1
+                logger.info(f"Sammendrag for sesjon {session_id[:8]} oppdatert ({summarized_count + len(messages)} meldinger foldet inn)")
+        except Exception as e:
+            logger.error(f"Kunne ikke oppdatere samtalesammendrag for {session_id}: {e}")
+        finally:
+            if self._updating.get(session_id) is asyncio.current_task():
+                del self._updating[session_id]
+
+    def _pending(self, session_id: str):
+        """(sammendrag, antall foldet inn, meldinger som har falt ut av vinduet), eller None"""
+        db = SessionLocal()
+        try:
+            chat_session = db.query(ChatSession).filter(ChatSession.id == session_id).first()
+            if chat_session is None:
+                return None
+            summarized_count = chat_session.summary_message_count or 0
+            total = db.query(ChatMessage).filter(ChatMessage.session_id == chat_session.id).count()
+            outside = total - self.window - summarized_count
+            if outside < self.summarize_every:
+                return None
+            messages = db.query(ChatMessage)\
+                .filter(ChatMessage.session_id == chat_session.id)\
+                .order_by(ChatMessage.timestamp)\
+                .offset(summarized_count)\
+                .limit(outside)\
+                .all()
+            return (
+                chat_session.summary or "",
+                summarized_count,
+                [{"role": message.role, "content": message.content} for message in messages]
+            )
+        finally:
+            db.close()
+
+    def _save(self, session_id: str, summary: str, summarized_count: int):
+        db = SessionLocal()
+        try:
+            chat_session = db.query(ChatSession).filter(ChatSession.id == session_id).first()
+            if chat_session is None:
+                return
+            chat_session.summary = summary
+            chat_session.summary_message_count = summarized_count
+            chat_session.summary_updated_at = datetime.utcnow()
+            db.commit()
+        finally:
+            db.close()
+        memory = self.sessions.get(session_id)
+        if memory is not None:
+            memory.summary = summary
+            memory.summarized_count = summarized_count
+
+    async def _summarize(self, summary: str, messages: List[Dict[str, str]]) -> str:
+        """Nytt sammendrag = gammelt sammendrag + nye meldinger, via rag-engine (LLM)"""
+        try:
+            response = await rag_engine_client.post(
+                f"{settings.rag_engine_url}/summarize",
+                json={"summary": summary, "messages": messages, "max_chars": self.summary_chars},
+                timeout=30.0
+            )
+            response.raise_for_status()
+            new_summary = rag_engine_client.decode(response).get("summary")
+            if new_summary:
+                return self._clip(new_summary, self.summary_chars)
+        except Exception as e:
+            logger.info(f"Sammendrag via rag-engine feilet, komprimerer lokalt: {e}")
+        self.summary_fallbacks += 1
+        return self._compress(summary, messages)
+
+    def _compress(self, summary: str, messages: List[Dict[str, str]]) -> str:
+        """Uten LLM: første setning av hver melding, og de eldste linjene kuttes først"""
+        lines = [line for line in summary.splitlines() if line]
+        for message in messages:
+            first_sentence = message["content"].strip().split(". ")[0]
+            lines.append(f"{ROLE_LABELS.get(message['role'], message['role'])}: {self._clip(first_sentence, 160)}")
+        while lines and sum(len(line) + 1 for line in lines) > self.summary_chars:
+            lines.pop(0)
+        return "\n".join(lines)
+
+    def forget(self, session_id: str):
+        self.sessions.pop(str(session_id), None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sessions_cached": len(self.sessions),
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "summaries": self.summaries,
+            "summary_fallbacks": self.summary_fallbacks,
+            "updating": sum(1 for task in self._updating.values() if not task.done())
+        }
+
+
+conversation_memory = ConversationMemory(
+    recent_turns=settings.chat_memory_recent_turns,
+    message_chars=settings.chat_memory_message_chars,
+    summary_chars=settings.chat_memory_summary_chars,
+    summarize_every_turns=settings.chat_memory_summarize_every_turns
+)
@@ -0,0 +1,46 @@
+"""
+Disconnect - avbryter arbeid når klienten har gått
+Arbeidet kjøres som en egen task mens forespørselen jevnlig sjekkes for http.disconnect.
+Lukker brukeren fanen (eller frontend prøver på nytt), kanselleres tasken, og
+CancelledError bobler ned gjennom embedding, søk og den strømmede LLM-forbindelsen.
+"""
+
+import asyncio
+import contextlib
+import logging
+from typing import Awaitable, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Ikke-standard, men velkjent (nginx) statuskode for "klienten lukket forespørselen"
+CLIENT_CLOSED_REQUEST = 499
+
+
+class ClientDisconnected(Exception):
+    """Klienten lukket forbindelsen før svaret var klart"""
+
+
+async def cancel_on_disconnect(request, awaitable: Awaitable[T], poll_interval: float = 0.25) -> T:
+    """
+    Venter på awaitable, men kansellerer den og kaster ClientDisconnected hvis
+    klienten kobler fra underveis. request er en Starlette/FastAPI Request.
+    """
+    work = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({work}, timeout=poll_interval)
+            if done:
+                return work.result()
+            if await request.is_disconnected():
+                work.cancel()
+                # La arbeidet rydde opp (lukke strømmer, rulle tilbake) før vi går videre
+                with contextlib.suppress(asyncio.CancelledError):
+                    await work
+                logger.info(f"🔌 Klienten koblet fra {request.url.path} - arbeidet er avbrutt")
+                raise ClientDisconnected()
+    finally:
+        # Blir vi selv kansellert (f.eks. ved nedstenging), skal arbeidet også stoppe
+        if not work.done():
+            work.cancel()
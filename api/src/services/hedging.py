@@ -0,0 +1,93 @@
+"""
+Hedging - starter en reserve parallelt når hovedkallet er tregere enn normalt
+LatencyWindow holder de siste vellykkede svartidene; hedge_delay() er p95 av dem.
+hedged() venter så lenge på hovedkallet før reserven startes, og bruker det som
+først gir et brukbart svar. Taperen kanselleres.
+"""
+
+import asyncio
+import collections
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+PRIMARY = "primary"
+BACKUP = "backup"
+
+
+class LatencyWindow:
+    """Rullerende vindu med svartider (sekunder) for å finne hedge-terskelen"""
+
+    def __init__(self, size: int = 200, percentile: float = 95.0, min_samples: int = 20, min_delay: float = 0.0):
+        self.samples: collections.deque = collections.deque(maxlen=size)
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.hedges = 0
+        self.backup_wins = 0
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+
+    def quantile(self, percentile: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        index = min(int(len(ordered) * percentile / 100.0), len(ordered) - 1)
+        return ordered[index]
+
+    def hedge_delay(self) -> Optional[float]:
+        """Hvor lenge hovedkallet får før reserven startes; None til vi har nok målinger"""
+        if len(self.samples) < self.min_samples:
+            return None
+        return max(self.quantile(self.percentile), self.min_delay)
+
+    def stats(self) -> Dict[str, Any]:
+        p50 = self.quantile(50.0)
+        p95 = self.quantile(self.percentile)
+        return {
+            "samples": len(self.samples),
+            "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+            f"p{self.percentile:g}_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            "hedges": self.hedges,
+            "backup_wins": self.backup_wins
+        }
+
+
+async def hedged(
+    primary: Callable[[], Awaitable[Any]],
+    backup: Callable[[], Awaitable[Any]],
+    delay: Optional[float],
+    window: Optional[LatencyWindow] = None
+) -> Tuple[Any, str]:
+    """
+    Kjører primary; er den ikke ferdig etter delay sekunder, startes backup parallelt.
+    Returnerer (resultat, PRIMARY | BACKUP) fra den første som gir et sant resultat.
+    Feiler primary før reserven er startet, kastes feilen videre (kalleren faller da
+    tilbake selv). delay=None skrur av hedging.
+    """
+    primary_task = asyncio.ensure_future(primary())
+    backup_task = None
+    try:
+        if delay is not None:
+            await asyncio.wait({primary_task}, timeout=delay)
+            if not primary_task.done():
+                backup_task = asyncio.ensure_future(backup())
+                if window is not None:
+                    window.hedges += 1
+        pending = {primary_task} if backup_task is None else {primary_task, backup_task}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            # Blir begge ferdige samtidig, foretrekkes hovedsvaret
+            for task in sorted(done, key=lambda task: task is not primary_task):
+                if task.cancelled() or task.exception() is not None or not task.result():
+                    continue
+                if task is backup_task:
+                    if window is not None:
+                        window.backup_wins += 1
+                    return task.result(), BACKUP
+                return task.result(), PRIMARY
+        # Ingen ga et brukbart svar - feilen (eller det tomme svaret) fra primary gjelder
+        return primary_task.result(), PRIMARY
+    finally:
+        for task in (primary_task, backup_task):
+            if task is not None and not task.done():
+                task.cancel()
@@ -0,0 +1,179 @@
+"""
+Intern RPC-klient mot rag-engine
+Én delt httpx.AsyncClient med keep-alive-pool i stedet for en ny klient (og nye TCP-
+forbindelser) per forespørsel. Klienten startes og lukkes av app-ens lifespan, men
+opprettes ved første kall hvis ingen lifespan har startet den.
+
+Kilder og chunks kan hentes som msgpack i stedet for JSON (mindre og raskere å dekode).
+Idempotente kall prøves på nytt ved transportfeil; POST prøves bare på nytt når
+forbindelsen aldri ble opprettet. Hvert kall måles (svartid, dekode-CPU, bytes), og
+pooling kan skrus av med RAG_ENGINE_POOLING=false for å sammenligne før og etter.
+"""
+
+import asyncio
+import contextlib
+import logging
+import time
+from typing import Any, AsyncIterator, Dict, Optional
+
+import httpx
+
+from ..config import settings
+from .hedging import LatencyWindow
+
+logger = logging.getLogger(__name__)
+
+try:
+    import msgpack
+except ImportError:  # Valgfri - uten msgpack brukes JSON
+    msgpack = None
+
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+
+class RagEngineClient:
+    """Delt, poolet HTTP-klient for kall fra API-et til rag-engine"""
+
+    def __init__(
+        self,
+        pooled: bool = True,
+        max_connections: int = 20,
+        max_keepalive_connections: int = 10,
+        keepalive_expiry: float = 30.0,
+        retries: int = 2,
+        use_msgpack: bool = False
+    ):
+        self.pooled = pooled
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.retries = retries
+        self.use_msgpack = use_msgpack and msgpack is not None
+        if use_msgpack and msgpack is None:
+            logger.warning("RAG_ENGINE_MSGPACK er på, men msgpack er ikke installert - bruker JSON")
+        self._client: Optional[httpx.AsyncClient] = None
+        # Metrikker
+        self.latency = LatencyWindow(size=500)
+        self.calls = 0
+        self.errors = 0
+        self.retried = 0
+        self.bytes_received = 0
+        self.decode_cpu_seconds = 0.0
+        self.decoded = {"json": 0, "msgpack": 0}
+
+    def _build(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(limits=self.limits)
+
+    async def start(self):
+        if self.pooled and (self._client is None or self._client.is_closed):
+            self._client = self._build()
+            logger.info(f"Intern rag-engine-klient startet ({self.limits.max_keepalive_connections} keep-alive-forbindelser)")
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @contextlib.asynccontextmanager
+    async def _session(self) -> AsyncIterator[httpx.AsyncClient]:
+        if not self.pooled:
+            # Gammel oppførsel: ny klient og ny forbindelse per kall
+            async with self._build() as client:
+                yield client
+            return
+        if self._client is None or self._client.is_closed:
+            await self.start()
+        yield self._client
+
+    async def request(self, method: str, url: str, idempotent: Optional[bool] = None, **kwargs) -> httpx.Response:
+        """
+        Sender ett kall. kwargs går rett til httpx (json, timeout, ...). Timeouts prøves
+        aldri på nytt - da ville kallet spist av fristen til resten av turen.
+        """
+        method = method.upper()
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        headers = dict(kwargs.pop("headers", None) or {})
+        if self.use_msgpack:
+            headers.setdefault("Accept", f"{MSGPACK_MEDIA_TYPE}, application/json;q=0.9")
+
+        self.calls += 1
+        started = time.perf_counter()
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._session() as client:
+                    response = await client.request(method, url, headers=headers, **kwargs)
+                break
+            except httpx.TimeoutException:
+                self.errors += 1
+                raise
+            except httpx.TransportError as e:
+                # ConnectError: forespørselen nådde aldri rag-engine, så selv POST er trygt
+                retryable = idempotent or isinstance(e, httpx.ConnectError)
+                if not retryable or attempt == self.retries:
+                    self.errors += 1
+                    raise
+                self.retried += 1
+                logger.info(f"Transportfeil mot rag-engine ({type(e).__name__}) - prøver igjen")
+                await asyncio.sleep(0.05 * 2 ** attempt)
+
+        self.latency.record(time.perf_counter() - started)
+        self.bytes_received += len(response.content)
+        return response
+
+    def decode(self, response: httpx.Response) -> Any:
+        """Dekoder svaret fra msgpack eller JSON avhengig av Content-Type"""
+        started = time.thread_time()
+        try:
+            if response.headers.get("content-type", "").startswith(MSGPACK_MEDIA_TYPE) and msgpack is not None:
+                self.decoded["msgpack"] += 1
+                return msgpack.unpackb(response.content, raw=False)
+            self.decoded["json"] += 1
+            return response.json()
+        finally:
+            self.decode_cpu_seconds += time.thread_time() - started
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        p50 = self.latency.quantile(50.0)
+        p95 = self.latency.quantile(95.0)
+        return {
+            "pooled": self.pooled,
+            "msgpack": self.use_msgpack,
+            "calls": self.calls,
+            "errors": self.errors,
+            "retried": self.retried,
+            "hop_p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+            "hop_p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            "bytes_received": self.bytes_received,
+            "decode_cpu_ms": round(self.decode_cpu_seconds * 1000, 2),
+            "decoded": dict(self.decoded)
+        }
+
+
+rag_engine_client = RagEngineClient(
+    pooled=settings.rag_engine_pooling,
+    max_connections=settings.rag_engine_max_connections,
+    max_keepalive_connections=settings.rag_engine_max_keepalive,
+    keepalive_expiry=settings.rag_engine_keepalive_seconds,
+    retries=settings.rag_engine_retries,
+    use_msgpack=settings.rag_engine_msgpack
+)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app) -> AsyncIterator[None]:
+    """Lifespan for app-en som monterer rutene: åpner poolen ved oppstart og lukker den ved nedstenging"""
+    await rag_engine_client.start()
+    try:
+        yield
+    finally:
+        await rag_engine_client.close()
@@ -16,6 +16,25 @@ export const ChatInterface: React.FC = () => {
     endRef.current?.scrollIntoView({ behavior: 'smooth' });
   }, [messages]);
 
+  // Varm opp retrieval mens brukeren skriver (debounced); svaret trengs ikke
+  useEffect(() => {
+    const partial = input.trim();
+    if (partial.length < 12) return;
+    const timer = setTimeout(() => {
+      fetch('/api/chat/prefetch', {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({
+          message: partial,
+          session_id: 'default-session',
+        }),
+      }).catch(() => undefined);
+    }, 300);
+    return () => clearTimeout(timer);
+  }, [input]);
+
   const send = async (text: string, byUser = true) => {
     const userMessage: Message = { id: `${Date.now()}`, text, user: byUser };
     setMessages((m) => [...m, userMessage]);
@@ -0,0 +1,99 @@
+"""
+Benchmark: flat vs. hierarkisk (dokument → chunk) søk i API Gateway sin ChromaDB
+Bygger et syntetisk korpus i økende størrelse og måler søkelatens og overlapp
+med flatt søk for hver størrelse.
+
+Kjør fra repo-roten:
+    python scripts/benchmark_hierarchical_retrieval.py --sizes 1000 5000 20000 50000
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+import uuid
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "services" / "api-gateway"))
+
+from rag_service import GPSRAGService  # noqa: E402
+
+
+def make_document(rng, dim: int, chunks_per_doc: int, noise: float):
+    """Lager et syntetisk dokument: chunk-vektorer spredt rundt et tilfeldig tema"""
+    topic = rng.standard_normal(dim).astype(np.float32)
+    topic /= np.linalg.norm(topic)
+    vectors = topic + noise * rng.standard_normal((chunks_per_doc, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return topic, vectors
+
+
+def percentile(values, q):
+    return float(np.percentile(np.asarray(values), q)) * 1000
+
+
+async def run_queries(service, queries, top_k, mode):
+    """Kjører alle spørringene og returnerer latenser og treff per spørring"""
+    latencies, hits = [], []
+    for query_vector in queries:
+        async def embed(_texts, vector=query_vector):
+            return [vector.tolist()]
+        service.create_embeddings = embed
+
+        started = time.perf_counter()
+        results = await service.search_documents("benchmark", top_k=top_k, retrieval_mode=mode)
+        latencies.append(time.perf_counter() - started)
+        hits.append({(r["metadata"]["doc_id"], r["chunk_index"]) for r in results})
+    return latencies, hits
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 20000], help="Antall chunks i korpuset")
+    parser.add_argument("--chunks-per-doc", type=int, default=50)
+    parser.add_argument("--dim", type=int, default=1536, help="Vektordimensjon (ada-002 = 1536)")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--noise", type=float, default=0.08)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    service = GPSRAGService()
+    # Mål ren ANN-latens - ingen MMR eller identifikator-oppslag
+    service.mmr_enabled = False
+    service.identifier_fast_path = False
+
+    topics = []
+    print(f"{'chunks':>8} {'docs':>6} {'flat p50':>10} {'flat p99':>10} {'hier p50':>10} {'hier p99':>10} {'overlap@k':>10}")
+
+    for size in sorted(args.sizes):
+        # Fyll korpuset opp til ønsket størrelse
+        while service.collection.count() < size:
+            topic, vectors = make_document(rng, args.dim, args.chunks_per_doc, args.noise)
+            topics.append(topic)
+            chunks = [{"id": f"chunk_{i}", "text": f"chunk {i}", "tokens": 2} for i in range(len(vectors))]
+            service._store_in_chromadb(str(uuid.uuid4()), f"manual_{len(topics)}.pdf", chunks, vectors.tolist())
+
+        queries = []
+        for _ in range(args.queries):
+            topic = topics[rng.integers(len(topics))]
+            query = topic + 2 * args.noise * rng.standard_normal(args.dim).astype(np.float32)
+            queries.append(query / np.linalg.norm(query))
+
+        flat_latencies, flat_hits = await run_queries(service, queries, args.top_k, "flat")
+        hier_latencies, hier_hits = await run_queries(service, queries, args.top_k, "hierarchical")
+        overlap = np.mean([len(f & h) / max(len(f), 1) for f, h in zip(flat_hits, hier_hits)])
+
+        print(
+            f"{service.collection.count():>8} {len(topics):>6} "
+            f"{percentile(flat_latencies, 50):>8.2f}ms {percentile(flat_latencies, 99):>8.2f}ms "
+            f"{percentile(hier_latencies, 50):>8.2f}ms {percentile(hier_latencies, 99):>8.2f}ms "
+            f"{overlap:>10.3f}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,182 @@
+"""
+Benchmark: Weaviate-vektorkompresjon (PQ/BQ/SQ) mot ukomprimert HNSW
+Laster korpusets vektorer inn i midlertidige klasser, én per kompresjonstype, og måler
+estimert minnebruk, søkelatens og recall@k mot eksakt (brute force) og mot ukomprimert.
+
+Kjør fra repo-roten mot en kjørende Weaviate:
+    python scripts/benchmark_vector_compression.py --source Document --configs none pq bq
+    python scripts/benchmark_vector_compression.py --synthetic 50000 --dim 384
+"""
+
+import argparse
+import re
+import sys
+import time
+from pathlib import Path
+from urllib.request import urlopen
+
+import numpy as np
+import weaviate
+from weaviate.classes.config import Configure
+from weaviate.util import generate_uuid5
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "services" / "rag-engine"))
+
+from vector_index import vector_index_config  # noqa: E402
+
+
+def load_corpus_vectors(client, source: str) -> np.ndarray:
+    """Henter alle vektorene fra Document-klassen og dens shards"""
+    vectors = []
+    for name in client.collections.list_all():
+        if name != source and not name.startswith(f"{source}_shard_"):
+            continue
+        for obj in client.collections.get(name).iterator(include_vector=True):
+            vector = obj.vector.get("default") if isinstance(obj.vector, dict) else obj.vector
+            vectors.append(vector)
+    return np.asarray(vectors, dtype=np.float32)
+
+
+def synthetic_vectors(rng, count: int, dim: int, clusters: int = 200) -> np.ndarray:
+    """Klyngede vektorer - ligner mer på dokument-chunks enn uniform støy"""
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(clusters, size=count)] + 0.3 * rng.standard_normal((count, dim)).astype(np.float32)
+    return vectors
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def estimated_vector_bytes(compression: str, count: int, dim: int, max_connections: int, pq_segments: int) -> int:
+    """Omtrentlig minne for vektorer + HNSW-graf (lag 0: 2*maxConnections kanter à 8 byte)"""
+    graph = count * 2 * max_connections * 8
+    per_vector = {
+        "none": dim * 4,
+        "pq": pq_segments,
+        "bq": dim // 8,
+        "sq": dim,
+    }[compression]
+    return count * per_vector + graph
+
+
+def heap_bytes(metrics_url: str) -> int:
+    """Leser Go-heap fra Weaviate sitt Prometheus-endepunkt (PROMETHEUS_MONITORING_ENABLED=true)"""
+    body = urlopen(metrics_url, timeout=5).read().decode()
+    match = re.search(r"^go_memstats_heap_inuse_bytes (\S+)$", body, re.MULTILINE)
+    return int(float(match.group(1))) if match else 0
+
+
+def run_config(client, compression: str, vectors: np.ndarray, queries: np.ndarray, args):
+    """Bygger én midlertidig klasse, søker og returnerer (latenser, treff per spørring)"""
+    name = f"BenchCompression{compression.upper()}"
+    if client.collections.exists(name):
+        client.collections.delete(name)
+
+    collection = client.collections.create(
+        name=name,
+        vectorizer_config=Configure.Vectorizer.none(),
+        vector_index_config=vector_index_config({
+            "compression": compression,
+            "ef": args.ef,
+            "max_connections": args.max_connections,
+            "ef_construction": args.ef_construction,
+            "pq_segments": args.pq_segments or None,
+            # Treningen må starte innenfor korpuset for at PQ/SQ skal slå inn
+            "training_limit": min(args.training_limit, len(vectors)),
+            "rescore_limit": args.rescore_limit,
+        })
+    )
+
+    try:
+        with collection.batch.fixed_size(batch_size=500) as batch:
+            for i, vector in enumerate(vectors):
+                batch.add_object(properties={}, vector=vector.tolist(), uuid=generate_uuid5(i))
+        # Kompresjon skjer asynkront etter at training_limit er nådd
+        time.sleep(args.settle)
+
+        heap = heap_bytes(args.metrics_url) if args.metrics_url else None
+
+        latencies, hits = [], []
+        for query in queries:
+            started = time.perf_counter()
+            result = collection.query.near_vector(near_vector=query.tolist(), limit=args.top_k)
+            latencies.append(time.perf_counter() - started)
+            hits.append({str(obj.uuid) for obj in result.objects})
+        return latencies, hits, heap
+    finally:
+        if not args.keep:
+            client.collections.delete(name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--grpc-port", type=int, default=50051)
+    parser.add_argument("--source", default="Document", help="Klasse å hente korpusvektorer fra")
+    parser.add_argument("--synthetic", type=int, default=0, help="Bruk N syntetiske vektorer i stedet for korpuset")
+    parser.add_argument("--dim", type=int, default=384, help="Dimensjon for syntetiske vektorer")
+    parser.add_argument("--configs", nargs="+", default=["none", "pq", "bq"], choices=["none", "pq", "bq", "sq"])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--ef", type=int, default=None)
+    parser.add_argument("--max-connections", type=int, default=32)
+    parser.add_argument("--ef-construction", type=int, default=128)
+    parser.add_argument("--pq-segments", type=int, default=0, help="0 = Weaviate velger")
+    parser.add_argument("--training-limit", type=int, default=100000)
+    parser.add_argument("--rescore-limit", type=int, default=None)
+    parser.add_argument("--settle", type=float, default=10.0, help="Sekunder å vente på bakgrunnskompresjon")
+    parser.add_argument("--metrics-url", default=None, help="F.eks. http://localhost:2112/metrics")
+    parser.add_argument("--keep", action="store_true", help="Ikke slett benchmark-klassene")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    client = weaviate.connect_to_local(host=args.host, port=args.port, grpc_port=args.grpc_port)
+
+    try:
+        if args.synthetic:
+            vectors = normalize(synthetic_vectors(rng, args.synthetic, args.dim))
+        else:
+            vectors = normalize(load_corpus_vectors(client, args.source))
+        if len(vectors) == 0:
+            print(f"Ingen vektorer funnet i {args.source}")
+            return
+
+        count, dim = vectors.shape
+        # Spørringer: korpusvektorer med litt støy, så nærmeste nabo ikke er trivielt seg selv
+        sample = vectors[rng.integers(count, size=args.queries)]
+        queries = normalize(sample + 0.05 * rng.standard_normal(sample.shape).astype(np.float32))
+
+        # Fasit: eksakt cosine top-k
+        exact = np.argsort(-(queries @ vectors.T), axis=1)[:, :args.top_k]
+        exact_hits = [{str(generate_uuid5(int(i))) for i in row} for row in exact]
+
+        pq_segments = args.pq_segments or max(dim // 4, 1)
+        print(f"Korpus: {count} vektorer, dim {dim}, {args.queries} spørringer, k={args.top_k}\n")
+        print(f"{'config':>6} {'est. minne':>12} {'heap':>10} {'p50':>9} {'p99':>9} {'recall@k':>9} {'vs none':>8}")
+
+        baseline_hits = None
+        for compression in args.configs:
+            latencies, hits, heap = run_config(client, compression, vectors, queries, args)
+            recall = np.mean([len(h & e) / args.top_k for h, e in zip(hits, exact_hits)])
+            if compression == "none":
+                baseline_hits = hits
+            vs_none = (
+                np.mean([len(h & b) / args.top_k for h, b in zip(hits, baseline_hits)])
+                if baseline_hits is not None else float("nan")
+            )
+            memory = estimated_vector_bytes(compression, count, dim, args.max_connections, pq_segments)
+            print(
+                f"{compression:>6} {memory / 2**20:>10.1f}MB "
+                f"{(f'{heap / 2**20:.0f}MB' if heap else '-'):>10} "
+                f"{np.percentile(latencies, 50) * 1000:>7.2f}ms {np.percentile(latencies, 99) * 1000:>7.2f}ms "
+                f"{recall:>9.3f} {vs_none:>8.3f}"
+            )
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+ANN-tuning: finner HNSW-parametre (ef, M/maxConnections, ef_construction) for våre embeddings
+Bygger indekser over korpusvektorene for hver kombinasjon i sweepen, måler recall@k mot
+eksakt brute force og p50/p99 søkelatens, og skriver den raskeste konfigurasjonen som når
+målrecall til konfigfilen tjenesten leser ved oppstart.
+
+Kjør fra repo-roten:
+    # ChromaDB (API Gateway) - vektorene hentes fra en kjørende gateway
+    python scripts/tune_ann_index.py chroma --gateway http://localhost:8000 --target-recall 0.95
+    # ... eller fra en eksport (curl -o embeddings.npy http://localhost:8000/api/embeddings/export)
+    python scripts/tune_ann_index.py chroma --vectors embeddings.npy
+    # Weaviate (rag-engine) - vektorene hentes fra Document-klassene
+    python scripts/tune_ann_index.py weaviate --source Document --ef 32 64 128 --m 16 32
+"""
+
+import argparse
+import io
+import itertools
+import json
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from urllib.request import urlopen
+
+import numpy as np
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+DEFAULT_OUTPUT = {
+    "chroma": REPO_ROOT / "services" / "api-gateway" / "ann_index_config.json",
+    "weaviate": REPO_ROOT / "services" / "rag-engine" / "ann_index_config.json",
+}
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def load_weaviate_vectors(args) -> np.ndarray:
+    """Henter alle vektorene fra Document-klassen og dens shards"""
+    import weaviate
+
+    client = weaviate.connect_to_local(host=args.host, port=args.port, grpc_port=args.grpc_port)
+    try:
+        vectors = []
+        for name in client.collections.list_all():
+            if name != args.source and not name.startswith(f"{args.source}_shard_"):
+                continue
+            for obj in client.collections.get(name).iterator(include_vector=True):
+                vectors.append(obj.vector.get("default") if isinstance(obj.vector, dict) else obj.vector)
+        return np.asarray(vectors, dtype=np.float32)
+    finally:
+        client.close()
+
+
+def load_gateway_vectors(url: str) -> np.ndarray:
+    """Henter chunk-embeddingene fra gatewayens /api/embeddings/export (in-memory ChromaDB + offloadede segmenter)"""
+    with urlopen(f"{url.rstrip('/')}/api/embeddings/export", timeout=300) as response:
+        return np.load(io.BytesIO(response.read())).astype(np.float32)
+
+
+def load_vectors(args, rng) -> np.ndarray:
+    if args.vectors:
+        return np.load(args.vectors).astype(np.float32)
+    if args.gateway:
+        return load_gateway_vectors(args.gateway)
+    if args.synthetic:
+        centers = rng.standard_normal((200, args.dim)).astype(np.float32)
+        labels = rng.integers(200, size=args.synthetic)
+        return centers[labels] + 0.3 * rng.standard_normal((args.synthetic, args.dim)).astype(np.float32)
+    if args.backend == "weaviate":
+        return load_weaviate_vectors(args)
+    raise SystemExit("Oppgi --gateway, --vectors eller --synthetic for chroma; gatewayen har ingen vedvarende lagring")
+
+
+def measure(search, queries: np.ndarray, exact_ids, k: int):
+    """Kjører alle spørringene og returnerer (recall@k, p50 ms, p99 ms)"""
+    latencies, recalls = [], []
+    for query, truth in zip(queries, exact_ids):
+        started = time.perf_counter()
+        found = search(query)
+        latencies.append(time.perf_counter() - started)
+        recalls.append(len(set(found) & truth) / k)
+    return float(np.mean(recalls)), float(np.percentile(latencies, 50)) * 1000, float(np.percentile(latencies, 99)) * 1000
+
+
+def sweep_chroma(vectors, queries, exact_ids, args):
+    import chromadb
+
+    client = chromadb.Client()
+    ids = [str(i) for i in range(len(vectors))]
+    rows = []
+    for m, ef_construction, ef in itertools.product(args.m, args.ef_construction, args.ef):
+        name = f"ann_tuning_{m}_{ef_construction}_{ef}"
+        # search_ef kan ikke endres etter opprettelse i ChromaDB, så hver kombinasjon bygges for seg
+        collection = client.create_collection(name=name, metadata={
+            "hnsw:space": "cosine", "hnsw:M": m, "hnsw:construction_ef": ef_construction, "hnsw:search_ef": ef
+        })
+        started = time.perf_counter()
+        for start in range(0, len(vectors), 5000):
+            collection.add(ids=ids[start:start + 5000], embeddings=vectors[start:start + 5000].tolist())
+        build_seconds = time.perf_counter() - started
+
+        def search(query):
+            return collection.query(query_embeddings=[query.tolist()], n_results=args.top_k, include=[])["ids"][0]
+
+        recall, p50, p99 = measure(search, queries, exact_ids, args.top_k)
+        rows.append({"M": m, "ef_construction": ef_construction, "ef": ef,
+                     "recall": recall, "p50_ms": p50, "p99_ms": p99, "build_s": build_seconds})
+        print_row(rows[-1])
+        client.delete_collection(name)
+    return rows
+
+
+def sweep_weaviate(vectors, queries, exact_ids, args):
+    import weaviate
+    from weaviate.classes.config import Configure, Reconfigure
+    from weaviate.util import generate_uuid5
+
+    client = weaviate.connect_to_local(host=args.host, port=args.port, grpc_port=args.grpc_port)
+    uuid_to_index = {str(generate_uuid5(i)): str(i) for i in range(len(vectors))}
+    rows = []
+    try:
+        for m, ef_construction in itertools.product(args.m, args.ef_construction):
+            name = f"AnnTuning{m}x{ef_construction}"
+            if client.collections.exists(name):
+                client.collections.delete(name)
+            collection = client.collections.create(
+                name=name,
+                vectorizer_config=Configure.Vectorizer.none(),
+                vector_index_config=Configure.VectorIndex.hnsw(max_connections=m, ef_construction=ef_construction)
+            )
+            try:
+                started = time.perf_counter()
+                with collection.batch.fixed_size(batch_size=500) as batch:
+                    for i, vector in enumerate(vectors):
+                        batch.add_object(properties={}, vector=vector.tolist(), uuid=generate_uuid5(i))
+                build_seconds = time.perf_counter() - started
+
+                # ef kan endres på en levende indeks - én bygging per (M, ef_construction)
+                for ef in args.ef:
+                    collection.config.update(vector_index_config=Reconfigure.VectorIndex.hnsw(ef=ef))
+
+                    def search(query):
+                        result = collection.query.near_vector(near_vector=query.tolist(), limit=args.top_k)
+                        return [uuid_to_index[str(obj.uuid)] for obj in result.objects]
+
+                    recall, p50, p99 = measure(search, queries, exact_ids, args.top_k)
+                    rows.append({"M": m, "ef_construction": ef_construction, "ef": ef,
+                                 "recall": recall, "p50_ms": p50, "p99_ms": p99, "build_s": build_seconds})
+                    print_row(rows[-1])
+            finally:
+                client.collections.delete(name)
+    finally:
+        client.close()
+    return rows
+
+
+def print_row(row):
+    print(
+        f"{row['M']:>4} {row['ef_construction']:>6} {row['ef']:>5} "
+        f"{row['recall']:>8.3f} {row['p50_ms']:>8.2f}ms {row['p99_ms']:>8.2f}ms {row['build_s']:>8.1f}s"
+    )
+
+
+def recommend(rows, target_recall: float):
+    """Lavest p99 blant konfigurasjonene som når målet; ellers den med høyest recall"""
+    passing = [row for row in rows if row["recall"] >= target_recall]
+    if passing:
+        return min(passing, key=lambda row: (row["p99_ms"], row["build_s"]))
+    return max(rows, key=lambda row: (row["recall"], -row["p99_ms"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("backend", choices=["chroma", "weaviate"])
+    parser.add_argument("--vectors", help=".npy-fil med korpusets embeddings (én rad per chunk)")
+    parser.add_argument("--gateway", help="URL til en kjørende API Gateway å hente embeddingene fra")
+    parser.add_argument("--synthetic", type=int, default=0, help="Bruk N syntetiske vektorer")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--source", default="Document", help="Weaviate-klasse å hente vektorer fra")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--grpc-port", type=int, default=50051)
+    parser.add_argument("--m", type=int, nargs="+", default=[8, 16, 32])
+    parser.add_argument("--ef-construction", type=int, nargs="+", default=[64, 128])
+    parser.add_argument("--ef", type=int, nargs="+", default=[16, 32, 64, 128])
+    parser.add_argument("--queries", type=int, default=200, help="Holdes utenfor indeksen og brukes som spørringer")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--target-recall", type=float, default=0.95)
+    parser.add_argument("--output", type=Path, default=None, help="Standard: konfigfilen tjenesten leser")
+    parser.add_argument("--dry-run", action="store_true", help="Ikke skriv konfigfilen")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    vectors = normalize(load_vectors(args, rng))
+    if len(vectors) <= args.queries:
+        raise SystemExit(f"For få vektorer ({len(vectors)}) til {args.queries} spørringer")
+
+    # Ekte spørringer ligner ikke på lagrede chunks - hold et utvalg utenfor indeksen
+    order = rng.permutation(len(vectors))
+    queries, corpus = vectors[order[:args.queries]], vectors[order[args.queries:]]
+    exact = np.argsort(-(queries @ corpus.T), axis=1)[:, :args.top_k]
+    exact_ids = [{str(i) for i in row} for row in exact]
+
+    print(f"{args.backend}: {len(corpus)} vektorer, dim {corpus.shape[1]}, {len(queries)} spørringer, k={args.top_k}\n")
+    print(f"{'M':>4} {'ef_c':>6} {'ef':>5} {'recall':>8} {'p50':>10} {'p99':>10} {'bygging':>9}")
+
+    sweep = sweep_chroma if args.backend == "chroma" else sweep_weaviate
+    rows = sweep(corpus, queries, exact_ids, args)
+    best = recommend(rows, args.target_recall)
+
+    config = {
+        "backend": args.backend,
+        "M": best["M"],
+        "ef_construction": best["ef_construction"],
+        "ef": best["ef"],
+        "measured": {
+            "recall_at_k": round(best["recall"], 4),
+            "k": args.top_k,
+            "p50_ms": round(best["p50_ms"], 3),
+            "p99_ms": round(best["p99_ms"], 3),
+            "corpus_size": len(corpus),
+            "target_recall": args.target_recall,
+            "met_target": best["recall"] >= args.target_recall,
+        },
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+    }
+    print(f"\nAnbefalt: M={best['M']} ef_construction={best['ef_construction']} ef={best['ef']} "
+          f"(recall {best['recall']:.3f}, p99 {best['p99_ms']:.2f}ms)")
+    if not config["measured"]["met_target"]:
+        print(f"⚠️ Ingen konfigurasjon nådde recall {args.target_recall} - utvid sweepen")
+
+    if not args.dry_run:
+        output = args.output or DEFAULT_OUTPUT[args.backend]
+        output.write_text(json.dumps(config, indent=2) + "\n")
+        print(f"Skrev {output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+"""
+Chunk Store - komprimert lagring av chunk-tekstene
+u-blox-manualene gjentar de samme frasene, tabellhodene og feltbeskrivelsene side opp
+og side ned. En zstd-ordbok trent på korpuset gjør at selv korte chunks komprimeres godt,
+og teksten pakkes kun ut for de endelige top-k treffene.
+"""
+
+import logging
+import os
+import random
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class ChunkStore:
+    """
+    chunk_id -> zstd-komprimert tekst.
+
+    Før korpuset har train_min_chunks chunks komprimeres det uten ordbok. Ordboken
+    trenes første gang grensen nås og på nytt hver gang korpuset har vokst med
+    retrain_factor; da komprimeres alle chunks på nytt med den nye ordboken.
+    """
+
+    def __init__(
+        self,
+        level: int = 3,
+        dict_size: int = 64 * 1024,
+        train_min_chunks: int = 256,
+        retrain_factor: float = 4.0,
+        train_sample_size: int = 4000
+    ):
+        import zstandard
+
+        self._zstd = zstandard
+        self.level = level
+        self.dict_size = dict_size
+        self.train_min_chunks = train_min_chunks
+        self.retrain_factor = retrain_factor
+        self.train_sample_size = train_sample_size
+
+        self.chunks: Dict[str, Tuple[bytes, int]] = {}  # chunk_id -> (komprimert, rå lengde)
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.dictionary = None
+        self.trained_on = 0
+        # Compressor/decompressor-objektene er ikke trådsikre, og shards kjører i tråder
+        self._lock = threading.Lock()
+        self._set_dictionary(None)
+
+    def _set_dictionary(self, dictionary):
+        self.dictionary = dictionary
+        params = {"dict_data": dictionary} if dictionary is not None else {}
+        # Ordbok-id og sjekksum er 8 byte per chunk vi ikke trenger i minnet
+        self._compressor = self._zstd.ZstdCompressor(level=self.level, write_dict_id=False, write_checksum=False, **params)
+        self._decompressor = self._zstd.ZstdDecompressor(**params)
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def __contains__(self, chunk_id: str) -> bool:
+        return chunk_id in self.chunks
+
+    def put_many(self, ids: List[str], texts: List[str]):
+        with self._lock:
+            for chunk_id, text in zip(ids, texts):
+                self._remove(chunk_id)
+                raw = text.encode("utf-8")
+                compressed = self._compressor.compress(raw)
+                self.chunks[chunk_id] = (compressed, len(raw))
+                self.raw_bytes += len(raw)
+                self.stored_bytes += len(compressed)
+
+            if self._should_train():
+                self._train()
+
+    def get_many(self, ids: Iterable[str]) -> List[Optional[str]]:
+        """Pakker ut tekstene for ids; None for ukjente chunks"""
+        with self._lock:
+            texts = []
+            for chunk_id in ids:
+                entry = self.chunks.get(chunk_id)
+                texts.append(self._decompress(entry[0]) if entry is not None else None)
+            return texts
+
+    def stored_size(self, ids: Iterable[str]) -> int:
+        """Komprimert størrelse for ids, brukt i minneregnskapet"""
+        return sum(len(self.chunks[chunk_id][0]) for chunk_id in ids if chunk_id in self.chunks)
+
+    def remove_many(self, ids: Iterable[str]):
+        with self._lock:
+            for chunk_id in ids:
+                self._remove(chunk_id)
+
+    def clear(self):
+        with self._lock:
+            self.chunks.clear()
+            self.raw_bytes = 0
+            self.stored_bytes = 0
+
+    def _remove(self, chunk_id: str):
+        entry = self.chunks.pop(chunk_id, None)
+        if entry is not None:
+            self.stored_bytes -= len(entry[0])
+            self.raw_bytes -= entry[1]
+
+    def _decompress(self, compressed: bytes) -> str:
+        return self._decompressor.decompress(compressed).decode("utf-8")
+
+    def _should_train(self) -> bool:
+        if len(self.chunks) < self.train_min_chunks:
+            return False
+        return self.trained_on == 0 or len(self.chunks) >= self.trained_on * self.retrain_factor
+
+    def _train(self):
+        """Trener en ny ordbok på et utvalg av chunkene og komprimerer alt på nytt med den"""
+        raw = {chunk_id: self._decompressor.decompress(compressed) for chunk_id, (compressed, _) in self.chunks.items()}
+        samples = list(raw.values())
+        if len(samples) > self.train_sample_size:
+            samples = random.sample(samples, self.train_sample_size)
+
+        try:
+            dictionary = self._zstd.train_dictionary(self.dict_size, samples, level=self.level)
+        except self._zstd.ZstdError as e:
+            # For lite eller for ensartet korpus - prøv igjen når det har vokst
+            logger.warning(f"⚠️ Kunne ikke trene zstd-ordbok på {len(samples)} chunks: {e}")
+            self.trained_on = len(self.chunks)
+            return
+
+        self._set_dictionary(dictionary)
+        self.trained_on = len(self.chunks)
+        self.stored_bytes = 0
+        for chunk_id, data in raw.items():
+            compressed = self._compressor.compress(data)
+            self.chunks[chunk_id] = (compressed, len(data))
+            self.stored_bytes += len(compressed)
+
+        logger.info(
+            f"🗜️ Trente zstd-ordbok ({len(dictionary.as_bytes())} byte) på {len(samples)} chunks: "
+            f"{self.raw_bytes} -> {self.stored_bytes} byte"
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "chunks": len(self.chunks),
+            "raw_bytes": self.raw_bytes,
+            "stored_bytes": self.stored_bytes,
+            "compression_ratio": round(self.raw_bytes / self.stored_bytes, 2) if self.stored_bytes else None,
+            "dictionary_bytes": len(self.dictionary.as_bytes()) if self.dictionary is not None else 0,
+            "dictionary_trained_on": self.trained_on if self.dictionary is not None else 0,
+            "level": self.level
+        }
+
+
+def chunk_store_from_env() -> Optional[ChunkStore]:
+    """RAG_CHUNK_COMPRESSION=zstd (standard) eller none for ukomprimerte tekster i ChromaDB"""
+    mode = os.getenv("RAG_CHUNK_COMPRESSION", "zstd").lower()
+    if mode == "none":
+        return None
+    if mode != "zstd":
+        logger.warning(f"⚠️ Ukjent RAG_CHUNK_COMPRESSION={mode}, bruker zstd")
+    return ChunkStore(
+        level=int(os.getenv("RAG_ZSTD_LEVEL", "3")),
+        dict_size=int(os.getenv("RAG_ZSTD_DICT_SIZE", str(64 * 1024))),
+        train_min_chunks=int(os.getenv("RAG_ZSTD_TRAIN_MIN_CHUNKS", "256"))
+    )
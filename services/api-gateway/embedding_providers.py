@@ -0,0 +1,270 @@
+"""
+Embedding Providers - utskiftbar kilde for embeddings
+"openai" kaller Embeddings API over nett, "onnx" kjører multi-qa-MiniLM-L6-cos-v1 lokalt
+på CPU med ONNX Runtime (int8-kvantisert, dynamisk batching over en trådpool).
+"""
+
+import abc
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ONNX_MODEL_REPO = "sentence-transformers/multi-qa-MiniLM-L6-cos-v1"
+
+
+class EmbeddingProvider(abc.ABC):
+    """Felles grensesnitt: embed() returnerer én vektor per tekst, i samme rekkefølge"""
+
+    name = "base"
+    dimension: Optional[int] = None
+
+    @abc.abstractmethod
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        """Én vektor per tekst, i samme rekkefølge som texts"""
+
+    async def close(self):
+        pass
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    """Kaller OpenAI API direkte med httpx for å unngå bibliotek-konflikter"""
+
+    name = "openai"
+    dimension = 1536
+
+    def __init__(self, api_key: Optional[str], model: str = "text-embedding-ada-002", limiter=None):
+        self.api_key = api_key
+        self.model = model
+        # Valgfri delt rate limiter (OpenAILimiter i gatewayen); None = kall rett på
+        self.limiter = limiter
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        import httpx
+
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+        json_data = {
+            "input": texts,
+            "model": self.model
+        }
+
+        logger.info(f"🔄 Kaller OpenAI Embeddings API direkte for {len(texts)} tekstblokker...")
+
+        async def request():
+            async with httpx.AsyncClient() as client:
+                response = await client.post(
+                    "https://api.openai.com/v1/embeddings",
+                    headers=headers,
+                    json=json_data,
+                    timeout=30.0
+                )
+            response.raise_for_status()  # Sjekker for HTTP-feil (4xx, 5xx)
+            return response
+
+        if self.limiter is None:
+            response = await request()
+        else:
+            # 429/5xx prøves på nytt av limiteren; ruten (query/ingest) arves fra kalleren
+            response = await self.limiter.run(self.limiter.estimate_tokens(texts), request)
+            self.limiter.observe(response.headers)
+
+        embeddings = [item["embedding"] for item in response.json()["data"]]
+        logger.info(f"✅ Lagde {len(embeddings)} embeddings via direkte API-kall")
+        return embeddings
+
+
+class OnnxMiniLMProvider(EmbeddingProvider):
+    """
+    multi-qa-MiniLM-L6-cos-v1 i prosess med ONNX Runtime på CPU.
+
+    Samme modell som transformers-inference bruker for Weaviate, så vektorene kan
+    brukes som bring-your-own vektorer der. Samtidige kall samles i batcher: en
+    forespørsel venter maks max_wait_ms på at flere skal komme før batchen kjøres
+    i trådpoolen.
+    """
+
+    name = "onnx"
+    dimension = 384
+
+    def __init__(
+        self,
+        model_dir: str,
+        quantize: bool = True,
+        max_batch_size: int = 64,
+        max_wait_ms: float = 2.0,
+        workers: int = 2,
+        intra_op_threads: int = 0,
+        max_length: int = 256,
+        scheduler=None
+    ):
+        try:
+            import onnxruntime as ort
+            from tokenizers import Tokenizer
+        except ImportError as e:
+            # Valgfrie avhengigheter, installeres fra requirements-onnx.txt
+            raise RuntimeError("RAG_EMBEDDING_PROVIDER=onnx krever pakkene i requirements-onnx.txt") from e
+
+        model_path, tokenizer_path = self._resolve_model_files(Path(model_dir), quantize)
+
+        self.tokenizer = Tokenizer.from_file(str(tokenizer_path))
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.enable_padding()
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads  # 0 = ONNX Runtime velger
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(str(model_path), options, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        # InferenceSession.run er trådsikker - flere batcher kan kjøre parallelt
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="onnx-embed")
+        self.queue: Optional[asyncio.Queue] = None
+        self.batcher: Optional[asyncio.Task] = None
+        self.inflight = set()
+        # Valgfri prioritets-scheduler (gatewayen): interaktive batcher går foran opplasting
+        self.scheduler = scheduler
+        logger.info(f"✅ ONNX embedding-modell lastet: {model_path.name} ({workers} workers)")
+
+    @staticmethod
+    def _resolve_model_files(model_dir: Path, quantize: bool) -> Tuple[Path, Path]:
+        """Finner (eller henter og kvantiserer) modellfilene i model_dir"""
+        model_dir.mkdir(parents=True, exist_ok=True)
+        model_path = model_dir / "model.onnx"
+        tokenizer_path = model_dir / "tokenizer.json"
+
+        if not model_path.exists() or not tokenizer_path.exists():
+            # Krever nett én gang; legg filene i model_dir på forhånd for offline drift
+            from huggingface_hub import hf_hub_download
+            logger.info(f"⬇️ Laster ned {ONNX_MODEL_REPO} til {model_dir}")
+            model_path = Path(hf_hub_download(ONNX_MODEL_REPO, "onnx/model.onnx", local_dir=model_dir))
+            tokenizer_path = Path(hf_hub_download(ONNX_MODEL_REPO, "tokenizer.json", local_dir=model_dir))
+
+        if not quantize:
+            return model_path, tokenizer_path
+
+        quantized_path = model_dir / "model_int8.onnx"
+        if not quantized_path.exists():
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            logger.info("🔧 Kvantiserer embedding-modellen til int8...")
+            quantize_dynamic(str(model_path), str(quantized_path), weight_type=QuantType.QInt8)
+        return quantized_path, tokenizer_path
+
+    def _encode_batch(self, texts: List[str]) -> np.ndarray:
+        """Tokeniserer og kjører modellen; mean pooling + L2-normalisering som sentence-transformers"""
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.asarray([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.asarray([e.attention_mask for e in encodings], dtype=np.int64)
+
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            inputs["token_type_ids"] = np.zeros_like(input_ids)
+
+        token_embeddings = self.session.run(None, inputs)[0]
+        mask = attention_mask[..., None].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+
+    def _ensure_batcher(self):
+        if self.batcher is None or self.batcher.done():
+            self.queue = asyncio.Queue()
+            self.batcher = asyncio.create_task(self._run_batcher())
+
+    async def _run_batcher(self):
+        """Samler ventende forespørsler til batcher og kjører dem i trådpoolen"""
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self.queue.get()]
+            size = len(pending[0][0])
+            deadline = loop.time() + self.max_wait
+            while size < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                pending.append(item)
+                size += len(item[0])
+
+            texts = [text for item_texts, _, _ in pending for text in item_texts]
+            # Ikke vent på at batchen blir ferdig før neste samles - trådpoolen kjører dem parallelt
+            task = asyncio.create_task(self._dispatch(loop, texts, pending))
+            self.inflight.add(task)
+            task.add_done_callback(self.inflight.discard)
+
+    async def _dispatch(self, loop, texts: List[str], pending):
+        started = time.perf_counter()
+        try:
+            # Store forespørsler deles opp så én opplasting ikke blokkerer alle workers
+            vectors = []
+            for start in range(0, len(texts), self.max_batch_size):
+                batch = texts[start:start + self.max_batch_size]
+                if self.scheduler is None:
+                    vectors.append(await loop.run_in_executor(self.executor, self._encode_batch, batch))
+                    continue
+                # Hver delbatch venter på sin tur, så et spørsmål kan gå foran resten av en opplasting
+                async with self.scheduler.slot(self.scheduler.batch_class({cls for _, _, cls in pending})):
+                    vectors.append(await loop.run_in_executor(self.executor, self._encode_batch, batch))
+            vectors = np.concatenate(vectors)
+        except Exception as e:
+            for _, future, _ in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        offset = 0
+        for item_texts, future, _ in pending:
+            if not future.done():
+                future.set_result(vectors[offset:offset + len(item_texts)].tolist())
+            offset += len(item_texts)
+        logger.debug(f"ONNX batch: {len(texts)} tekster fra {len(pending)} kall på {(time.perf_counter() - started) * 1000:.1f}ms")
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        self._ensure_batcher()
+        future = asyncio.get_running_loop().create_future()
+        cls = self.scheduler.current_class() if self.scheduler is not None else None
+        await self.queue.put((texts, future, cls))
+        return await future
+
+    async def close(self):
+        if self.batcher is not None:
+            self.batcher.cancel()
+        self.executor.shutdown(wait=False)
+
+
+def create_embedding_provider(
+    name: Optional[str] = None,
+    openai_api_key: Optional[str] = None,
+    limiter=None,
+    scheduler=None
+) -> EmbeddingProvider:
+    """Velger provider fra RAG_EMBEDDING_PROVIDER (openai eller onnx)"""
+    name = (name or os.getenv("RAG_EMBEDDING_PROVIDER", "openai")).lower()
+    if name == "onnx":
+        return OnnxMiniLMProvider(
+            model_dir=os.getenv("RAG_ONNX_MODEL_DIR", "/tmp/models/multi-qa-MiniLM-L6-cos-v1"),
+            quantize=os.getenv("RAG_ONNX_QUANTIZE", "true").lower() == "true",
+            max_batch_size=int(os.getenv("RAG_ONNX_MAX_BATCH", "64")),
+            max_wait_ms=float(os.getenv("RAG_ONNX_MAX_WAIT_MS", "2")),
+            workers=int(os.getenv("RAG_ONNX_WORKERS", "2")),
+            intra_op_threads=int(os.getenv("RAG_ONNX_THREADS", "0")),
+            scheduler=scheduler
+        )
+    if name != "openai":
+        logger.warning(f"⚠️ Ukjent RAG_EMBEDDING_PROVIDER={name}, bruker openai")
+    return OpenAIEmbeddingProvider(openai_api_key, limiter=limiter)
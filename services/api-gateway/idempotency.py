@@ -0,0 +1,225 @@
+"""
+Idempotency - gjentatte forespørsler med samme Idempotency-Key gjør ikke jobben på nytt
+Frontend prøver på nytt ved timeout. Med en Idempotency-Key kobles nye forsøk på den
+pågående beregningen (eller får det ferdige resultatet) i stedet for å kjøre retrieval,
+LLM eller hele ingesteringen igjen. Resultater huskes i ttl sekunder, i prosessen eller
+i Redis når flere instanser skal dele dem.
+
+Gir klienten opp (kobler fra), får beregningen grace sekunder på seg til et nytt forsøk
+kobler seg på før den kanselleres. Feilede beregninger huskes ikke.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+
+class IdempotencyConflict(Exception):
+    """Samme nøkkel ble brukt med en annen forespørsel"""
+
+
+def request_fingerprint(*parts: Any) -> str:
+    """Hash av det som gjør forespørselen unik; samme nøkkel med annet innhold er en feil"""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class _Entry:
+    def __init__(self, fingerprint: str):
+        self.fingerprint = fingerprint
+        self.task: Optional[asyncio.Task] = None
+        self.result: Any = None
+        self.done = False
+        self.expires_at: Optional[float] = None
+        self.subscribers = 0
+        self.abandon_handle: Optional[asyncio.TimerHandle] = None
+
+
+class IdempotencyStore:
+    """Kortlivet resultatlager per Idempotency-Key; redis_url gjør det delt mellom instanser"""
+
+    def __init__(
+        self,
+        ttl: float = 600.0,
+        grace: float = 10.0,
+        redis_url: Optional[str] = None,
+        pending_ttl: float = 120.0,
+        poll_interval: float = 0.2
+    ):
+        self.ttl = ttl
+        self.grace = grace
+        self.redis_url = redis_url
+        self.pending_ttl = pending_ttl
+        self.poll_interval = poll_interval
+        self.entries: Dict[str, _Entry] = {}
+        self._redis = None
+        # Tellere for metrikker
+        self.requests = 0
+        self.executions = 0
+        self.replayed = 0
+        self.conflicts = 0
+        self.abandoned = 0
+
+    def _redis_client(self):
+        if self.redis_url and self._redis is None:
+            import redis.asyncio as aioredis
+            self._redis = aioredis.from_url(self.redis_url)
+        return self._redis
+
+    def _prune(self):
+        now = time.monotonic()
+        expired = [key for key, entry in self.entries.items() if entry.expires_at is not None and entry.expires_at <= now]
+        for key in expired:
+            del self.entries[key]
+
+    async def run(self, key: str, fingerprint: str, compute: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Resultatet for key, beregnet høyst én gang. Returnerer (resultat, replayed), der
+        replayed er True når svaret kom fra et tidligere eller parallelt forsøk.
+        Resultatet må kunne JSON-serialiseres når Redis brukes.
+        """
+        self.requests += 1
+        self._prune()
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry.fingerprint != fingerprint:
+                self.conflicts += 1
+                raise IdempotencyConflict(key)
+            self.replayed += 1
+            if entry.done:
+                return entry.result, True
+            logger.info(f"🔁 Idempotency-Key {key[:16]} er under arbeid - kobler på det pågående kallet")
+            result, _ = await self._wait(key, entry)
+            return result, True
+
+        entry = _Entry(fingerprint)
+        self.entries[key] = entry
+        entry.task = asyncio.ensure_future(self._resolve(key, entry, compute))
+        entry.task.add_done_callback(lambda task: self._finish(key, entry, task))
+        result, replayed = await self._wait(key, entry)
+        if replayed:
+            self.replayed += 1
+        return result, replayed
+
+    async def _wait(self, key: str, entry: _Entry) -> Tuple[Any, bool]:
+        entry.subscribers += 1
+        if entry.abandon_handle is not None:
+            entry.abandon_handle.cancel()
+            entry.abandon_handle = None
+        try:
+            # shield: én klient som gir opp skal ikke stoppe arbeidet for neste forsøk
+            return await asyncio.shield(entry.task)
+        finally:
+            entry.subscribers -= 1
+            if entry.subscribers == 0 and not entry.task.done():
+                entry.abandon_handle = asyncio.get_running_loop().call_later(self.grace, self._abandon, key, entry)
+
+    def _abandon(self, key: str, entry: _Entry):
+        if entry.subscribers == 0 and not entry.task.done():
+            logger.info(f"🛑 Ingen nye forsøk for Idempotency-Key {key[:16]} innen {self.grace:.0f}s - avbryter")
+            self.abandoned += 1
+            entry.task.cancel()
+
+    def _finish(self, key: str, entry: _Entry, task: asyncio.Task):
+        if task.cancelled() or task.exception() is not None:
+            # Feil huskes ikke - neste forsøk får prøve på nytt
+            if self.entries.get(key) is entry:
+                del self.entries[key]
+            return
+        entry.result, _ = task.result()
+        entry.done = True
+        entry.expires_at = time.monotonic() + self.ttl
+
+    async def _resolve(self, key: str, entry: _Entry, compute: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        redis = None
+        try:
+            redis = self._redis_client()
+            if redis is not None:
+                remote = await self._claim(redis, key, entry.fingerprint)
+                if remote is not None:
+                    return remote["result"], True
+        except IdempotencyConflict:
+            raise
+        except Exception as e:
+            logger.warning(f"⚠️ Redis for idempotency utilgjengelig, bruker bare lokal lagring: {e}")
+            redis = None
+
+        self.executions += 1
+        try:
+            result = await compute()
+        except BaseException:
+            if redis is not None:
+                await self._forget(redis, key)
+            raise
+        if redis is not None:
+            try:
+                await redis.set(
+                    self._redis_key(key),
+                    json.dumps({"fingerprint": entry.fingerprint, "status": "completed", "result": result}, default=str),
+                    ex=int(self.ttl)
+                )
+            except Exception as e:
+                logger.warning(f"⚠️ Kunne ikke lagre idempotency-resultat i Redis: {e}")
+        return result, False
+
+    @staticmethod
+    def _redis_key(key: str) -> str:
+        return f"idempotency:{key}"
+
+    async def _claim(self, redis, key: str, fingerprint: str) -> Optional[Dict[str, Any]]:
+        """Tar nøkkelen (None), eller venter på og returnerer resultatet fra en annen instans"""
+        pending = json.dumps({"fingerprint": fingerprint, "status": "pending"})
+        while True:
+            if await redis.set(self._redis_key(key), pending, nx=True, ex=int(self.pending_ttl)):
+                return None
+            raw = await redis.get(self._redis_key(key))
+            if raw is None:
+                continue  # Utløp (eller eieren feilet) mellom SET og GET - prøv å ta den selv
+            data = json.loads(raw)
+            if data["fingerprint"] != fingerprint:
+                self.conflicts += 1
+                raise IdempotencyConflict(key)
+            if data["status"] == "completed":
+                return data
+            await asyncio.sleep(self.poll_interval)
+
+    async def _forget(self, redis, key: str):
+        try:
+            await redis.delete(self._redis_key(key))
+        except Exception as e:
+            logger.warning(f"⚠️ Kunne ikke slette idempotency-nøkkel i Redis: {e}")
+
+    async def close(self):
+        if self._redis is not None:
+            await self._redis.close()
+            self._redis = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "redis" if self.redis_url else "memory",
+            "requests": self.requests,
+            "executions": self.executions,
+            "replayed": self.replayed,
+            "conflicts": self.conflicts,
+            "abandoned": self.abandoned,
+            "in_flight": sum(1 for entry in self.entries.values() if not entry.done),
+            "stored": sum(1 for entry in self.entries.values() if entry.done)
+        }
+
+
+def idempotency_store_from_env() -> IdempotencyStore:
+    """IDEMPOTENCY_BACKEND=redis deler resultatene via REDIS_URL, ellers lagres de i prosessen"""
+    backend = os.getenv("IDEMPOTENCY_BACKEND", "memory").lower()
+    return IdempotencyStore(
+        ttl=float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "600")),
+        grace=float(os.getenv("IDEMPOTENCY_GRACE_SECONDS", "10")),
+        redis_url=os.getenv("REDIS_URL", "redis://redis:6379") if backend == "redis" else None
+    )
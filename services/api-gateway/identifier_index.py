@@ -0,0 +1,119 @@
+"""
+Identifier Index - eksakt oppslag på u-blox identifikatorer
+Trekker ut UBX-meldinger, NMEA-setninger, konfignøkler og modulnavn fra tekst
+og holder en hash map fra identifikator → chunk ids.
+"""
+
+import re
+import bisect
+import logging
+from typing import Dict, List, Set
+
+logger = logging.getLogger(__name__)
+
+# NMEA 0183 setninger som u-blox mottakere sender/mottar
+NMEA_SENTENCES = (
+    "DTM", "GAQ", "GBQ", "GBS", "GGA", "GLL", "GLQ", "GNQ", "GNS", "GPQ",
+    "GQQ", "GRS", "GSA", "GST", "GSV", "RLM", "RMC", "THS", "TXT", "VLW",
+    "VTG", "ZDA",
+)
+
+# Produktfamilier for u-blox moduler og chips
+MODULE_FAMILIES = (
+    "ALEX", "ANNA", "DAN", "EVA", "JODY", "LARA", "LEA", "LENA", "LEXI",
+    "MAX", "MIA", "NEO", "NINA", "NORA", "PAM", "RCB", "SAM", "SARA",
+    "TOBY", "ZED", "ZOE",
+)
+
+# Alle mønstre krever hele tokens, så "GPSRAG" eller "CFG" alene gir ingen treff
+_UBX_MESSAGE = re.compile(r"(?<![A-Z0-9-])UBX[-_]([A-Z]{2,5})[-_]([A-Z0-9]{2,12})(?![A-Z0-9])", re.IGNORECASE)
+_CONFIG_KEY = re.compile(r"(?<![A-Z0-9-])CFG[-_]([A-Z0-9]{2,12})[-_]([A-Z0-9_]{2,32})(?![A-Z0-9])", re.IGNORECASE)
+_NMEA_SENTENCE = re.compile(
+    r"(?<![A-Z0-9])\$?G[PNLABQX](" + "|".join(NMEA_SENTENCES) + r")(?![A-Z0-9])",
+    re.IGNORECASE,
+)
+_MODULE = re.compile(
+    r"(?<![A-Z0-9-])(" + "|".join(MODULE_FAMILIES) + r")[-_]([A-Z]?\d{1,3}[A-Z0-9]{0,4})(?:[-_](\d{2}[A-Z]))?(?![A-Z0-9])",
+    re.IGNORECASE,
+)
+
+
+def extract_identifiers(text: str) -> Set[str]:
+    """Trekker ut normaliserte u-blox identifikatorer fra en tekst"""
+    identifiers: Set[str] = set()
+
+    for match in _UBX_MESSAGE.finditer(text):
+        identifiers.add(f"UBX-{match.group(1)}-{match.group(2)}".upper())
+
+    for match in _CONFIG_KEY.finditer(text):
+        identifiers.add(f"CFG-{match.group(1)}-{match.group(2)}".upper())
+
+    # Talker-ID normaliseres til "GX" slik at GPGGA, GNGGA og GxGGA treffer hverandre
+    for match in _NMEA_SENTENCE.finditer(text):
+        identifiers.add(f"GX{match.group(1)}".upper())
+
+    for match in _MODULE.finditer(text):
+        family, variant = match.group(1).upper(), match.group(2).upper()
+        # Ordrekoder (NEO-M8N-0-10 / ZED-F9P-01B) indekseres på basisnavnet
+        identifiers.add(f"{family}-{variant}")
+
+    return identifiers
+
+
+class IdentifierIndex:
+    """Hash map fra identifikator → chunk ids, med prefiksoppslag for modulnavn"""
+
+    def __init__(self):
+        self._postings: Dict[str, Set[str]] = {}
+        self._sorted_keys: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self._postings)
+
+    def add(self, chunk_id: str, text: str) -> Set[str]:
+        """Indekserer en chunk og returnerer identifikatorene som ble funnet"""
+        identifiers = extract_identifiers(text)
+        for identifier in identifiers:
+            if identifier not in self._postings:
+                self._postings[identifier] = set()
+                bisect.insort(self._sorted_keys, identifier)
+            self._postings[identifier].add(chunk_id)
+        return identifiers
+
+    def remove(self, chunk_ids: Set[str]):
+        """Fjerner chunks fra indeksen (f.eks. når et dokument slettes)"""
+        for identifier in list(self._postings):
+            self._postings[identifier] -= chunk_ids
+            if not self._postings[identifier]:
+                del self._postings[identifier]
+                self._sorted_keys.remove(identifier)
+
+    def chunk_ids(self) -> Set[str]:
+        """Alle chunks som har minst én identifikator i indeksen"""
+        return set().union(*self._postings.values())
+
+    def _prefix_matches(self, prefix: str) -> List[str]:
+        """Finner alle nøkler som starter med prefix (NEO-M8 → NEO-M8N, NEO-M8T, ...)"""
+        start = bisect.bisect_left(self._sorted_keys, prefix)
+        matches = []
+        for key in self._sorted_keys[start:]:
+            if not key.startswith(prefix):
+                break
+            matches.append(key)
+        return matches
+
+    def lookup(self, query: str) -> Dict[str, Set[str]]:
+        """Returnerer chunk id → identifikatorene i spørringen som chunken matcher"""
+        hits: Dict[str, Set[str]] = {}
+
+        for identifier in extract_identifiers(query):
+            keys = [identifier] if identifier in self._postings else []
+            # Modulnavn uten variantbokstav (NEO-M8) treffer hele varianten
+            if not keys and identifier.split("-", 1)[0] in MODULE_FAMILIES:
+                keys = self._prefix_matches(identifier)
+
+            for key in keys:
+                for chunk_id in self._postings[key]:
+                    hits.setdefault(chunk_id, set()).add(identifier)
+
+        return hits
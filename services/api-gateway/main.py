@@ -8,16 +8,27 @@ import numpy_compat
 
 from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, HTMLResponse, JSONResponse
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
+import asyncio
+import hashlib
+import io
+import json
 import logging
 import os
 import tempfile
 import shutil
 from pathlib import Path
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from typing import List, Optional
+from datetime import datetime
+import numpy as np
 from rag_service import GPSRAGService # Direkte import
+from reindex import ReindexJob
+from deadline import Deadline
+from disconnect import CLIENT_CLOSED_REQUEST, ClientDisconnected, cancel_on_disconnect
+from idempotency import IDEMPOTENCY_HEADER, REPLAYED_HEADER, IdempotencyConflict, idempotency_store_from_env, request_fingerprint
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -54,11 +65,17 @@ async def lifespan(app: FastAPI):
     # Opprett ÉN enkelt instans av RAG-tjenesten
     app.state.rag_service = GPSRAGService()
     logger.info("✅ Singleton RAG service instans opprettet og lagret på app.state.")
+    # Resultater per Idempotency-Key, så nye forsøk fra frontend ikke gjør jobben på nytt
+    app.state.idempotency = idempotency_store_from_env()
     
     yield
     
     # Shutdown
     logger.info("🔄 Stopper GPSRAG API Gateway...")
+    if app.state.rag_service.reindex_job is not None:
+        app.state.rag_service.reindex_job.cancel()
+    await app.state.rag_service.embedding_provider.close()
+    await app.state.idempotency.close()
     app.state.rag_service = None # Rydd opp
 
 # Create FastAPI app
@@ -138,10 +155,41 @@ except Exception as e:
 # except ImportError as e:
 #     logger.warning(f"⚠️ Chat router ikke tilgjengelig: {e}")
 
+# Filtre som skyves ned i vektorsøket (f.eks. chat om én bestemt manual)
+class SearchFilters(BaseModel):
+    document_id: Optional[str] = None
+    filename: Optional[str] = None
+    page_from: Optional[int] = None
+    page_to: Optional[int] = None
+    uploaded_after: Optional[datetime] = None
+    uploaded_before: Optional[datetime] = None
+
 # Model for the chat request body
 class ChatRequest(BaseModel):
     message: str
     session_id: str = "default-session"
+    filters: Optional[SearchFilters] = None
+    deadline_ms: Optional[int] = None  # Tidsbudsjett for hele svaret; standard RAG_DEADLINE_MS
+
+# Model for halvskrevne spørsmål fra chat-UI-et
+class PrefetchRequest(BaseModel):
+    message: str
+    session_id: str = "default-session"
+    filters: Optional[SearchFilters] = None
+
+# Model for batch-spørringer (evaluering, FAQ-generering)
+class BatchQueryRequest(BaseModel):
+    questions: List[str]
+    top_k: int = Field(5, ge=1, le=50)
+    filters: Optional[SearchFilters] = None
+    generate_answers: bool = False
+    max_concurrency: int = 4
+
+# Model for re-embedding til ny indeksversjon
+class ReindexRequest(BaseModel):
+    provider: str
+    rate_limit: Optional[float] = None  # chunks per sekund
+    batch_size: int = 64
 
 @app.get("/api")
 async def api_root():
@@ -157,9 +205,15 @@ async def api_root():
             "api_health": "/api/health",
             "chat": "/api/chat/",
             "upload": "/api/upload",
+            "chat_stream": "/api/chat/stream",
+            "batch_query": "/api/query/batch",
         }
     }
 
+def idempotent_response(body: dict, replayed: bool) -> JSONResponse:
+    """Svar fra idempotency-lageret; Idempotent-Replayed forteller klienten at det er gjenbrukt"""
+    return JSONResponse(content=body, headers={REPLAYED_HEADER: "true"} if replayed else None)
+
 # Chat endpoint - henter nå RAG-tjenesten fra app.state
 @app.post("/api/chat/")
 async def chat_endpoint(request: Request, chat_request: ChatRequest):
@@ -170,16 +224,44 @@ async def chat_endpoint(request: Request, chat_request: ChatRequest):
         logger.info(f"🚀 RAG Chat query mottatt: {chat_request.message}")
         
         # Kall RAG-tjenesten for å generere et svar
-        rag_result = await rag_service.generate_rag_response(chat_request.message)
+        filters = chat_request.filters.model_dump(exclude_none=True) if chat_request.filters else None
+        deadline = Deadline(chat_request.deadline_ms)
         
-        # Returner svaret i forventet format
-        return {
-            "response": rag_result["response"],
-            "session_id": chat_request.session_id,
-            "status": "success",
-            "sources": rag_result.get("sources", []),
-            "context_used": rag_result.get("context_used", False)
-        }
+        async def answer():
+            rag_result = await rag_service.generate_rag_response(
+                chat_request.message, filters=filters, deadline=deadline, session_id=chat_request.session_id
+            )
+            # Returner svaret i forventet format
+            return {
+                "response": rag_result["response"],
+                "session_id": chat_request.session_id,
+                "status": "success",
+                "sources": rag_result.get("sources", []),
+                "context_used": rag_result.get("context_used", False),
+                "context_stats": rag_result.get("context_stats"),
+                "routing": rag_result.get("routing"),
+                "working_set": rag_result.get("working_set"),
+                "deadline": rag_result.get("deadline")
+            }
+        
+        # Lukker klienten forbindelsen, kanselleres embedding, søk og OpenAI-strømmen
+        # (med Idempotency-Key først etter en kort frist, i tilfelle klienten prøver igjen)
+        idempotency_key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not idempotency_key:
+            return await cancel_on_disconnect(request, answer())
+        body, replayed = await cancel_on_disconnect(
+            request,
+            request.app.state.idempotency.run(
+                idempotency_key, request_fingerprint("chat", chat_request.model_dump(mode="json")), answer
+            )
+        )
+        return idempotent_response(body, replayed)
+    
+    except ClientDisconnected:
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+    
+    except IdempotencyConflict:
+        raise HTTPException(status_code=422, detail=f"{IDEMPOTENCY_HEADER} er allerede brukt med en annen forespørsel")
             
     except Exception as e:
         logger.error(f"❌ Chat endpoint feilet: {e}", exc_info=True)
@@ -189,6 +271,38 @@ async def chat_endpoint(request: Request, chat_request: ChatRequest):
             detail=f"Det oppstod en intern feil i chat-tjenesten: {str(e)}"
         )
 
+@app.post("/api/chat/prefetch")
+async def chat_prefetch_endpoint(request: Request, prefetch_request: PrefetchRequest):
+    """
+    Spekulativ retrieval mens brukeren skriver: henter embedding og kandidater for det
+    halvskrevne spørsmålet i bakgrunnen. Svarer med en gang; er det endelige spørsmålet
+    nær nok, hopper /api/chat/ over embedding og søk.
+    """
+    rag_service = request.app.state.rag_service
+    filters = prefetch_request.filters.model_dump(exclude_none=True) if prefetch_request.filters else None
+    status = rag_service.prefetch(prefetch_request.session_id, prefetch_request.message, filters)
+    return {"status": status}
+
+@app.post("/api/chat/stream")
+async def chat_stream_endpoint(request: Request, chat_request: ChatRequest):
+    """
+    Chat med svaret strømmet som NDJSON: {"type": "token", ...} per token og til slutt
+    {"type": "done", ...} med kilder og statistikk. Identiske samtidige spørsmål deler én beregning.
+    """
+    rag_service = request.app.state.rag_service
+    filters = chat_request.filters.model_dump(exclude_none=True) if chat_request.filters else None
+    deadline = Deadline(chat_request.deadline_ms)
+    
+    async def stream_events():
+        async for event in rag_service.stream_rag_response(
+            chat_request.message, filters=filters, deadline=deadline, session_id=chat_request.session_id
+        ):
+            if event["type"] == "done":
+                event["session_id"] = chat_request.session_id
+            yield json.dumps(event, ensure_ascii=False) + "\n"
+    
+    return StreamingResponse(stream_events(), media_type="application/x-ndjson")
+
 # File upload endpoint - henter nå RAG-tjenesten fra app.state
 @app.post("/api/upload")
 async def upload_file(request: Request, file: UploadFile = File(...)):
@@ -210,63 +324,236 @@ async def upload_file(request: Request, file: UploadFile = File(...)):
         # Reset file pointer
         await file.seek(0)
         
-        # Opprett temp mappe for Railway
-        upload_dir = Path("/tmp/uploads")
-        upload_dir.mkdir(exist_ok=True)
+        async def ingest():
+            # Opprett temp mappe for Railway
+            upload_dir = Path("/tmp/uploads")
+            upload_dir.mkdir(exist_ok=True)
         
-        # Lagre filen midlertidig
-        file_path = upload_dir / file.filename
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+            # Lagre filen midlertidig
+            file_path = upload_dir / file.filename
+            with open(file_path, "wb") as buffer:
+                shutil.copyfileobj(file.file, buffer)
         
-        logger.info(f"✅ Fil lagret: {file.filename} ({file_size} bytes)")
+            logger.info(f"✅ Fil lagret: {file.filename} ({file_size} bytes)")
         
-        # Prosesser dokumentet med RAG
-        try:
-            result = await rag_service.process_document(str(file_path), file.filename)
+            # Prosesser dokumentet med RAG
+            try:
+                result = await rag_service.process_document(str(file_path), file.filename)
             
-            if result["status"] == "success":
-                logger.info(f"✅ RAG prosessering fullført: {result}")
-                return {
-                    "status": "success",
-                    "message": f"Fil '{file.filename}' lastet opp og prosessert",
-                    "filename": file.filename,
-                    "size": file_size,
-                    "processed": True,
-                    "rag_info": {
-                        "doc_id": result["doc_id"],
-                        "chunks_count": result["chunks_count"],
-                        "storage_type": result.get("storage_type", "chromadb")
+                if result["status"] == "success":
+                    logger.info(f"✅ RAG prosessering fullført: {result}")
+                    return {
+                        "status": "success",
+                        "message": f"Fil '{file.filename}' lastet opp og prosessert",
+                        "filename": file.filename,
+                        "size": file_size,
+                        "processed": True,
+                        "rag_info": {
+                            "doc_id": result["doc_id"],
+                            "chunks_count": result["chunks_count"],
+                            "storage_type": result.get("storage_type", "chromadb")
+                        }
                     }
-                }
-            else:
-                logger.warning(f"⚠️ RAG prosessering feilet: {result}")
+                else:
+                    logger.warning(f"⚠️ RAG prosessering feilet: {result}")
+                    return {
+                        "status": "success",
+                        "message": f"Fil '{file.filename}' lastet opp (RAG prosessering feilet: {result['message']})",
+                        "filename": file.filename,
+                        "size": file_size,
+                        "processed": False,
+                        "error": result["message"]
+                    }
+            
+            except Exception as rag_error:
+                logger.error(f"❌ RAG prosessering feilet: {rag_error}")
                 return {
                     "status": "success",
-                    "message": f"Fil '{file.filename}' lastet opp (RAG prosessering feilet: {result['message']})",
+                    "message": f"Fil '{file.filename}' lastet opp (RAG prosessering under feilsøking)",
                     "filename": file.filename,
                     "size": file_size,
                     "processed": False,
-                    "error": result["message"]
+                    "error": str(rag_error)
                 }
-            
-        except Exception as rag_error:
-            logger.error(f"❌ RAG prosessering feilet: {rag_error}")
-            return {
-                "status": "success",
-                "message": f"Fil '{file.filename}' lastet opp (RAG prosessering under feilsøking)",
-                "filename": file.filename,
-                "size": file_size,
-                "processed": False,
-                "error": str(rag_error)
-            }
+        
+        # Et nytt forsøk med samme Idempotency-Key og samme fil ingesteres ikke på nytt
+        idempotency_key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not idempotency_key:
+            return await ingest()
+        fingerprint = request_fingerprint("upload", file.filename, hashlib.sha256(content).hexdigest())
+        body, replayed = await request.app.state.idempotency.run(idempotency_key, fingerprint, ingest)
+        return idempotent_response(body, replayed)
         
     except HTTPException:
         raise
+    except IdempotencyConflict:
+        raise HTTPException(status_code=422, detail=f"{IDEMPOTENCY_HEADER} er allerede brukt med en annen forespørsel")
     except Exception as e:
         logger.error(f"Upload error: {e}")
         raise HTTPException(status_code=500, detail=f"Upload feil: {str(e)}")
 
+@app.delete("/api/documents/{doc_id}")
+async def delete_document(request: Request, doc_id: str):
+    """Sletter et dokument fra live-indeksen"""
+    if not request.app.state.rag_service.delete_document(doc_id):
+        raise HTTPException(status_code=404, detail="Dokumentet finnes ikke")
+    return {"status": "deleted", "doc_id": doc_id}
+
+@app.post("/api/query/batch")
+async def batch_query(request: Request, batch_request: BatchQueryRequest):
+    """
+    Kjører mange spørsmål med ett embedding-kall og én vektorsøk-spørring.
+    Resultatene strømmes som NDJSON, én linje per spørsmål i den rekkefølgen de blir ferdige.
+    """
+    if not batch_request.questions:
+        raise HTTPException(status_code=400, detail="questions kan ikke være tom")
+    if len(batch_request.questions) > 2048:
+        # OpenAI tar maks 2048 input per embedding-kall
+        raise HTTPException(status_code=400, detail="Maks 2048 spørsmål per batch")
+    if batch_request.max_concurrency < 1:
+        raise HTTPException(status_code=400, detail="max_concurrency må være minst 1")
+    
+    rag_service = request.app.state.rag_service
+    filters = batch_request.filters.model_dump(exclude_none=True) if batch_request.filters else None
+    questions = batch_request.questions
+    
+    logger.info(f"📦 Batch-spørring mottatt: {len(questions)} spørsmål")
+    batch_results = await rag_service.search_documents_batch(questions, top_k=batch_request.top_k, filters=filters)
+    
+    async def stream_results():
+        if not batch_request.generate_answers:
+            for index, (question, results) in enumerate(zip(questions, batch_results)):
+                yield json.dumps({"index": index, "question": question, "results": results}, ensure_ascii=False) + "\n"
+            return
+        
+        # Svargenerering med begrenset samtidighet mot OpenAI
+        semaphore = asyncio.Semaphore(batch_request.max_concurrency)
+        
+        async def answer(index: int):
+            async with semaphore:
+                rag_result = await rag_service.answer_from_results(questions[index], batch_results[index])
+            return {
+                "index": index,
+                "question": questions[index],
+                "results": batch_results[index],
+                "response": rag_result["response"],
+                "sources": rag_result.get("sources", []),
+                "context_stats": rag_result.get("context_stats"),
+                "routing": rag_result.get("routing")
+            }
+        
+        tasks = [asyncio.create_task(answer(index)) for index in range(len(questions))]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                yield json.dumps(await finished, ensure_ascii=False) + "\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+    
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+@app.get("/api/index")
+async def index_status(request: Request):
+    """Live indeksversjon og eventuell pågående re-embedding"""
+    rag_service = request.app.state.rag_service
+    job = rag_service.reindex_job
+    return {
+        "version": rag_service.index_version,
+        "collection": rag_service.collection.name,
+        "embedding_provider": rag_service.embedding_provider.name,
+        "chunks": rag_service.collection.count(),
+        "reindex": job.status() if job else None
+    }
+
+@app.post("/api/index/reindex", status_code=202)
+async def start_reindex(request: Request, reindex_request: ReindexRequest):
+    """Starter re-embedding til en ny indeksversjon i bakgrunnen; live-indeksen svarer som før"""
+    rag_service = request.app.state.rag_service
+    if rag_service.reindex_job is not None and rag_service.reindex_job.running:
+        raise HTTPException(status_code=409, detail="En re-embedding pågår allerede")
+    if reindex_request.provider.lower() not in ("openai", "onnx"):
+        raise HTTPException(status_code=400, detail="provider må være openai eller onnx")
+    if reindex_request.batch_size < 1 or (reindex_request.rate_limit is not None and reindex_request.rate_limit <= 0):
+        raise HTTPException(status_code=400, detail="batch_size og rate_limit må være positive")
+    
+    rag_service.reindex_job = ReindexJob(
+        rag_service,
+        reindex_request.provider.lower(),
+        rate_limit=reindex_request.rate_limit,
+        batch_size=reindex_request.batch_size
+    ).start()
+    return rag_service.reindex_job.status()
+
+@app.get("/api/index/reindex")
+async def reindex_status(request: Request):
+    """Fremdrift og ETA for siste re-embedding"""
+    job = request.app.state.rag_service.reindex_job
+    if job is None:
+        raise HTTPException(status_code=404, detail="Ingen re-embedding er startet")
+    return job.status()
+
+@app.delete("/api/index/reindex")
+async def cancel_reindex(request: Request):
+    """Avbryter en pågående re-embedding; skyggeindeksen slettes og live-indeksen beholdes"""
+    job = request.app.state.rag_service.reindex_job
+    if job is None or not job.running:
+        raise HTTPException(status_code=404, detail="Ingen re-embedding pågår")
+    job.cancel()
+    return {"status": "cancelling"}
+
+@app.get("/api/memory")
+async def memory_usage(request: Request):
+    """Minnebudsjett, cgroup-forbruk, minneregnskap per dokument (resident eller offloadet) og cacher som working sets"""
+    rag_service = request.app.state.rag_service
+    chunk_store = rag_service.collection.chunk_store
+    return {
+        **rag_service.memory.stats(),
+        "chunk_store": chunk_store.stats() if chunk_store is not None else None
+    }
+
+@app.get("/api/metrics")
+async def service_metrics(request: Request):
+    """Tellere for sammenslåing av identiske samtidige spørsmål, Idempotency-Key, prefetch, working sets, modellnivåer, OpenAI-kvoten og prioritetskøene"""
+    rag_service = request.app.state.rag_service
+    return {
+        "single_flight": rag_service.single_flight.stats(),
+        "idempotency": request.app.state.idempotency.stats(),
+        "prefetch": rag_service.prefetch_cache.stats(),
+        "working_sets": rag_service.working_sets.stats(),
+        "model_router": rag_service.model_router.stats(),
+        "cpu_scheduler": rag_service.cpu_scheduler.stats(),
+        "openai_limiter": rag_service.openai_limiter.stats() if rag_service.openai_limiter is not None else None
+    }
+
+@app.get("/api/embeddings/export")
+async def export_embeddings(request: Request):
+    """Chunk-embeddings som .npy (float32, én rad per chunk) for scripts/tune_ann_index.py"""
+    vectors = await asyncio.to_thread(request.app.state.rag_service.export_embeddings)
+    buffer = io.BytesIO()
+    np.save(buffer, vectors)
+    return Response(
+        content=buffer.getvalue(),
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": "attachment; filename=embeddings.npy"}
+    )
+
+@app.get("/api/shards")
+async def shard_stats(request: Request):
+    """Antall chunks per shard"""
+    return {"shards": request.app.state.rag_service.collection.stats()}
+
+# Hver ny shard er en collection og en tråd i scatter-gather-poolen
+MAX_SHARDS_PER_REQUEST = 8
+
+@app.post("/api/shards")
+async def add_shards(request: Request, count: int = 1):
+    """Legger til shards og flytter dokumentene som nå hører til de nye"""
+    if not 1 <= count <= MAX_SHARDS_PER_REQUEST:
+        raise HTTPException(status_code=400, detail=f"count må være mellom 1 og {MAX_SHARDS_PER_REQUEST}")
+    rag_service = request.app.state.rag_service
+    result = await asyncio.to_thread(rag_service.add_shards, count)
+    return {"status": "success", **result, "shard_sizes": rag_service.collection.stats()}
+
 # Root route - serve Next.js frontend
 @app.get("/")
 async def root():
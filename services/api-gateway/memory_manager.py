@@ -0,0 +1,288 @@
+"""
+Memory Manager - minneregnskap og offload for den in-memory vektorindeksen
+Holder oversikt over hvor mye minne hvert dokument bruker, og flytter dokumentene som
+sist ble hentet for lengst siden til segmenter på disk når budsjettet er nådd.
+Dokumentene lastes inn igjen når et filter eller en spørring treffer dem.
+Cacher som er registrert (working sets) teller med i budsjettet og krympes før noe offloades.
+"""
+
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# cgroup v2 først, så v1
+CGROUP_LIMIT_FILES = ["/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"]
+CGROUP_USAGE_FILES = ["/sys/fs/cgroup/memory.current", "/sys/fs/cgroup/memory/memory.usage_in_bytes"]
+
+
+def _read_cgroup_value(paths: List[str]) -> Optional[int]:
+    for path in paths:
+        try:
+            value = Path(path).read_text().strip()
+        except OSError:
+            continue
+        if value == "max":
+            return None
+        value = int(value)
+        # cgroup v1 rapporterer "ubegrenset" som et enormt tall
+        return value if value < 2 ** 60 else None
+    return None
+
+
+def cgroup_memory_limit() -> Optional[int]:
+    return _read_cgroup_value(CGROUP_LIMIT_FILES)
+
+
+def cgroup_memory_usage() -> Optional[int]:
+    return _read_cgroup_value(CGROUP_USAGE_FILES)
+
+
+def budget_from_env() -> Optional[int]:
+    """RAG_MEMORY_BUDGET_BYTES, ellers RAG_MEMORY_BUDGET_FRACTION av containerens cgroup-grense"""
+    explicit = os.getenv("RAG_MEMORY_BUDGET_BYTES")
+    if explicit:
+        return int(explicit)
+    limit = cgroup_memory_limit()
+    if limit is None:
+        return None
+    return int(limit * float(os.getenv("RAG_MEMORY_BUDGET_FRACTION", "0.5")))
+
+
+class MemoryManager:
+    """
+    Regnskap per dokument (vektorer + tekst + metadata + HNSW-kanter) og LRU-offload.
+
+    Dokument-centroidene blir alltid liggende i minnet, slik at to-trinns søket fortsatt
+    ser offloadede dokumenter og kan laste dem inn igjen ved behov.
+    """
+
+    def __init__(self, segment_dir: str, budget_bytes: Optional[int] = None, hnsw_m: int = 16):
+        self.segment_dir = Path(segment_dir)
+        self.segment_dir.mkdir(parents=True, exist_ok=True)
+        self.budget_bytes = budget_bytes
+        self.hnsw_m = hnsw_m
+        self.documents: Dict[str, Dict[str, Any]] = {}
+        # Cacher med bytes_used, max_bytes og shrink(target_bytes)
+        self.caches: Dict[str, Any] = {}
+        self.offload_count = 0
+        self.reload_count = 0
+
+    def estimate_bytes(
+        self,
+        embeddings: List[List[float]],
+        documents: List[str],
+        metadatas: List[Dict[str, Any]],
+        text_bytes: Optional[int] = None
+    ) -> int:
+        """text_bytes overstyrer tekststørrelsen når tekstene ligger komprimert"""
+        vector_bytes = sum(len(embedding) for embedding in embeddings) * 4
+        if text_bytes is None:
+            text_bytes = sum(len(document.encode("utf-8")) for document in documents)
+        metadata_bytes = sum(len(json.dumps(metadata)) for metadata in metadatas)
+        # Lag 0 i HNSW har opptil 2*M naboer per vektor, 8 byte per kant
+        graph_bytes = len(embeddings) * 2 * self.hnsw_m * 8
+        return vector_bytes + text_bytes + metadata_bytes + graph_bytes
+
+    def register(self, doc_id: str, filename: str, uploaded_at: int, size_bytes: int, chunk_count: int):
+        self.documents[doc_id] = {
+            "filename": filename,
+            "uploaded_at": uploaded_at,
+            "bytes": size_bytes,
+            "chunk_count": chunk_count,
+            "last_retrieved": time.time(),
+            "resident": True
+        }
+
+    def touch(self, doc_ids: Iterable[str]):
+        now = time.time()
+        for doc_id in doc_ids:
+            if doc_id in self.documents:
+                self.documents[doc_id]["last_retrieved"] = now
+
+    @property
+    def resident_bytes(self) -> int:
+        return sum(d["bytes"] for d in self.documents.values() if d["resident"])
+
+    @property
+    def cache_bytes(self) -> int:
+        return sum(cache.bytes_used for cache in self.caches.values())
+
+    def register_cache(self, name: str, cache):
+        """En cache som teller mot budsjettet; den kan gjenoppbygges, så den krympes før dokumenter offloades"""
+        self.caches[name] = cache
+
+    def relieve_caches(self) -> int:
+        """Krymper cachene til resident + cacher er innenfor budsjettet; returnerer frigjorte bytes"""
+        if self.budget_bytes is None:
+            return 0
+        excess = self.resident_bytes + self.cache_bytes - self.budget_bytes
+        freed = 0
+        for cache in self.caches.values():
+            if freed >= excess:
+                break
+            freed += cache.shrink(max(cache.bytes_used - (excess - freed), 0))
+        if freed:
+            logger.info(f"🧹 Minnepress: krympet cachene med {freed} byte")
+        return freed
+
+    def offloaded_ids(self) -> Set[str]:
+        return {doc_id for doc_id, d in self.documents.items() if not d["resident"]}
+
+    def matching_offloaded(self, filters: Optional[Dict[str, Any]], to_timestamp) -> Set[str]:
+        """Offloadede dokumenter som et document_id/filename/dato-filter peker på"""
+        if not filters:
+            return set()
+        keys = ("document_id", "filename", "uploaded_after", "uploaded_before")
+        if not any(filters.get(key) is not None for key in keys):
+            return set()
+
+        matches = set()
+        for doc_id in self.offloaded_ids():
+            document = self.documents[doc_id]
+            if filters.get("document_id") and filters["document_id"] != doc_id:
+                continue
+            if filters.get("filename") and filters["filename"] != document["filename"]:
+                continue
+            if filters.get("uploaded_after") is not None and document["uploaded_at"] < to_timestamp(filters["uploaded_after"]):
+                continue
+            if filters.get("uploaded_before") is not None and document["uploaded_at"] > to_timestamp(filters["uploaded_before"]):
+                continue
+            matches.add(doc_id)
+        return matches
+
+    def _segment_paths(self, doc_id: str):
+        return self.segment_dir / f"{doc_id}.npy", self.segment_dir / f"{doc_id}.json"
+
+    def read_segment(self, doc_id: str) -> Dict[str, list]:
+        vectors_path, rows_path = self._segment_paths(doc_id)
+        rows = json.loads(rows_path.read_text())
+        rows["embeddings"] = np.load(vectors_path).tolist()
+        return rows
+
+    def read_chunks(self, doc_id: str, collection) -> Dict[str, list]:
+        """Et dokuments chunks, enten de ligger i collection eller i et segment på disk"""
+        document = self.documents.get(doc_id)
+        if document is not None and not document["resident"]:
+            return self.read_segment(doc_id)
+        return collection.get(where={"doc_id": doc_id}, include=["embeddings", "documents", "metadatas"])
+
+    def offload(self, doc_id: str, collection):
+        """Skriver dokumentets chunks til disk og fjerner dem fra collection"""
+        chunks = collection.get(where={"doc_id": doc_id}, include=["embeddings", "documents", "metadatas"])
+        vectors_path, rows_path = self._segment_paths(doc_id)
+
+        # Skriv til midlertidige filer først så et avbrudd ikke etterlater et halvt segment
+        with open(f"{vectors_path}.tmp", "wb") as handle:
+            np.save(handle, np.asarray(chunks["embeddings"], dtype=np.float32))
+        Path(f"{rows_path}.tmp").write_text(json.dumps({
+            "ids": chunks["ids"],
+            "documents": chunks["documents"],
+            "metadatas": chunks["metadatas"]
+        }))
+        os.replace(f"{vectors_path}.tmp", vectors_path)
+        os.replace(f"{rows_path}.tmp", rows_path)
+
+        collection.delete(ids=chunks["ids"])
+        self.documents[doc_id]["resident"] = False
+        self.offload_count += 1
+
+    def reload(self, doc_ids: Iterable[str], collection) -> List[str]:
+        """Laster offloadede dokumenter inn i collection igjen"""
+        reloaded = []
+        for doc_id in doc_ids:
+            document = self.documents.get(doc_id)
+            if document is None or document["resident"]:
+                continue
+            rows = self.read_segment(doc_id)
+            collection.add(
+                ids=rows["ids"],
+                embeddings=rows["embeddings"],
+                metadatas=rows["metadatas"],
+                documents=rows["documents"]
+            )
+            document["resident"] = True
+            self._remove_segment(doc_id)
+            reloaded.append(doc_id)
+            self.reload_count += 1
+
+        if reloaded:
+            logger.info(f"📥 Lastet inn {len(reloaded)} offloadede dokumenter igjen")
+        return reloaded
+
+    def enforce(self, collection, protected: Iterable[str] = ()) -> List[str]:
+        """Offloader minst nylig hentede dokumenter til resident-minnet er innenfor budsjettet"""
+        if self.budget_bytes is None:
+            return []
+
+        self.relieve_caches()
+        protected = set(protected)
+        resident = self.resident_bytes
+        document_budget = self.budget_bytes - self.cache_bytes
+        offloaded = []
+        candidates = sorted(
+            (doc_id for doc_id, d in self.documents.items() if d["resident"] and doc_id not in protected),
+            key=lambda doc_id: self.documents[doc_id]["last_retrieved"]
+        )
+        for doc_id in candidates:
+            if resident <= document_budget:
+                break
+            try:
+                self.offload(doc_id, collection)
+            except Exception as e:
+                logger.error(f"❌ Offload av {doc_id} feilet: {e}")
+                continue
+            resident -= self.documents[doc_id]["bytes"]
+            offloaded.append(doc_id)
+
+        if offloaded:
+            logger.info(f"📤 Offloadet {len(offloaded)} dokumenter ({resident}/{document_budget} byte resident)")
+        return offloaded
+
+    def rebuild(self, sizes: Dict[str, int]):
+        """Etter bytte av indeksversjon ligger alt i den nye collection - gamle segmenter er utdaterte"""
+        for doc_id in list(self.documents):
+            if not self.documents[doc_id]["resident"]:
+                self._remove_segment(doc_id)
+            self.documents[doc_id]["resident"] = True
+            if doc_id in sizes:
+                self.documents[doc_id]["bytes"] = sizes[doc_id]
+
+    def forget(self, doc_id: str):
+        """Dokumentet er slettet - fjern regnskapet og et eventuelt segment på disk"""
+        if self.documents.pop(doc_id, None) is not None:
+            self._remove_segment(doc_id)
+
+    def _remove_segment(self, doc_id: str):
+        for path in self._segment_paths(doc_id):
+            path.unlink(missing_ok=True)
+
+    def stats(self) -> Dict[str, Any]:
+        offloaded = self.offloaded_ids()
+        return {
+            "budget_bytes": self.budget_bytes,
+            "resident_bytes": self.resident_bytes,
+            "offloaded_bytes": sum(self.documents[doc_id]["bytes"] for doc_id in offloaded),
+            "cache_bytes": self.cache_bytes,
+            "caches": {
+                name: {"bytes": cache.bytes_used, "max_bytes": cache.max_bytes}
+                for name, cache in self.caches.items()
+            },
+            "cgroup_limit_bytes": cgroup_memory_limit(),
+            "cgroup_usage_bytes": cgroup_memory_usage(),
+            "documents_resident": len(self.documents) - len(offloaded),
+            "documents_offloaded": len(offloaded),
+            "offloads": self.offload_count,
+            "reloads": self.reload_count,
+            "segment_dir": str(self.segment_dir),
+            "documents": [
+                {"doc_id": doc_id, **document}
+                for doc_id, document in sorted(self.documents.items(), key=lambda item: -item[1]["bytes"])
+            ]
+        }
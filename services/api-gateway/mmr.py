@@ -0,0 +1,42 @@
+"""
+Maximal Marginal Relevance (MMR) for diversifisering av søketreff
+Velger k chunks som er relevante for spørringen, men ikke nesten-duplikater av hverandre.
+"""
+
+from typing import List, Sequence
+
+import numpy as np
+
+
+def maximal_marginal_relevance(
+    embeddings: Sequence[Sequence[float]],
+    relevance: Sequence[float],
+    k: int,
+    lambda_mult: float = 0.7
+) -> List[int]:
+    """
+    Returnerer indeksene til de k valgte kandidatene i MMR-rekkefølge.
+
+    lambda_mult=1.0 gir ren relevans-rangering, lambda_mult=0.0 gir maksimal spredning.
+    """
+    if k <= 0 or len(embeddings) == 0:
+        return []
+
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = vectors / np.where(norms == 0, 1.0, norms)
+    scores = np.asarray(relevance, dtype=np.float32)
+
+    k = min(k, len(vectors))
+    selected = [int(np.argmax(scores))]
+    # Høyeste cosinus-likhet hver kandidat har mot det valgte settet, oppdateres inkrementelt
+    max_similarity = vectors @ vectors[selected[0]]
+
+    while len(selected) < k:
+        mmr_scores = lambda_mult * scores - (1 - lambda_mult) * max_similarity
+        mmr_scores[selected] = -np.inf
+        next_index = int(np.argmax(mmr_scores))
+        selected.append(next_index)
+        max_similarity = np.maximum(max_similarity, vectors @ vectors[next_index])
+
+    return selected
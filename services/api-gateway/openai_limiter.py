@@ -0,0 +1,308 @@
+"""
+OpenAI Limiter - delt klient-side rate limiting mot OpenAI
+Chat-modellen og embedding-modellen har hver sin kvote hos OpenAI, så hver får sin pool
+med token buckets for forespørsler per minutt (RPM) og tokens per minutt (TPM). Rutene
+(chat, query, ingest) trekker fra poolen sin, og kan ha en egen andel av den - slik kan
+ikke en bulk-opplasting bruke opp kvoten som spørsmål trenger for query-embeddings.
+
+Samtidigheten per pool justeres med AIMD: litt opp for hvert vellykkede kall, halvert ved
+429, og ledige plasser går til interaktive kall før bulk (se priority_scheduler). 429 og 5xx prøves på nytt etter Retry-After (eller eksponentiell backoff) med jitter,
+og en 429 med Retry-After setter hele poolen på pause så de andre kallene ikke også
+treffer veggen. Gjenstående kvote fra x-ratelimit-headerne trekkes inn i bøttene, så
+vi ligger rett under taket i stedet for å pendle over og under det.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+import httpx
+
+from priority_scheduler import PriorityScheduler, current_route, route_class
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+class TokenBucket:
+    """Fylles kontinuerlig med per_minute/60 per sekund opp til ett minutts kvote"""
+
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self.rate = per_minute / 60.0
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.per_minute, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Sekunder til amount er tilgjengelig (store kall venter bare til bøtta er full)"""
+        self._refill()
+        needed = min(amount, self.per_minute)
+        return 0.0 if self.level >= needed else (needed - self.level) / self.rate
+
+    def take(self, amount: float):
+        # Kan gå i minus - et stort kall betales tilbake før de neste slipper til
+        self._refill()
+        self.level -= amount
+
+    def sync(self, remaining: float):
+        """OpenAI sier hvor mye som faktisk er igjen; vi stoler aldri på mer enn det"""
+        self._refill()
+        self.level = min(self.level, remaining)
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD: +1/limit per vellykket kall (≈ +1 per runde), halvering ved 429. Plassene
+    deles ut av en PriorityScheduler, så query-embeddings går foran ventende opplastings-batcher.
+    """
+
+    def __init__(self, name: str, initial: int, minimum: int, maximum: int, min_bulk_share: float = 0.1, decrease_cooldown: float = 1.0):
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.decrease_cooldown = decrease_cooldown
+        self._last_decrease = 0.0
+        self.slots = PriorityScheduler(name, int(self.limit), min_bulk_share=min_bulk_share)
+
+    @property
+    def in_flight(self) -> int:
+        return self.slots.in_flight
+
+    async def acquire(self, cls: str) -> str:
+        return await self.slots.acquire(cls)
+
+    def release(self, cls: str):
+        self.slots.release(cls)
+
+    def on_success(self):
+        self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+        self.slots.set_capacity(int(self.limit))
+
+    def on_throttled(self):
+        # Alle kallene fra samme overtrekk får 429 - bare halver én gang per cooldown
+        now = time.monotonic()
+        if now - self._last_decrease >= self.decrease_cooldown:
+            self.limit = max(self.minimum, self.limit / 2)
+            self._last_decrease = now
+            self.slots.set_capacity(int(self.limit))
+
+
+class LimitPool:
+    """Kvoten for én OpenAI-modell"""
+
+    def __init__(self, name: str, rpm: float, tpm: float, concurrency: AdaptiveConcurrency):
+        self.name = name
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.concurrency = concurrency
+        self.paused_until = 0.0
+
+
+class Route:
+    """En brukstype med sin andel av poolen (share=1.0 betyr ingen egen grense)"""
+
+    def __init__(self, name: str, pool: LimitPool, share: float = 1.0):
+        self.name = name
+        self.pool = pool
+        self.share = share
+        self.requests = TokenBucket(pool.requests.per_minute * share) if share < 1.0 else None
+        self.tokens = TokenBucket(pool.tokens.per_minute * share) if share < 1.0 else None
+        self._lock = asyncio.Lock()
+        # Metrikker
+        self.calls = 0
+        self.throttled = 0
+        self.retries = 0
+        self.failures = 0
+        self.waited_seconds = 0.0
+
+    def buckets(self):
+        """(bøtte, mengde-nøkkel) for alt ruten må ha plass i"""
+        pool = self.pool
+        pairs = [(pool.requests, "requests"), (pool.tokens, "tokens")]
+        if self.requests is not None:
+            pairs += [(self.requests, "requests"), (self.tokens, "tokens")]
+        return pairs
+
+
+class OpenAILimiter:
+    """Felles limiter for alle OpenAI-kall i prosessen"""
+
+    def __init__(
+        self,
+        chat_rpm: float = 3500,
+        chat_tpm: float = 90000,
+        embed_rpm: float = 3000,
+        embed_tpm: float = 1000000,
+        ingest_share: float = 0.7,
+        initial_concurrency: int = 8,
+        min_concurrency: int = 1,
+        max_concurrency: int = 32,
+        min_bulk_share: float = 0.1,
+        max_retries: int = 4,
+        base_backoff: float = 0.5,
+        max_backoff: float = 20.0,
+        jitter: float = 0.2
+    ):
+        def concurrency(name: str):
+            return AdaptiveConcurrency(name, initial_concurrency, min_concurrency, max_concurrency, min_bulk_share)
+
+        chat = LimitPool("chat", chat_rpm, chat_tpm, concurrency("chat"))
+        embeddings = LimitPool("embeddings", embed_rpm, embed_tpm, concurrency("embeddings"))
+        self.pools = {pool.name: pool for pool in (chat, embeddings)}
+        self.routes = {
+            "chat": Route("chat", chat),
+            "query": Route("query", embeddings),
+            # Opplasting og reindeksering får bare en andel, så spørsmål alltid slipper til
+            "ingest": Route("ingest", embeddings, share=ingest_share)
+        }
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    @staticmethod
+    def estimate_tokens(texts: List[str]) -> int:
+        """Grovt anslag (~4 tegn per token); x-ratelimit-headerne korrigerer bøttene etterpå"""
+        return sum(len(text) // 4 + 1 for text in texts)
+
+    def _route(self, name: Optional[str]) -> Route:
+        return self.routes[name or current_route()]
+
+    async def _acquire(self, route: Route, tokens: int) -> str:
+        """
+        Venter til kvoten og samtidigheten gir plass; rutens lås gir FIFO innen ruten.
+        Returnerer prioritetsklassen som plassen må gis tilbake med.
+        """
+        started = time.monotonic()
+        amounts = {"requests": 1, "tokens": tokens}
+        async with route._lock:
+            while True:
+                pause = route.pool.paused_until - time.monotonic()
+                wait = max([pause] + [bucket.wait_time(amounts[key]) for bucket, key in route.buckets()])
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            for bucket, key in route.buckets():
+                bucket.take(amounts[key])
+        cls = await route.pool.concurrency.acquire(route_class(route.name))
+        route.waited_seconds += time.monotonic() - started
+        return cls
+
+    def _retry_delay(self, headers: httpx.Headers, attempt: int) -> float:
+        retry_after = None
+        if headers.get("retry-after-ms"):
+            retry_after = float(headers["retry-after-ms"]) / 1000
+        elif headers.get("retry-after"):
+            try:
+                retry_after = float(headers["retry-after"])
+            except ValueError:
+                pass  # HTTP-dato - faller tilbake til backoff
+        if retry_after is not None:
+            # Jitter oppover så ventende kall ikke kommer tilbake i samme millisekund
+            return retry_after * (1 + random.uniform(0, self.jitter))
+        backoff = min(self.max_backoff, self.base_backoff * 2 ** attempt)
+        return random.uniform(backoff / 2, backoff)
+
+    def observe(self, headers: httpx.Headers, route: Optional[str] = None):
+        """Trekker gjenstående kvote fra OpenAI sine x-ratelimit-headere inn i bøttene"""
+        pool = self._route(route).pool
+        for bucket, header in ((pool.requests, "x-ratelimit-remaining-requests"), (pool.tokens, "x-ratelimit-remaining-tokens")):
+            value = headers.get(header)
+            if value is not None:
+                try:
+                    bucket.sync(float(value))
+                except ValueError:
+                    pass
+
+    async def run(self, tokens: int, call: Callable[[], Awaitable[T]], route: Optional[str] = None) -> T:
+        """
+        Kjører call innenfor kvoten. call må kaste httpx.HTTPStatusError ved HTTP-feil
+        (raise_for_status); 429 og 5xx prøves på nytt, alt annet kastes videre.
+        """
+        route_state = self._route(route)
+        pool = route_state.pool
+        route_state.calls += 1
+        for attempt in range(self.max_retries + 1):
+            cls = await self._acquire(route_state, tokens)
+            delay = None
+            try:
+                result = await call()
+            except httpx.HTTPStatusError as e:
+                status = e.response.status_code
+                if status == 429:
+                    route_state.throttled += 1
+                    pool.concurrency.on_throttled()
+                    self.observe(e.response.headers, route_state.name)
+                if status not in RETRYABLE_STATUS or attempt == self.max_retries:
+                    route_state.failures += 1
+                    raise
+                delay = self._retry_delay(e.response.headers, attempt)
+                if status == 429:
+                    pool.paused_until = max(pool.paused_until, time.monotonic() + delay)
+            else:
+                pool.concurrency.on_success()
+                return result
+            finally:
+                pool.concurrency.release(cls)
+
+            route_state.retries += 1
+            logger.warning(
+                f"⏳ OpenAI svarte {status} på {route_state.name} - prøver igjen om {delay:.1f}s "
+                f"(forsøk {attempt + 2}/{self.max_retries + 1}, samtidighet {pool.concurrency.limit:.1f})"
+            )
+            await asyncio.sleep(delay)
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "pools": {
+                name: {
+                    "requests_available": round(pool.requests.level, 1),
+                    "tokens_available": round(pool.tokens.level, 1),
+                    "concurrency_limit": round(pool.concurrency.limit, 2),
+                    "in_flight": pool.concurrency.in_flight,
+                    "paused_for_seconds": round(max(pool.paused_until - now, 0.0), 2),
+                    "scheduler": pool.concurrency.slots.stats()
+                }
+                for name, pool in self.pools.items()
+            },
+            "routes": {
+                name: {
+                    "share": route.share,
+                    "calls": route.calls,
+                    "throttled": route.throttled,
+                    "retries": route.retries,
+                    "failures": route.failures,
+                    "waited_seconds": round(route.waited_seconds, 3)
+                }
+                for name, route in self.routes.items()
+            }
+        }
+
+
+def openai_limiter_from_env() -> Optional[OpenAILimiter]:
+    """RAG_OPENAI_LIMITER=false skrur av limiteren (kallene går rett til OpenAI)"""
+    if os.getenv("RAG_OPENAI_LIMITER", "true").lower() != "true":
+        return None
+    return OpenAILimiter(
+        chat_rpm=float(os.getenv("RAG_OPENAI_CHAT_RPM", "3500")),
+        chat_tpm=float(os.getenv("RAG_OPENAI_CHAT_TPM", "90000")),
+        embed_rpm=float(os.getenv("RAG_OPENAI_EMBED_RPM", "3000")),
+        embed_tpm=float(os.getenv("RAG_OPENAI_EMBED_TPM", "1000000")),
+        ingest_share=float(os.getenv("RAG_OPENAI_INGEST_SHARE", "0.7")),
+        initial_concurrency=int(os.getenv("RAG_OPENAI_CONCURRENCY", "8")),
+        min_concurrency=int(os.getenv("RAG_OPENAI_MIN_CONCURRENCY", "1")),
+        max_concurrency=int(os.getenv("RAG_OPENAI_MAX_CONCURRENCY", "32")),
+        min_bulk_share=float(os.getenv("RAG_MIN_BULK_SHARE", "0.1")),
+        max_retries=int(os.getenv("RAG_OPENAI_MAX_RETRIES", "4"))
+    )
@@ -0,0 +1,301 @@
+"""
+Prefetch Cache - spekulativ retrieval mens brukeren skriver
+Chat-UI-et sender det halvskrevne spørsmålet (debounced) til /api/chat/prefetch. Her
+ventes det litt til (per sesjon - et nytt tastetrykk erstatter det forrige), før
+query-embedding og ChromaDB-kandidatene hentes og legges i en kortlivet cache.
+
+Når hele spørsmålet kommer, gjenbrukes kandidatene bare hvis det endelige spørsmålet er
+en forlengelse av det som ble prefetchet (samme filtre). Er det ikke nøyaktig samme
+spørsmål, embeddes det endelige spørsmålet likevel: kandidatene godtas bare når de to
+embeddingene er nær nok hverandre, og de rangeres på nytt mot den endelige embeddingen.
+Da spares ANN-søket (og for identiske spørsmål også embedding-kallet). Pågår prefetchen
+fortsatt, venter spørsmålet på den i stedet for å starte et nytt kall.
+
+Vektorene lagres som float32, og cachen holdes innenfor max_bytes. Ny eller slettet
+data tømmer den.
+"""
+
+import asyncio
+import collections
+import json
+import logging
+import re
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import numpy as np
+
+from single_flight import normalize_question
+
+logger = logging.getLogger(__name__)
+
+_WORD = re.compile(r"\w+")
+
+
+def _digit_words(text: str) -> set:
+    return {word for word in _WORD.findall(text) if any(ch.isdigit() for ch in word)}
+
+
+def _unit(vectors) -> np.ndarray:
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1.0, norms)
+
+
+def pack_candidates(query_embeddings: List[List[float]], results: Dict[str, list]) -> Dict[str, Any]:
+    """Det en prefetch lagrer: query-embeddingen og rad 0 av et ChromaDB query-svar, med vektorene som float32"""
+    found = bool(results["ids"]) and len(results["ids"][0]) > 0
+    return {
+        "embedding": np.asarray(query_embeddings[0], dtype=np.float32),
+        "ids": list(results["ids"][0]) if found else [],
+        "metadatas": list(results["metadatas"][0]) if found else [],
+        "embeddings": np.asarray(results["embeddings"][0] if found else [], dtype=np.float32)
+    }
+
+
+def _packed_bytes(value: Dict[str, Any]) -> int:
+    return (
+        value["embedding"].nbytes
+        + value["embeddings"].nbytes
+        + sum(len(chunk_id) for chunk_id in value["ids"])
+        + len(json.dumps(value["metadatas"], default=str))
+    )
+
+
+class PrefetchCache:
+    """Prefetchede (embedding, kandidater) per normalisert delspørsmål og filtre"""
+
+    def __init__(
+        self,
+        ttl: float = 30.0,
+        max_entries: int = 256,
+        max_bytes: int = 32 * 1024 * 1024,
+        min_similarity: float = 0.8,
+        min_cosine: float = 0.9,
+        debounce: float = 0.25,
+        min_chars: int = 12
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.min_similarity = min_similarity
+        self.min_cosine = min_cosine
+        self.debounce = debounce
+        self.min_chars = min_chars
+        self.entries: "collections.OrderedDict[str, Dict[str, Any]]" = collections.OrderedDict()
+        self.bytes_used = 0
+        # Prefetch som venter på debounce, per sesjon
+        self.debouncing: Dict[str, asyncio.Task] = {}
+        # Økes når data endres; eldre oppføringer brukes ikke
+        self.generation = 0
+        # Tellere for metrikker
+        self.requests = 0
+        self.debounced = 0
+        self.computed = 0
+        self.failed = 0
+        self.evicted = 0
+        self.hits = {"exact": 0, "close": 0, "in_flight": 0}
+        self.rejected = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    @staticmethod
+    def _filters_key(filters: Optional[Dict[str, Any]]) -> str:
+        return json.dumps(filters or {}, sort_keys=True, default=str)
+
+    def _key(self, query: str, filters: Optional[Dict[str, Any]]) -> str:
+        return f"{self._filters_key(filters)}|{normalize_question(query)}"
+
+    def similarity(self, prefetched: str, final: str) -> float:
+        """Hvor stor del av det endelige spørsmålet som var skrevet; 0 hvis det ikke er en forlengelse"""
+        prefetched, final = normalize_question(prefetched), normalize_question(final)
+        if prefetched == final:
+            return 1.0
+        if not final.startswith(prefetched):
+            return 0.0
+        # Modellnavn og verdier (NEO-M8 vs NEO-M8N, 9600 vs 96000) må være skrevet ferdig
+        if _digit_words(prefetched) != _digit_words(final):
+            return 0.0
+        return len(prefetched) / len(final)
+
+    def _drop(self, key: str):
+        entry = self.entries.pop(key)
+        self.bytes_used -= entry["bytes"]
+
+    def _prune(self):
+        now = time.monotonic()
+        for key in [key for key, entry in self.entries.items() if entry["expires_at"] <= now or entry["generation"] != self.generation]:
+            self._drop(key)
+
+    def _evict(self):
+        """Eldste oppføringer ut til både antall og bytes er innenfor grensene"""
+        while self.entries and (len(self.entries) > self.max_entries or self.bytes_used > self.max_bytes):
+            self._drop(next(iter(self.entries)))
+            self.evicted += 1
+
+    def prefetch(
+        self,
+        session_id: str,
+        query: str,
+        filters: Optional[Dict[str, Any]],
+        compute: Callable[[], Awaitable[Dict[str, Any]]]
+    ) -> str:
+        """
+        Planlegger en prefetch og returnerer med en gang: "skipped" (for kort), "cached"
+        eller "scheduled". compute gir pack_candidates() for det halvskrevne spørsmålet.
+        """
+        self.requests += 1
+        if len(normalize_question(query)) < self.min_chars:
+            return "skipped"
+        self._prune()
+        key = self._key(query, filters)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return "cached"
+        previous = self.debouncing.pop(session_id, None)
+        if previous is not None and not previous.done():
+            previous.cancel()
+            self.debounced += 1
+        self.debouncing[session_id] = asyncio.ensure_future(self._run(session_id, key, query, filters, compute))
+        return "scheduled"
+
+    async def _run(self, session_id: str, key: str, query: str, filters: Optional[Dict[str, Any]], compute):
+        try:
+            await asyncio.sleep(self.debounce)
+        finally:
+            if self.debouncing.get(session_id) is asyncio.current_task():
+                del self.debouncing[session_id]
+        entry = {
+            "query": query,
+            "filters_key": self._filters_key(filters),
+            "generation": self.generation,
+            "expires_at": time.monotonic() + self.ttl,
+            "started_at": time.monotonic(),
+            "duration": None,
+            "bytes": 0,
+            "task": asyncio.ensure_future(compute())
+        }
+        if key in self.entries:
+            self._drop(key)
+        self.entries[key] = entry
+        self._evict()
+        entry["task"].add_done_callback(lambda task: self._finished(key, entry, task))
+
+    def _finished(self, key: str, entry: Dict[str, Any], task: asyncio.Task):
+        if task.cancelled() or task.exception() is not None:
+            self.failed += 1
+            if self.entries.get(key) is entry:
+                self._drop(key)
+            if not task.cancelled():
+                logger.warning(f"⚠️ Prefetch feilet for \"{entry['query'][:40]}\": {task.exception()}")
+            return
+        self.computed += 1
+        entry["duration"] = time.monotonic() - entry["started_at"]
+        if self.entries.get(key) is entry:
+            entry["bytes"] = _packed_bytes(task.result())
+            self.bytes_used += entry["bytes"]
+            self._evict()
+
+    def _closest(self, query: str, filters: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        exact = self.entries.get(self._key(query, filters))
+        if exact is not None:
+            return exact
+        filters_key = self._filters_key(filters)
+        best, best_similarity = None, self.min_similarity
+        for entry in self.entries.values():
+            if entry["filters_key"] != filters_key:
+                continue
+            similarity = self.similarity(entry["query"], query)
+            if similarity >= best_similarity:
+                best, best_similarity = entry, similarity
+        return best
+
+    async def lookup(
+        self,
+        query: str,
+        filters: Optional[Dict[str, Any]],
+        wait_timeout: Optional[float] = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Prefetchen av query eller av en begynnelse av det, eller None. En prefetch som
+        fortsatt pågår ventes på i høyst wait_timeout sekunder. "exact" sier om
+        embeddingen kan brukes som den er; ellers må kandidatene gjennom accept().
+        """
+        self._prune()
+        entry = self._closest(query, filters)
+        if entry is None:
+            self.misses += 1
+            return None
+        task = entry["task"]
+        in_flight = not task.done()
+        if in_flight:
+            try:
+                await asyncio.wait_for(asyncio.shield(task), wait_timeout)
+            except Exception:
+                self.misses += 1
+                return None
+        if task.cancelled() or task.exception() is not None or entry["generation"] != self.generation:
+            self.misses += 1
+            return None
+        exact = normalize_question(entry["query"]) == normalize_question(query)
+        return {
+            **task.result(),
+            "query": entry["query"],
+            "exact": exact,
+            "kind": "in_flight" if in_flight else ("exact" if exact else "close"),
+            "duration": None if in_flight else entry["duration"]
+        }
+
+    def accept(self, prefetched: Dict[str, Any], query_embedding: List[float]) -> Optional[Dict[str, list]]:
+        """
+        Kandidatene fra lookup() rangert mot det endelige spørsmålets embedding, på samme
+        form som et ChromaDB query-svar - eller None når embeddingene er for ulike.
+        """
+        query_vector = _unit(query_embedding)
+        if not prefetched["exact"]:
+            cosine = float(_unit(prefetched["embedding"]) @ query_vector)
+            if cosine < self.min_cosine:
+                self.rejected += 1
+                logger.info(f"🔮 Forkaster prefetch \"{prefetched['query'][:40]}\" (cosinus {cosine:.2f})")
+                return None
+        self.hits[prefetched["kind"]] += 1
+        if prefetched["duration"] is not None:
+            self.saved_seconds += prefetched["duration"]
+        logger.info(f"🔮 Gjenbruker prefetch \"{prefetched['query'][:40]}\" ({prefetched['kind']})")
+
+        if not prefetched["ids"]:
+            return {"ids": [[]], "metadatas": [[]], "distances": [[]], "embeddings": [[]]}
+        similarities = _unit(prefetched["embeddings"]) @ query_vector
+        order = np.argsort(-similarities)
+        return {
+            "ids": [[prefetched["ids"][i] for i in order]],
+            "metadatas": [[prefetched["metadatas"][i] for i in order]],
+            "distances": [[float(1 - similarities[i]) for i in order]],
+            "embeddings": [[prefetched["embeddings"][i] for i in order]]
+        }
+
+    def clear(self):
+        """Data er endret - ingen prefetch fra før nå kan brukes"""
+        self.generation += 1
+        self.entries.clear()
+        self.bytes_used = 0
+
+    def stats(self) -> Dict[str, Any]:
+        hits = sum(self.hits.values())
+        lookups = hits + self.rejected + self.misses
+        return {
+            "requests": self.requests,
+            "debounced": self.debounced,
+            "computed": self.computed,
+            "failed": self.failed,
+            "hits": dict(self.hits),
+            "rejected": self.rejected,
+            "misses": self.misses,
+            "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+            "saved_ms": round(self.saved_seconds * 1000, 1),
+            "cached": len(self.entries),
+            "bytes": self.bytes_used,
+            "max_bytes": self.max_bytes,
+            "evicted": self.evicted,
+            "debouncing": len(self.debouncing)
+        }
@@ -0,0 +1,176 @@
+"""
+Priority Scheduler - interaktive kall foran bulk-arbeid
+Chat og query-embeddings ("interactive") og opplasting/reindeksering ("bulk") deler
+OpenAI-kvoten, event-loopen og CPU-en. Schedulerne gir et fast antall plasser; når en
+plass blir ledig, går ventende interaktivt arbeid foran ventende bulk-arbeid, men bulk
+får alltid minst min_bulk_share av plassene når begge venter, så en stor opplasting
+ikke sulter helt ut.
+
+Klassen avgjøres av ruten kallet kjører under (work_route("ingest") = bulk), og arves
+av tasks som startes inne i blokken.
+"""
+
+import asyncio
+import collections
+import contextlib
+import contextvars
+import time
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, Optional
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+ROUTE_CLASSES = {"chat": INTERACTIVE, "query": INTERACTIVE, "ingest": BULK}
+
+# Ruten arbeidet tilhører (chat, query, ingest); brukes også av OpenAI-limiteren
+_current_route: contextvars.ContextVar[str] = contextvars.ContextVar("work_route", default="query")
+
+
+@contextlib.contextmanager
+def work_route(name: str) -> Iterator[None]:
+    """Arbeid (og tasks startet) inne i blokken regnes mot ruten name"""
+    token = _current_route.set(name)
+    try:
+        yield
+    finally:
+        _current_route.reset(token)
+
+
+def current_route() -> str:
+    return _current_route.get()
+
+
+def route_class(route: Optional[str] = None) -> str:
+    return ROUTE_CLASSES.get(route or current_route(), INTERACTIVE)
+
+
+class PriorityScheduler:
+    """
+    capacity plasser delt mellom klassene. reserved_interactive plasser holdes alltid
+    unna bulk, så et nytt chat-kall ikke må vente på at en lang bulk-jobb blir ferdig.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        capacity: int,
+        min_bulk_share: float = 0.1,
+        reserved_interactive: int = 0,
+        window: int = 100
+    ):
+        self.name = name
+        self.capacity = max(capacity, 1)
+        self.min_bulk_share = min_bulk_share
+        self.reserved_interactive = reserved_interactive
+        self.queues = {INTERACTIVE: collections.deque(), BULK: collections.deque()}
+        self.running = {INTERACTIVE: 0, BULK: 0}
+        # Klassene til de siste tildelingene - grunnlaget for minsteandelen til bulk
+        self.recent: collections.deque = collections.deque(maxlen=window)
+        # Metrikker
+        self.dispatched = {INTERACTIVE: 0, BULK: 0}
+        self.max_queue_depth = {INTERACTIVE: 0, BULK: 0}
+        self.waits = {INTERACTIVE: collections.deque(maxlen=1000), BULK: collections.deque(maxlen=1000)}
+
+    @staticmethod
+    def current_class() -> str:
+        return route_class()
+
+    @staticmethod
+    def batch_class(classes) -> str:
+        """En samlet batch med minst ett interaktivt kall kjører som interaktiv"""
+        return INTERACTIVE if INTERACTIVE in classes else BULK
+
+    @property
+    def in_flight(self) -> int:
+        return self.running[INTERACTIVE] + self.running[BULK]
+
+    def set_capacity(self, capacity: int):
+        self.capacity = max(capacity, 1)
+        self._dispatch()
+
+    def _bulk_allowed(self) -> bool:
+        return self.running[BULK] < max(self.capacity - self.reserved_interactive, 1)
+
+    def _pick(self) -> Optional[str]:
+        interactive_waiting = bool(self.queues[INTERACTIVE])
+        bulk_ready = bool(self.queues[BULK]) and self._bulk_allowed()
+        if interactive_waiting and bulk_ready:
+            bulk_share = self.recent.count(BULK) / len(self.recent) if self.recent else 0.0
+            return BULK if bulk_share < self.min_bulk_share else INTERACTIVE
+        if interactive_waiting:
+            return INTERACTIVE
+        return BULK if bulk_ready else None
+
+    def _dispatch(self):
+        while self.in_flight < self.capacity:
+            cls = self._pick()
+            if cls is None:
+                return
+            enqueued_at, waiter = self.queues[cls].popleft()
+            if waiter.done():
+                continue
+            self.running[cls] += 1
+            self.recent.append(cls)
+            self.dispatched[cls] += 1
+            self.waits[cls].append(time.monotonic() - enqueued_at)
+            waiter.set_result(None)
+
+    async def acquire(self, cls: Optional[str] = None) -> str:
+        """Venter på en plass; returnerer klassen som må gis tilbake til release()"""
+        cls = cls or route_class()
+        entry = (time.monotonic(), asyncio.get_running_loop().create_future())
+        queue = self.queues[cls]
+        queue.append(entry)
+        self.max_queue_depth[cls] = max(self.max_queue_depth[cls], len(queue))
+        self._dispatch()
+        try:
+            await entry[1]
+        except asyncio.CancelledError:
+            if entry in queue:
+                queue.remove(entry)
+            elif entry[1].done() and not entry[1].cancelled():
+                # Plassen ble tildelt, men vi rakk ikke å bruke den
+                self.release(cls)
+            raise
+        return cls
+
+    def release(self, cls: str):
+        self.running[cls] -= 1
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, cls: Optional[str] = None) -> AsyncIterator[None]:
+        cls = await self.acquire(cls)
+        try:
+            yield
+        finally:
+            self.release(cls)
+
+    async def run_in_thread(self, fn: Callable[..., Any], *args, cls: Optional[str] = None) -> Any:
+        """CPU-tungt arbeid i en tråd, men først når klassen får en plass"""
+        async with self.slot(cls):
+            return await asyncio.to_thread(fn, *args)
+
+    @staticmethod
+    def _quantile_ms(samples, percentile: float) -> Optional[float]:
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        return round(ordered[min(int(len(ordered) * percentile / 100.0), len(ordered) - 1)] * 1000, 2)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "capacity": self.capacity,
+            "in_flight": self.in_flight,
+            "bulk_share_recent": round(self.recent.count(BULK) / len(self.recent), 3) if self.recent else 0.0,
+            "classes": {
+                cls: {
+                    "queued": len(self.queues[cls]),
+                    "running": self.running[cls],
+                    "dispatched": self.dispatched[cls],
+                    "max_queue_depth": self.max_queue_depth[cls],
+                    "wait_p50_ms": self._quantile_ms(self.waits[cls], 50.0),
+                    "wait_p99_ms": self._quantile_ms(self.waits[cls], 99.0)
+                }
+                for cls in (INTERACTIVE, BULK)
+            }
+        }
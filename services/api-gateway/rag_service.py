@@ -4,12 +4,16 @@ Håndterer PDF prosessering, embeddings og vector søk
 """
 
 import os
+import json
+import asyncio
 import logging
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, AsyncIterator, Callable, Tuple
 from pathlib import Path
 import uuid
 import re
 import tempfile
+import time
+from datetime import datetime
 
 # CRITICAL: Apply NumPy compatibility patches FIRST
 import numpy_compat  # This MUST be first
@@ -22,8 +26,52 @@ import chromadb
 # from chromadb.config import Settings # Ikke lenger nødvendig
 import tiktoken
 
+from identifier_index import IdentifierIndex, extract_identifiers
+from mmr import maximal_marginal_relevance
+from context_packer import pack_context
+from sharded_collection import ShardedCollection, doc_id_from_chunk_id
+from embedding_providers import create_embedding_provider
+from memory_manager import MemoryManager, budget_from_env
+from chunk_store import chunk_store_from_env
+from deadline import TRUNCATION_MARKER, Deadline
+from single_flight import SingleFlight
+from openai_limiter import openai_limiter_from_env
+from priority_scheduler import PriorityScheduler, work_route
+from model_router import EXTRACTIVE, model_router_from_env
+from prefetch_cache import PrefetchCache, pack_candidates
+from working_set import HIT, SessionWorkingSets
+
 logger = logging.getLogger(__name__)
 
+# Sidemarkør som extract_text_from_pdf legger inn foran hver side
+PAGE_MARKER = re.compile(r"--- Side (\d+) ---")
+
+# HNSW-parametre anbefalt av scripts/tune_ann_index.py
+ANN_CONFIG_PATH = Path(os.getenv("RAG_ANN_CONFIG_PATH") or Path(__file__).parent / "ann_index_config.json")
+
+def _hnsw_metadata() -> Dict[str, Any]:
+    """Collection-metadata for chunk-indeksen, med tunede HNSW-parametre hvis de finnes"""
+    metadata = {"hnsw:space": "cosine"}
+    if not ANN_CONFIG_PATH.exists():
+        return metadata
+    try:
+        tuned = json.loads(ANN_CONFIG_PATH.read_text())
+        metadata.update({
+            "hnsw:M": int(tuned["M"]),
+            "hnsw:construction_ef": int(tuned["ef_construction"]),
+            "hnsw:search_ef": int(tuned["ef"])
+        })
+        logger.info(f"✅ Tunede HNSW-parametre lastet fra {ANN_CONFIG_PATH}: {metadata}")
+    except Exception as e:
+        logger.warning(f"⚠️ Kunne ikke lese {ANN_CONFIG_PATH}, bruker standard HNSW: {e}")
+    return metadata
+
+def _to_timestamp(value: Any) -> int:
+    """Gjør om datetime eller tall til unix-tid slik ChromaDB kan sammenligne det"""
+    if isinstance(value, datetime):
+        return int(value.timestamp())
+    return int(value)
+
 class GPSRAGService:
     def __init__(self):
         """
@@ -35,17 +83,113 @@ class GPSRAGService:
             logger.error("❌ OPENAI_API_KEY mangler.")
         
         self.tokenizer = tiktoken.get_encoding("cl100k_base")
+        # Delt RPM/TPM-kvote mot OpenAI for chat, query-embeddings og opplasting
+        self.openai_limiter = openai_limiter_from_env()
+        # CPU-tungt arbeid (PDF-tekst, chunking, ONNX-batcher): chat først, opplasting får en minsteandel
+        self.cpu_scheduler = PriorityScheduler(
+            "cpu",
+            capacity=int(os.getenv("RAG_CPU_WORKERS", "2")),
+            min_bulk_share=float(os.getenv("RAG_MIN_BULK_SHARE", "0.1")),
+            reserved_interactive=1
+        )
+        # Opplastinger embeddes i batcher, så query-embeddings kan gå foran mellom dem
+        self.ingest_batch_size = int(os.getenv("RAG_INGEST_EMBED_BATCH", "64"))
+        # OpenAI over nett eller lokal ONNX MiniLM (RAG_EMBEDDING_PROVIDER)
+        self.embedding_provider = create_embedding_provider(
+            openai_api_key=self.openai_api_key, limiter=self.openai_limiter, scheduler=self.cpu_scheduler
+        )
         
         # Enkel in-memory client
         self.client = chromadb.Client()
-        self.collection = self.client.get_or_create_collection(
-            name="gpsrag_shared_in_memory",
-            metadata={"hnsw:space": "cosine"}
+        self.hnsw_metadata = _hnsw_metadata()
+        # Minneregnskap per dokument; minst nylig hentede dokumenter offloades til disk over budsjettet
+        self.memory = MemoryManager(
+            os.getenv("RAG_OFFLOAD_DIR", "/tmp/gpsrag_segments"),
+            budget_bytes=budget_from_env(),
+            hnsw_m=self.hnsw_metadata.get("hnsw:M", 16)
+        )
+        # Live indeksversjon: chunks, dokument-centroider og embedding-provider byttes alltid samlet
+        self.index_version = 1
+        self.collection, self.document_collection = self.create_index_collections(self.index_version)
+        self.reindex_job = None
+        # "flat" søker alle chunks, "hierarchical" velger dokumenter først, "auto" bytter ved en viss størrelse
+        self.retrieval_mode = os.getenv("RAG_RETRIEVAL_MODE", "auto").lower()
+        self.hierarchical_top_docs = int(os.getenv("RAG_HIERARCHICAL_TOP_DOCS", "5"))
+        self.hierarchical_min_chunks = int(os.getenv("RAG_HIERARCHICAL_MIN_CHUNKS", "20000"))
+        # Eksakt oppslag på UBX-meldinger, NMEA-setninger, konfignøkler og modulnavn
+        self.identifier_index = IdentifierIndex()
+        self.identifier_fast_path = os.getenv("RAG_IDENTIFIER_FAST_PATH", "true").lower() == "true"
+        self.identifier_min_hits = int(os.getenv("RAG_IDENTIFIER_MIN_HITS", "1"))
+        # Hurtigsporet brukes bare når alle treffene får plass (og høyst så mange); ellers rangeres de på innhold
+        self.identifier_max_hits = int(os.getenv("RAG_IDENTIFIER_MAX_HITS", "5"))
+        self.identifier_boost = float(os.getenv("RAG_IDENTIFIER_BOOST", "0.15"))
+        # MMR: hent flere kandidater og velg ut et variert sett (overlappende chunks gir lite ny kontekst)
+        self.mmr_enabled = os.getenv("RAG_MMR_ENABLED", "true").lower() == "true"
+        self.mmr_lambda = float(os.getenv("RAG_MMR_LAMBDA", "0.7"))
+        self.mmr_fetch_multiplier = int(os.getenv("RAG_MMR_FETCH_MULTIPLIER", "4"))
+        # Kontekst til LLM bygges innenfor et fast token-budsjett
+        self.context_token_budget = int(os.getenv("RAG_CONTEXT_TOKEN_BUDGET", "1500"))
+        self.context_top_k = int(os.getenv("RAG_CONTEXT_TOP_K", "5"))
+        # Modellnivå per spørsmål: ekstraktivt svar, rask modell eller stor modell
+        self.model_router = model_router_from_env()
+        # Identiske samtidige spørsmål deler én beregning (embedding, søk og LLM)
+        self.single_flight = SingleFlight()
+        # Embedding og kandidater hentet mens brukeren skriver (/api/chat/prefetch)
+        self.prefetch_cache = PrefetchCache(
+            ttl=float(os.getenv("RAG_PREFETCH_TTL_SECONDS", "30")),
+            max_bytes=int(float(os.getenv("RAG_PREFETCH_MAX_MB", "32")) * 1024 * 1024),
+            min_similarity=float(os.getenv("RAG_PREFETCH_MIN_SIMILARITY", "0.8")),
+            min_cosine=float(os.getenv("RAG_PREFETCH_MIN_COSINE", "0.9")),
+            debounce=int(os.getenv("RAG_PREFETCH_DEBOUNCE_MS", "250")) / 1000.0
         )
+        # Forrige turs kandidater per sesjon; oppfølgingsspørsmål rangeres mot dem først
+        self.working_sets = SessionWorkingSets(
+            ttl=float(os.getenv("RAG_WORKING_SET_TTL_SECONDS", "1800")),
+            min_coverage=float(os.getenv("RAG_WORKING_SET_MIN_COVERAGE", "0.9")),
+            max_bytes=int(float(os.getenv("RAG_WORKING_SET_MAX_MB", "64")) * 1024 * 1024)
+        )
+        self.memory.register_cache("working_sets", self.working_sets)
         self.initialized = True
-        logger.info(f"✅ In-memory RAG Service initialisert med collection: {self.collection.name}")
+        logger.info(
+            f"✅ In-memory RAG Service initialisert med collection: {self.collection.name} "
+            f"({len(self.collection.shards)} shards, embeddings: {self.embedding_provider.name})"
+        )
         # self.in_memory_docs er ikke lenger nødvendig, Chroma håndterer det.
 
+    def create_index_collections(self, version: int):
+        """Oppretter chunk- og dokument-collections for en indeksversjon"""
+        name = "gpsrag_shared_in_memory" if version == 1 else f"gpsrag_shared_in_memory_v{version}"
+        # Chunks fordeles på RAG_SHARD_COUNT collections; søk går til alle shards parallelt.
+        # Tekstene ligger zstd-komprimert i en ChunkStore (RAG_CHUNK_COMPRESSION)
+        collection = ShardedCollection(
+            self.client,
+            name=name,
+            num_shards=int(os.getenv("RAG_SHARD_COUNT", "1")),
+            metadata=self.hnsw_metadata,
+            chunk_store=chunk_store_from_env()
+        )
+        # Én centroid-vektor per dokument for to-trinns søk (dokument → chunk)
+        document_collection = self.client.get_or_create_collection(
+            name=f"{name}_documents",
+            metadata={"hnsw:space": "cosine"}
+        )
+        return collection, document_collection
+
+    def activate_index(self, version: int, collection, document_collection, embedding_provider):
+        """
+        Bytter live indeks (alias-flip). Ingen await her, så ingen spørring ser en
+        blanding av ny collection og gammel embedding-provider.
+        """
+        previous = (self.collection, self.document_collection, self.embedding_provider)
+        self.collection = collection
+        self.document_collection = document_collection
+        self.embedding_provider = embedding_provider
+        self.index_version = version
+        self.prefetch_cache.clear()
+        self.working_sets.clear()
+        logger.info(f"🔁 Indeksversjon {version} er nå live ({embedding_provider.name})")
+        return previous
+
     def extract_text_from_pdf(self, pdf_path: str) -> str:
         """Ekstraherer tekst fra PDF"""
         try:
@@ -105,54 +249,55 @@ class GPSRAGService:
                 "tokens": len(self.tokenizer.encode(current_chunk))
             })
         
+        self._assign_pages(chunks)
         logger.info(f"✅ Opprettet {len(chunks)} tekst-chunks")
         return chunks
 
+    def _assign_pages(self, chunks: List[Dict[str, Any]]):
+        """Setter page_start/page_end på hver chunk ut fra "--- Side N ---" markørene"""
+        current_page = 1
+        for chunk in chunks:
+            markers = list(PAGE_MARKER.finditer(chunk["text"]))
+            if markers:
+                pages = [int(m.group(1)) for m in markers]
+                # Tekst før første markør hører til siden chunken startet på
+                starts_on_marker = not chunk["text"][:markers[0].start()].strip()
+                chunk["page_start"] = min(pages) if starts_on_marker else min(current_page, min(pages))
+                chunk["page_end"] = max(pages + [current_page])
+            else:
+                chunk["page_start"] = chunk["page_end"] = current_page
+            current_page = chunk["page_end"]
+
     async def create_embeddings(self, texts: List[str]) -> List[List[float]]:
-        """Lager embeddings ved å kalle OpenAI API direkte med httpx for å unngå bibliotek-konflikter."""
+        """Lager embeddings med den konfigurerte provideren (OpenAI eller lokal ONNX)"""
         try:
             import httpx
-            
-            headers = {
-                "Authorization": f"Bearer {self.openai_api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            json_data = {
-                "input": texts,
-                "model": "text-embedding-ada-002"
-            }
-            
-            logger.info(f"🔄 Kaller OpenAI Embeddings API direkte for {len(texts)} tekstblokker...")
-            
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    "https://api.openai.com/v1/embeddings",
-                    headers=headers,
-                    json=json_data,
-                    timeout=30.0
-                )
-            
-            response.raise_for_status() # Sjekker for HTTP-feil (4xx, 5xx)
-            
-            response_data = response.json()
-            embeddings = [item['embedding'] for item in response_data['data']]
-            
-            logger.info(f"✅ Lagde {len(embeddings)} embeddings via direkte API-kall")
-            return embeddings
+            return await self.embedding_provider.embed(texts)
             
         except httpx.HTTPStatusError as e:
             logger.error(f"❌ HTTP-feil ved direkte kall til OpenAI: {e.response.status_code} - {e.response.text}")
             raise Exception(f"OpenAI API-feil: {e.response.text}")
         except Exception as e:
-            logger.error(f"❌ Embedding feil (direkte kall): {e}", exc_info=True)
+            logger.error(f"❌ Embedding feil ({self.embedding_provider.name}): {e}", exc_info=True)
             raise Exception(f"Kunne ikke lage embeddings: {str(e)}")
 
+    async def _embed_in_batches(self, texts: List[str]) -> List[List[float]]:
+        """Embedder i batcher - hver batch er en egen jobb som chat kan gå foran"""
+        embeddings = []
+        for start in range(0, len(texts), self.ingest_batch_size):
+            embeddings.extend(await self.create_embeddings(texts[start:start + self.ingest_batch_size]))
+        return embeddings
+
     async def process_document(self, file_path: str, filename: str) -> Dict[str, Any]:
         """Prosesserer dokument komplett - PDF → chunks → embeddings → lagring"""
+        # Alt arbeidet (OpenAI-kvote og CPU) kjører som bulk, bak interaktive spørsmål
+        with work_route("ingest"):
+            return await self._process_document(file_path, filename)
+
+    async def _process_document(self, file_path: str, filename: str) -> Dict[str, Any]:
         try:
-            # 1. Ekstraher tekst fra PDF
-            text = self.extract_text_from_pdf(file_path)
+            # 1. Ekstraher tekst fra PDF (i en tråd, så event-loopen kan svare på chat imens)
+            text = await self.cpu_scheduler.run_in_thread(self.extract_text_from_pdf, file_path)
             
             if not text.strip():
                 logger.warning(f"⚠️ Ingen tekst funnet i PDF: {filename}")
@@ -163,7 +308,7 @@ class GPSRAGService:
                 }
             
             # 2. Del opp i chunks
-            chunks = self.chunk_text(text)
+            chunks = await self.cpu_scheduler.run_in_thread(self.chunk_text, text)
             
             if not chunks:
                 logger.warning(f"⚠️ Kunne ikke lage chunks fra: {filename}")
@@ -176,7 +321,12 @@ class GPSRAGService:
             # 3. Lag embeddings
             chunk_texts = [chunk["text"] for chunk in chunks]
             try:
-                embeddings = await self.create_embeddings(chunk_texts)
+                version = self.index_version
+                embeddings = await self._embed_in_batches(chunk_texts)
+                # Indeksen ble byttet mens vi embeddet - vektorene må komme fra den nye modellen
+                while version != self.index_version:
+                    version = self.index_version
+                    embeddings = await self._embed_in_batches(chunk_texts)
             except Exception as e:
                 logger.error(f"❌ Embedding feilet: {e}", exc_info=True)
                 # Forenklet feilhåndtering - kast unntaket videre
@@ -214,13 +364,17 @@ class GPSRAGService:
         chunk_ids = []
         metadatas = []
         documents = []
+        uploaded_at = int(time.time())
         
         for i, chunk in enumerate(chunks):
             chunk_ids.append(f"{doc_id}_chunk_{i}")
             metadatas.append({
                 "filename": filename,
                 "doc_id": doc_id,
-                "chunk_index": i
+                "chunk_index": i,
+                "page_start": chunk.get("page_start", 1),
+                "page_end": chunk.get("page_end", 1),
+                "uploaded_at": uploaded_at
             })
             documents.append(chunk["text"])
         
@@ -230,52 +384,632 @@ class GPSRAGService:
             metadatas=metadatas,
             documents=documents
         )
+        
+        self._store_document_centroid(doc_id, filename, embeddings, uploaded_at)
+        # Prefetchede kandidater og working sets kjenner ikke det nye dokumentet
+        self.prefetch_cache.clear()
+        self.working_sets.clear()
+        
+        # Nye dokumenter kan presse andre ut til disk - aldri det som nettopp ble lastet opp
+        self.memory.register(
+            doc_id, filename, uploaded_at,
+            self.memory.estimate_bytes(
+                embeddings, documents, metadatas,
+                text_bytes=self.collection.stored_text_bytes(chunk_ids, documents)
+            ),
+            len(chunk_ids)
+        )
+        self.memory.enforce(self.collection, protected={doc_id})
+        
+        # Indekser identifikatorer først når chunkene faktisk er lagret
+        identifier_count = 0
+        for chunk_id, text in zip(chunk_ids, documents):
+            identifier_count += len(self.identifier_index.add(chunk_id, text))
+        logger.info(f"✅ Indekserte {identifier_count} identifikator-forekomster for {filename}")
 
-    async def search_documents(self, query: str, top_k: int = 5) -> List[Dict[str, Any]]:
-        """Søker i dokumenter kun med den delte ChromaDB-instansen"""
+    def delete_document(self, doc_id: str) -> bool:
+        """Sletter et dokument fra live-indeksen (chunks, centroid, minneregnskap og identifikatorer)"""
+        document = self.document_collection.get(ids=[doc_id], include=["metadatas"])
+        if not document["ids"]:
+            return False
+        chunk_count = int(document["metadatas"][0].get("chunk_count", 0))
+        self.collection.delete(where={"doc_id": doc_id})
+        self.document_collection.delete(ids=[doc_id])
+        self.memory.forget(doc_id)
+        self.identifier_index.remove({f"{doc_id}_chunk_{i}" for i in range(chunk_count)})
+        self.prefetch_cache.clear()
+        self.working_sets.clear()
+        logger.info(f"🗑️ Slettet dokument {doc_id} ({chunk_count} chunks)")
+        return True
+
+    def _store_document_centroid(self, doc_id: str, filename: str, embeddings: List[List[float]], uploaded_at: int, document_collection=None):
+        """Lagrer normalisert gjennomsnitt av chunk-vektorene som dokumentets vektor"""
+        centroid = np.mean(np.asarray(embeddings, dtype=np.float32), axis=0)
+        norm = np.linalg.norm(centroid)
+        if norm > 0:
+            centroid = centroid / norm
+        
+        (document_collection or self.document_collection).add(
+            ids=[doc_id],
+            embeddings=[centroid.tolist()],
+            metadatas=[{
+                "filename": filename,
+                "doc_id": doc_id,
+                "chunk_count": len(embeddings),
+                "uploaded_at": uploaded_at
+            }],
+            documents=[filename]
+        )
+
+    def _use_hierarchical(self, retrieval_mode: Optional[str], filters: Optional[Dict[str, Any]]) -> bool:
+        """Avgjør om søket skal gå via dokument-centroidene først"""
+        mode = (retrieval_mode or self.retrieval_mode).lower()
+        if filters and filters.get("document_id"):
+            return False  # Allerede begrenset til ett dokument
+        if mode == "hierarchical":
+            return True
+        if mode == "auto":
+            return self.collection.count() >= self.hierarchical_min_chunks
+        return False
+
+    def _select_documents(self, query_embedding: List[float], filters: Optional[Dict[str, Any]]) -> List[str]:
+        """Trinn 1: finner de mest relevante dokumentene via centroid-vektorene"""
+        # Sidefiltre gjelder chunks, ikke dokumenter
+        document_filters = {k: v for k, v in (filters or {}).items() if k not in ("page_from", "page_to")}
+        results = self.document_collection.query(
+            query_embeddings=[query_embedding],
+            n_results=self.hierarchical_top_docs,
+            where=self._build_where(document_filters),
+            include=["metadatas"]
+        )
+        return results["ids"][0] if results["ids"] else []
+
+    def _reload_offloaded(
+        self,
+        filters: Optional[Dict[str, Any]] = None,
+        exact_hits: Optional[Dict[str, set]] = None,
+        query_embeddings: Optional[List[List[float]]] = None
+    ) -> set:
+        """
+        Laster inn offloadede dokumenter som søket kan treffe: de filteret peker på,
+        de med eksakte identifikator-treff, og de med nærmeste centroid til spørringen.
+        """
+        offloaded = self.memory.offloaded_ids()
+        if not offloaded:
+            return set()
+        
+        touched = self.memory.matching_offloaded(filters, _to_timestamp)
+        touched |= {doc_id_from_chunk_id(chunk_id) for chunk_id in (exact_hits or {})} & offloaded
+        if query_embeddings:
+            document_filters = {k: v for k, v in (filters or {}).items() if k not in ("page_from", "page_to")}
+            results = self.document_collection.query(
+                query_embeddings=query_embeddings,
+                n_results=self.hierarchical_top_docs,
+                where=self._build_where(document_filters),
+                include=[]
+            )
+            touched |= {doc_id for row in results["ids"] for doc_id in row} & offloaded
+        
+        return set(self.memory.reload(touched, self.collection))
+
+    def _record_retrieval(self, results: List[Dict[str, Any]], reloaded: set):
+        """Oppdaterer LRU-tid for dokumentene som ble brukt og holder minnet innenfor budsjett"""
+        retrieved = {r["metadata"]["doc_id"] for r in results}
+        self.memory.touch(retrieved)
+        self.memory.enforce(self.collection, protected=retrieved | reloaded)
+
+    def _hydrate(self, results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Henter (og pakker ut) teksten kun for de endelige treffene"""
+        missing = [r for r in results if r["text"] is None]
+        if missing:
+            texts = self.collection.texts([f"{r['metadata']['doc_id']}_chunk_{r['chunk_index']}" for r in missing])
+            for result, text in zip(missing, texts):
+                result["text"] = text or ""
+        return results
+
+    def _format_result(
+        self,
+        text: Optional[str],
+        metadata: Dict[str, Any],
+        relevance_score: float,
+        cosine: Optional[float] = None
+    ) -> Dict[str, Any]:
+        """
+        Formaterer et søketreff på samme form uansett hvor det kommer fra (text=None fylles av _hydrate).
+        cosine er den rå likheten fra vektorsøket; None for treff som bare kom fra eksakt-indeksen.
+        """
+        return {
+            "text": text,
+            "metadata": metadata,
+            "relevance_score": relevance_score,
+            "cosine": cosine,
+            "filename": metadata["filename"],
+            "chunk_index": metadata["chunk_index"]
+        }
+
+    def _build_where(self, filters: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """
+        Oversetter søkefiltre til en ChromaDB where-klausul.
+
+        Støtter document_id, filename, page_from/page_to (chunks som overlapper sideintervallet)
+        og uploaded_after/uploaded_before (datetime eller unix-tid).
+        """
+        if not filters:
+            return None
+        
+        conditions = []
+        if filters.get("document_id"):
+            conditions.append({"doc_id": {"$eq": filters["document_id"]}})
+        if filters.get("filename"):
+            conditions.append({"filename": {"$eq": filters["filename"]}})
+        if filters.get("page_from") is not None:
+            conditions.append({"page_end": {"$gte": int(filters["page_from"])}})
+        if filters.get("page_to") is not None:
+            conditions.append({"page_start": {"$lte": int(filters["page_to"])}})
+        if filters.get("uploaded_after") is not None:
+            conditions.append({"uploaded_at": {"$gte": _to_timestamp(filters["uploaded_after"])}})
+        if filters.get("uploaded_before") is not None:
+            conditions.append({"uploaded_at": {"$lte": _to_timestamp(filters["uploaded_before"])}})
+        
+        return self._combine_where(*conditions)
+
+    def _combine_where(self, *conditions: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Slår sammen where-betingelser; ChromaDB krever $and når det er mer enn én"""
+        conditions = [c for c in conditions if c]
+        if not conditions:
+            return None
+        return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+    def _fetch_identifier_hits(self, exact_hits: Dict[str, set], query_identifier_count: int, where: Optional[Dict[str, Any]] = None) -> Dict[str, Dict[str, Any]]:
+        """Henter chunks fra eksakt-indeksen direkte fra ChromaDB, uten embedding"""
+        if not exact_hits:
+            return {}
+        
+        results = self.collection.get(
+            ids=list(exact_hits.keys()),
+            where=where,
+            include=["metadatas"]
+        )
+        
+        fetched = {}
+        for chunk_id, metadata in zip(results["ids"], results["metadatas"]):
+            # Andel av identifikatorene i spørringen som chunken inneholder
+            score = len(exact_hits[chunk_id]) / max(query_identifier_count, 1)
+            fetched[chunk_id] = self._format_result(None, metadata, score)
+        return fetched
+
+    def _identifier_fast_path_applies(self, identifier_results: Dict[str, Dict[str, Any]], top_k: int) -> bool:
+        """
+        Eksakte treff kan returneres uten embedding bare når de er entydige: få nok til at
+        alle får plass, og hver av dem inneholder alle identifikatorene i spørringen. Et bredt
+        modulnavn (ZED-F9P) treffer hele manualen og må rangeres på resten av spørsmålet.
+        """
+        return (
+            self.identifier_fast_path
+            and self.identifier_min_hits <= len(identifier_results) <= min(top_k, self.identifier_max_hits)
+            and all(result["relevance_score"] >= 1.0 for result in identifier_results.values())
+        )
+
+    def _identifier_cosines(self, chunk_ids: List[str], query_embedding: List[float]) -> Dict[str, float]:
+        """Cosinus mellom spørringen og de lagrede vektorene til chunks som bare traff eksakt"""
+        if not chunk_ids:
+            return {}
+        stored = self.collection.get(ids=chunk_ids, include=["embeddings"])
+        if not stored["ids"]:
+            return {}
+        vectors = np.asarray(stored["embeddings"], dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+        return dict(zip(stored["ids"], (vectors @ query).tolist()))
+
+    async def search_documents(
+        self,
+        query: str,
+        top_k: int = 5,
+        mmr_lambda: Optional[float] = None,
+        filters: Optional[Dict[str, Any]] = None,
+        retrieval_mode: Optional[str] = None,
+        deadline: Optional[Deadline] = None,
+        session_id: Optional[str] = None,
+        retrieval_info: Optional[Dict[str, Any]] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Søker i dokumenter kun med den delte ChromaDB-instansen.
+
+        Med en deadline får embedding-kallet sitt trinnbudsjett, og MMR hoppes over
+        når det ikke er nok tid igjen. Degraderingene registreres på deadline.
+        Med session_id rangeres spørsmålet først mot sesjonens working set; om det
+        traff, står i retrieval_info["working_set"].
+        """
         try:
-            # Lag embedding for query
-            query_embeddings = await self.create_embeddings([query])
-            query_embedding = query_embeddings[0]
-            
-            if self.collection is not None:
-                # Søk i ChromaDB
-                results = self.collection.query(
-                    query_embeddings=[query_embedding],
-                    n_results=top_k,
-                    include=["documents", "metadatas", "distances"]
-                )
-                
-                # Format resultater
-                search_results = []
-                if results["documents"] and len(results["documents"][0]) > 0:
-                    for i in range(len(results["documents"][0])):
-                        result = {
-                            "text": results["documents"][0][i],
-                            "metadata": results["metadatas"][0][i],
-                            "relevance_score": 1 - results["distances"][0][i],  # Convert distance to similarity
-                            "filename": results["metadatas"][0][i]["filename"],
-                            "chunk_index": results["metadatas"][0][i]["chunk_index"]
-                        }
-                        search_results.append(result)
-                
-                logger.info(f"✅ ChromaDB: Fant {len(search_results)} relevante chunks")
+            if self.collection is None:
+                logger.warning("⚠️ Ingen ChromaDB collection tilgjengelig for søk.")
+                return []
+            
+            # Filtre skyves ned i ChromaDB slik at ANN-søket kun går over relevante chunks
+            where = self._build_where(filters)
+            
+            # 1. Eksakt oppslag på identifikatorer (UBX-CFG-VALSET, ZED-F9P, ...)
+            exact_hits = self.identifier_index.lookup(query)
+            # Offloadede dokumenter som filteret eller identifikatorene peker på må inn før oppslaget
+            reloaded = self._reload_offloaded(filters, exact_hits)
+            identifier_results = self._fetch_identifier_hits(exact_hits, len(extract_identifiers(query)), where)
+            
+            if self._identifier_fast_path_applies(identifier_results, top_k):
+                search_results = sorted(
+                    identifier_results.values(),
+                    key=lambda r: (-r["relevance_score"], r["metadata"]["doc_id"], r["chunk_index"])
+                )[:top_k]
+                logger.info(f"⚡ Identifikator-treff: {len(search_results)} chunks uten embedding-kall")
+                self._hydrate(search_results)
+                self._record_retrieval(search_results, reloaded)
                 return search_results
             
+            # 2. Prefetch av samme spørsmål, eller av en begynnelse av det
+            use_mmr = self.mmr_enabled
+            n_candidates = top_k * self.mmr_fetch_multiplier if use_mmr else top_k
+            prefetched = None
+            if retrieval_mode is None and n_candidates <= self.context_top_k * self.mmr_fetch_multiplier:
+                prefetched = await self.prefetch_cache.lookup(
+                    query, filters, wait_timeout=deadline.stage_timeout("embed") if deadline is not None else None
+                )
+            if prefetched is not None and prefetched["exact"]:
+                # Samme spørsmål - embeddingen kan brukes som den er
+                query_embeddings = [prefetched["embedding"].tolist()]
             else:
-                logger.warning("⚠️ Ingen ChromaDB collection tilgjengelig for søk.")
-                return []
+                # 2b. Lag embedding for query
+                try:
+                    query_embeddings = await self._within(deadline, self.create_embeddings([query]), "embed")
+                except asyncio.TimeoutError:
+                    if deadline is None:
+                        raise
+                    # Uten embedding gjenstår bare de eksakte identifikator-treffene
+                    deadline.degrade("dense_search_skipped")
+                    logger.warning(f"⏱️ Embedding nådde ikke fristen, bruker {len(identifier_results)} identifikator-treff")
+                    search_results = sorted(identifier_results.values(), key=lambda r: -r["relevance_score"])[:top_k]
+                    self._hydrate(search_results)
+                    self._record_retrieval(search_results, reloaded)
+                    return search_results
+            
+            # Prefetchede kandidater godtas bare nær nok det endelige spørsmålet, og rangeres mot det
+            prefetched_results = None
+            if prefetched is not None:
+                prefetched_results = self.prefetch_cache.accept(prefetched, query_embeddings[0])
+                if prefetched_results is not None:
+                    reloaded |= self._reload_offloaded(filters, query_embeddings=query_embeddings)
+            
+            # 2c. Oppfølgingsspørsmål: forrige turs kandidater holder hvis de dekker spørsmålet godt nok
+            working_set_results = None
+            if session_id is not None and retrieval_mode is None:
+                working_set_results, turn = self.working_sets.match(session_id, query_embeddings[0], top_k, filters)
+                if retrieval_info is not None:
+                    retrieval_info["working_set"] = turn
+                if working_set_results is not None:
+                    results = working_set_results
+                    doc_ids = {metadata["doc_id"] for metadata in results["metadatas"][0]}
+                    reloaded |= set(self.memory.reload(doc_ids & self.memory.offloaded_ids(), self.collection))
+                    logger.info(f"🧠 Working set-treff for sesjonen (dekning {turn['coverage']:.2f}), hopper over søket")
+            
+            # 3. Søk i ChromaDB (med over-henting når MMR er aktivert og tiden strekker til)
+            if use_mmr and deadline is not None and not deadline.allows("rerank"):
+                use_mmr = False
+                deadline.degrade("rerank_skipped")
+            if working_set_results is None:
+                if prefetched_results is not None:
+                    results = prefetched_results
+                else:
+                    results, dense_reloaded = self._dense_query(
+                        query_embeddings, where, filters, retrieval_mode, n_candidates if use_mmr else top_k
+                    )
+                    reloaded |= dense_reloaded
+                if session_id is not None and retrieval_mode is None:
+                    self.working_sets.remember(session_id, filters, results, top_k)
+                    self.memory.relieve_caches()
+            
+            # 4-5. Format, boost eksakte treff og diversifiser med MMR
+            search_results = self._hydrate(self._rank_candidates(
+                results, 0, identifier_results, top_k, mmr_lambda, use_mmr, query_embedding=query_embeddings[0]
+            ))
+            self._record_retrieval(search_results, reloaded)
+            
+            logger.info(f"✅ ChromaDB: Fant {len(search_results)} relevante chunks")
+            return search_results
             
         except Exception as e:
             logger.error(f"❌ Søk feilet: {e}", exc_info=True)
             return []
 
-    async def generate_rag_response(self, query: str, max_tokens: int = 500) -> Dict[str, Any]:
-        """Generer RAG respons ved å kalle OpenAI Chat API direkte med httpx."""
+    def _dense_query(
+        self,
+        query_embeddings: List[List[float]],
+        where: Optional[Dict[str, Any]],
+        filters: Optional[Dict[str, Any]],
+        retrieval_mode: Optional[str],
+        n_candidates: int
+    ) -> Tuple[Dict[str, list], set]:
+        """ANN-søket for én query-embedding: laster inn offloadede dokumenter og begrenser hierarkisk"""
+        reloaded = self._reload_offloaded(filters, query_embeddings=query_embeddings)
+        # To-trinns søk: begrens chunk-søket til de mest relevante dokumentene
+        if self._use_hierarchical(retrieval_mode, filters):
+            doc_ids = self._select_documents(query_embeddings[0], filters)
+            if doc_ids:
+                where = self._combine_where(where, {"doc_id": {"$in": doc_ids}})
+                logger.info(f"🗂️ Hierarkisk søk: begrenset til {len(doc_ids)} dokumenter")
+        results = self.collection.query(
+            query_embeddings=query_embeddings,
+            n_results=n_candidates,
+            where=where,
+            include=["metadatas", "distances", "embeddings"]
+        )
+        return results, reloaded
+
+    def prefetch(self, session_id: str, partial_query: str, filters: Optional[Dict[str, Any]] = None) -> str:
+        """
+        Varmer opp embedding og kandidater for et halvskrevet spørsmål. Returnerer med en
+        gang ("scheduled", "cached" eller "skipped"); selve arbeidet skjer i bakgrunnen.
+        """
+        # Entydige identifikator-oppslag trenger verken embedding eller ANN-søk
+        exact_hits = self.identifier_index.lookup(partial_query)
+        identifier_results = self._fetch_identifier_hits(exact_hits, len(extract_identifiers(partial_query)), self._build_where(filters))
+        if self._identifier_fast_path_applies(identifier_results, self.context_top_k):
+            return "skipped"
+        
+        async def compute() -> Dict[str, Any]:
+            query_embeddings = await self.create_embeddings([partial_query])
+            n_candidates = self.context_top_k * (self.mmr_fetch_multiplier if self.mmr_enabled else 1)
+            results, _ = self._dense_query(query_embeddings, self._build_where(filters), filters, None, n_candidates)
+            return pack_candidates(query_embeddings, results)
+        
+        return self.prefetch_cache.prefetch(session_id, partial_query, filters, compute)
+
+    def _rank_candidates(
+        self,
+        results: Dict[str, list],
+        row: int,
+        identifier_results: Dict[str, Dict[str, Any]],
+        top_k: int,
+        mmr_lambda: Optional[float] = None,
+        use_mmr: Optional[bool] = None,
+        query_embedding: Optional[List[float]] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Gjør én rad av et ChromaDB query-svar om til de endelige top_k treffene.
+        Tekstene hentes ikke her - kalleren fyller dem inn med _hydrate.
+        """
+        # Format resultater og boost chunks som også traff eksakt
+        ranked = {}
+        candidate_embeddings = []
+        if results["ids"] and len(results["ids"][row]) > 0:
+            for i in range(len(results["ids"][row])):
+                chunk_id = results["ids"][row][i]
+                cosine = 1 - results["distances"][row][i]  # Convert distance to similarity
+                relevance_score = cosine
+                if chunk_id in identifier_results:
+                    relevance_score += self.identifier_boost
+                ranked[chunk_id] = self._format_result(
+                    None,
+                    results["metadatas"][row][i],
+                    relevance_score,
+                    cosine
+                )
+                candidate_embeddings.append(results["embeddings"][row][i])
+        
+        # MMR: velg top_k varierte chunks blant kandidatene
+        use_mmr = self.mmr_enabled if use_mmr is None else use_mmr
+        if use_mmr and len(ranked) > top_k:
+            candidates = list(ranked.items())
+            selected = maximal_marginal_relevance(
+                candidate_embeddings,
+                [result["relevance_score"] for _, result in candidates],
+                top_k,
+                self.mmr_lambda if mmr_lambda is None else mmr_lambda
+            )
+            ranked = dict(candidates[i] for i in selected)
+        
+        # Eksakte treff som dense-søket ikke fant, scores mot sine lagrede vektorer og får samme boost
+        missing = [chunk_id for chunk_id in identifier_results if chunk_id not in ranked]
+        cosines = self._identifier_cosines(missing, query_embedding) if query_embedding is not None else {}
+        weakest = min((result["relevance_score"] for result in ranked.values()), default=0.0)
+        for chunk_id in missing:
+            result = identifier_results[chunk_id]
+            cosine = cosines.get(chunk_id)
+            # Uten lagret vektor: rett under det svakeste dense-treffet
+            relevance_score = cosine + self.identifier_boost if cosine is not None else weakest
+            ranked[chunk_id] = self._format_result(None, result["metadata"], relevance_score, cosine)
+        
+        return sorted(ranked.values(), key=lambda r: r["relevance_score"], reverse=True)[:top_k]
+
+    async def search_documents_batch(
+        self,
+        queries: List[str],
+        top_k: int = 5,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> List[List[Dict[str, Any]]]:
+        """
+        Søker for mange spørsmål samtidig: ett embedding-kall og én ChromaDB-spørring for hele batchen.
+
+        Bruker flatt søk (hierarkisk søk gir en egen where-klausul per spørsmål) og
+        samme filtre for alle spørsmålene. Returnerer treff i samme rekkefølge som queries.
+        """
+        where = self._build_where(filters)
+        batch_results: List[List[Dict[str, Any]]] = [[] for _ in queries]
+        identifier_results = []
+        dense_rows = []
+        reloaded = self._reload_offloaded(filters)
+        
+        # 1. Eksakte identifikator-treff trenger verken embedding eller ANN-søk
+        for index, query in enumerate(queries):
+            exact_hits = self.identifier_index.lookup(query)
+            reloaded |= self._reload_offloaded(exact_hits=exact_hits)
+            hits = self._fetch_identifier_hits(exact_hits, len(extract_identifiers(query)), where)
+            identifier_results.append(hits)
+            if self._identifier_fast_path_applies(hits, top_k):
+                batch_results[index] = sorted(
+                    hits.values(),
+                    key=lambda r: (-r["relevance_score"], r["metadata"]["doc_id"], r["chunk_index"])
+                )[:top_k]
+            else:
+                dense_rows.append(index)
+        
+        if not dense_rows or (self.collection.count() == 0 and not self.memory.offloaded_ids()):
+            self._hydrate([r for hits in batch_results for r in hits])
+            self._record_retrieval([r for hits in batch_results for r in hits], reloaded)
+            return batch_results
+        
+        # 2. Ett embedding-kall for alle gjenstående spørsmål
+        query_embeddings = await self.create_embeddings([queries[i] for i in dense_rows])
+        reloaded |= self._reload_offloaded(filters, query_embeddings=query_embeddings)
+        
+        # 3. Én multi-query mot ChromaDB
+        n_candidates = top_k * self.mmr_fetch_multiplier if self.mmr_enabled else top_k
+        results = self.collection.query(
+            query_embeddings=query_embeddings,
+            n_results=n_candidates,
+            where=where,
+            include=["metadatas", "distances", "embeddings"]
+        )
+        
+        for row, index in enumerate(dense_rows):
+            batch_results[index] = self._rank_candidates(
+                results, row, identifier_results[index], top_k, query_embedding=query_embeddings[row]
+            )
+        self._hydrate([r for hits in batch_results for r in hits])
+        self._record_retrieval([r for hits in batch_results for r in hits], reloaded)
+        
+        logger.info(f"✅ Batch-søk: {len(queries)} spørsmål, {len(dense_rows)} via ett embedding-kall")
+        return batch_results
+
+    async def _within(self, deadline: Optional[Deadline], awaitable, stage: Optional[str] = None):
+        """Venter på awaitable innenfor trinnbudsjettet når forespørselen har en frist"""
+        if deadline is None:
+            return await awaitable
+        return await deadline.run(awaitable, stage)
+
+    def export_embeddings(self) -> np.ndarray:
+        """Alle chunk-embeddings (også offloadede) som float32, én rad per chunk - grunnlaget for ANN-tuning"""
+        rows = [self.collection.get(include=["embeddings"])["embeddings"]]
+        rows += [self.memory.read_segment(doc_id)["embeddings"] for doc_id in self.memory.offloaded_ids()]
+        vectors = [vector for part in rows for vector in part]
+        dim = len(vectors[0]) if vectors else 0
+        return np.asarray(vectors, dtype=np.float32).reshape(len(vectors), dim)
+
+    def add_shards(self, count: int = 1) -> Dict[str, Any]:
+        """Legger til shards og rebalanserer dokumentene mellom dem"""
+        return self.collection.add_shards(count)
+
+    async def generate_rag_response(
+        self,
+        query: str,
+        max_tokens: int = 500,
+        filters: Optional[Dict[str, Any]] = None,
+        deadline: Optional[Deadline] = None,
+        session_id: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Generer RAG respons ved å kalle OpenAI Chat API direkte med httpx.
+
+        Med en deadline degraderes trinnene når tiden ikke strekker til: færre chunks,
+        ingen MMR, og ekstraktivt svar i stedet for LLM. Hva som ble gjort står i "deadline".
+        Samtidige identiske spørsmål (normalisert spørsmål + filtre) deler én beregning,
+        og da gjelder fristen til den første forespørselen. Med session_id gjenbrukes
+        forrige turs kandidater for oppfølgingsspørsmål ("working_set" i svaret).
+        """
+        key = self._flight_key(query, filters, max_tokens, session_id)
+        result = await self.single_flight.run(
+            key, lambda flight: self._generate_rag_response(query, max_tokens, filters, deadline, flight.publish, session_id)
+        )
+        return dict(result)
+
+    async def stream_rag_response(
+        self,
+        query: str,
+        max_tokens: int = 500,
+        filters: Optional[Dict[str, Any]] = None,
+        deadline: Optional[Deadline] = None,
+        session_id: Optional[str] = None
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Som generate_rag_response, men gir svaret token for token ({"type": "token"})
+        og til slutt hele resultatet ({"type": "done"}). En abonnent som kommer inn i en
+        pågående beregning får først tokenene som allerede er generert.
+        """
+        key = self._flight_key(query, filters, max_tokens, session_id)
+        flight = self.single_flight.acquire(
+            key, lambda flight: self._generate_rag_response(query, max_tokens, filters, deadline, flight.publish, session_id)
+        )
+        try:
+            async for token in flight.stream():
+                yield {"type": "token", "content": token}
+            result = await asyncio.shield(flight.task)
+            yield {"type": "done", **result}
+        finally:
+            self.single_flight.release(flight)
+
+    def _flight_key(self, query: str, filters: Optional[Dict[str, Any]], max_tokens: int, session_id: Optional[str]) -> str:
+        # Et oppfølgingsspørsmål avhenger av sesjonens working set og deles ikke med andre sesjoner
+        if self.working_sets.has(session_id):
+            return self.single_flight.make_key(query, filters, max_tokens=max_tokens, session_id=session_id)
+        return self.single_flight.make_key(query, filters, max_tokens=max_tokens)
+
+    async def _generate_rag_response(
+        self,
+        query: str,
+        max_tokens: int,
+        filters: Optional[Dict[str, Any]],
+        deadline: Optional[Deadline],
+        on_token: Optional[Callable[[str], None]] = None,
+        session_id: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Selve beregningen bak generate_rag_response; on_token får hvert token fra LLM"""
+        retrieval_info: Dict[str, Any] = {}
         try:
-            # 1. Søk relevante dokumenter (dette fungerer allerede)
-            search_results = await self.search_documents(query, top_k=3)
+            # 1. Søk relevante dokumenter (token-budsjettet avgjør hvor mange som brukes)
+            top_k = self.context_top_k
+            if deadline is not None and not deadline.allows("full_k"):
+                top_k = max(1, top_k // 2)
+                deadline.degrade("top_k_reduced")
+            search_results = await self.search_documents(
+                query, top_k=top_k, filters=filters, deadline=deadline, session_id=session_id, retrieval_info=retrieval_info
+            )
             
+            result = await self.answer_from_results(query, search_results, max_tokens, deadline=deadline, on_token=on_token)
+            
+        except Exception as e:
+            logger.error(f"❌ RAG respons feil (direkte kall): {e}", exc_info=True)
+            result = {
+                "response": f"Beklager, en teknisk feil oppstod: {str(e)}",
+                "sources": [],
+                "context_used": False
+            }
+        
+        if "working_set" in retrieval_info:
+            result["working_set"] = retrieval_info["working_set"]
+        if deadline is not None:
+            result["deadline"] = deadline.metadata()
+            if deadline.degradations:
+                logger.info(f"⏱️ Degradert innenfor {deadline.budget_ms:.0f}ms: {', '.join(deadline.degradations)}")
+        return result
+
+    def _extractive_answer(self, search_results: List[Dict[str, Any]]) -> str:
+        """Svar uten LLM: utdrag fra det mest relevante treffet"""
+        best = max(search_results, key=lambda r: r["relevance_score"])
+        excerpt = best["text"][:600]
+        return (
+            f"Basert på dokumentet \"{best['filename']}\" (side {best['metadata'].get('page_start', 1)}) "
+            f"fant jeg følgende relevante informasjon:\n\n{excerpt}{'...' if len(best['text']) > 600 else ''}"
+        )
+
+    async def answer_from_results(
+        self,
+        query: str,
+        search_results: List[Dict[str, Any]],
+        max_tokens: int = 500,
+        deadline: Optional[Deadline] = None,
+        on_token: Optional[Callable[[str], None]] = None
+    ) -> Dict[str, Any]:
+        """Genererer svaret fra allerede hentede søketreff"""
+        try:
             if not search_results:
                 return {
                     "response": "Beklager, jeg fant ingen relevante dokumenter for spørsmålet ditt.",
@@ -283,9 +1017,60 @@ class GPSRAGService:
                     "context_used": False
                 }
             
-            # 2. Bygg context fra søkeresultater
-            context = "\n".join([f"Fra {r['filename']}:\n{r['text']}" for r in search_results])
-            sources = [{"filename": r["filename"], "excerpt": r["text"][:150]} for r in search_results]
+            # 2. Bygg context fra søkeresultater - nabo-chunks slås sammen og overlapp fjernes
+            packed = pack_context(
+                [
+                    {
+                        "text": r["text"],
+                        "score": r["relevance_score"],
+                        "source": r["metadata"]["doc_id"],
+                        "filename": r["filename"],
+                        "position": r["chunk_index"]
+                    }
+                    for r in search_results
+                ],
+                token_budget=self.context_token_budget
+            )
+            context = packed["context"]
+            sources = [
+                {"filename": r["filename"], "excerpt": r["text"][:150], "page": r["metadata"].get("page_start")}
+                for r in search_results
+            ]
+            
+            # Velg nivå: sikre oppslag besvares ekstraktivt, vanskelige spørsmål går til den store modellen.
+            # Routeren får rå cosinus - identifikator-score og boost sier ingenting om hvor godt treffet svarer.
+            # Treff uten cosinus som inneholder alle identifikatorene i spørsmålet er eksakte
+            answer_started = time.perf_counter()
+            route = self.model_router.route(query, [
+                {
+                    "text": r["text"],
+                    "score": r.get("cosine"),
+                    "exact": r.get("cosine") is None and r["relevance_score"] >= 1.0,
+                    "filename": r["filename"],
+                    "page": r["metadata"].get("page_start")
+                }
+                for r in search_results
+            ])
+            routing = {key: value for key, value in route.items() if key != "answer"}
+            
+            def answered(response: str, tier: str) -> Dict[str, Any]:
+                self.model_router.record(tier, time.perf_counter() - answer_started)
+                return {
+                    "response": response,
+                    "sources": sources,
+                    "context_used": True,
+                    "context_stats": packed["stats"],
+                    "routing": {**routing, "tier": tier}
+                }
+            
+            if route["tier"] == EXTRACTIVE:
+                logger.info(f"⚡ Ekstraktivt svar (dekning {route['coverage']:.2f}, score {route['top_score']:.2f})")
+                return answered(route["answer"], EXTRACTIVE)
+            
+            # Ikke nok tid igjen til et LLM-kall - svar ekstraktivt fra treffene
+            if deadline is not None and not deadline.allows("llm"):
+                deadline.degrade("extractive_answer")
+                return answered(self._extractive_answer(search_results), EXTRACTIVE)
             
             # 3. Lag prompt
             prompt = f"""Du er en AI-assistent for GPS-teknologi. Svar på spørsmålet kun basert på følgende kontekst.
@@ -306,33 +1091,41 @@ SVAR:"""
             }
             
             json_data = {
-                "model": "gpt-3.5-turbo",
+                "model": route["model"],
                 "messages": [{"role": "user", "content": prompt}],
                 "max_tokens": max_tokens,
                 "temperature": 0.3
             }
             
-            logger.info("🤖 Kaller OpenAI Chat API direkte...")
+            logger.info(f"🤖 Kaller OpenAI Chat API direkte ({route['model']}, nivå {route['tier']})...")
             
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    "https://api.openai.com/v1/chat/completions",
-                    headers=headers,
-                    json=json_data,
-                    timeout=45.0
-                )
-            
-            response.raise_for_status()
-            
-            ai_response = response.json()["choices"][0]["message"]["content"].strip()
+            emitted: List[str] = []
+            try:
+                ai_response = await self._within(deadline, self._stream_chat_completion(
+                    headers,
+                    json_data,
+                    timeout=deadline.stage_timeout() if deadline is not None else 45.0,
+                    on_token=on_token,
+                    parts=emitted
+                ))
+            except (httpx.TimeoutException, asyncio.TimeoutError):
+                if deadline is None:
+                    raise
+                deadline.degrade("llm_timeout")
+                if emitted:
+                    # Brukeren har allerede fått starten av svaret - avslutt det i stedet for å bytte det ut
+                    deadline.degrade("llm_truncated")
+                    if on_token is not None:
+                        on_token(TRUNCATION_MARKER)
+                    logger.warning(f"⏱️ OpenAI nådde ikke fristen, avkorter svaret etter {len(emitted)} tokens")
+                    return answered("".join(emitted).strip() + TRUNCATION_MARKER, route["tier"])
+                deadline.degrade("extractive_answer")
+                logger.warning("⏱️ OpenAI nådde ikke fristen, svarer ekstraktivt")
+                return answered(self._extractive_answer(search_results), EXTRACTIVE)
             
             logger.info("✅ RAG respons generert via direkte API-kall.")
             
-            return {
-                "response": ai_response,
-                "sources": sources,
-                "context_used": True
-            }
+            return answered(ai_response, route["tier"])
             
         except Exception as e:
             logger.error(f"❌ RAG respons feil (direkte kall): {e}", exc_info=True)
@@ -342,6 +1135,58 @@ SVAR:"""
                 "context_used": False
             }
 
+    async def _stream_chat_completion(
+        self,
+        headers: Dict[str, str],
+        json_data: Dict[str, Any],
+        timeout: float,
+        on_token: Optional[Callable[[str], None]] = None,
+        parts: Optional[List[str]] = None
+    ) -> str:
+        """
+        Strømmer svaret fra OpenAI og setter det sammen. Kanselleres kallet (klienten koblet
+        fra), lukkes forbindelsen og OpenAI slutter å generere - vi betaler ikke for resten.
+        Går via OpenAI-limiteren når den er på: 429 kommer før første token, så et nytt
+        forsøk sender aldri dupliserte tokens til on_token. parts fylles med tokenene etter
+        hvert, så kalleren ser hva som er sendt også når kallet avbrytes av fristen.
+        """
+        import httpx
+        
+        if parts is None:
+            parts = []
+        
+        async def request() -> str:
+            async with httpx.AsyncClient() as client:
+                async with client.stream(
+                    "POST",
+                    "https://api.openai.com/v1/chat/completions",
+                    headers=headers,
+                    json={**json_data, "stream": True},
+                    timeout=timeout
+                ) as response:
+                    response.raise_for_status()
+                    if self.openai_limiter is not None:
+                        self.openai_limiter.observe(response.headers, "chat")
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data: "):
+                            continue
+                        data = line[len("data: "):]
+                        if data == "[DONE]":
+                            break
+                        choices = json.loads(data).get("choices") or [{}]
+                        token = choices[0].get("delta", {}).get("content") or ""
+                        if token:
+                            parts.append(token)
+                            if on_token is not None:
+                                on_token(token)
+            return "".join(parts).strip()
+        
+        if self.openai_limiter is None:
+            return await request()
+        # OpenAI regner max_tokens mot TPM-kvoten allerede når kallet starter
+        tokens = sum(len(self.tokenizer.encode(message["content"])) for message in json_data["messages"])
+        return await self.openai_limiter.run(tokens + json_data.get("max_tokens", 0), request, route="chat")
+
 # Global RAG service er ikke lenger nødvendig, den håndteres av appens livssyklus
 # rag_service = None
 # def get_rag_service():
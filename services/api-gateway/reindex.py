@@ -0,0 +1,201 @@
+"""
+Reindex - re-embedding av hele korpuset til en ny indeksversjon uten nedetid
+Jobben bygger en skyggeindeks med ny embedding-provider i et begrenset tempo mens
+spørringer går mot live-indeksen, bytter alias atomisk og rydder bort den gamle.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Optional, Set
+
+from embedding_providers import create_embedding_provider
+from priority_scheduler import work_route
+from sharded_collection import doc_id_from_chunk_id
+
+logger = logging.getLogger(__name__)
+
+
+class ReindexJob:
+    """Én re-embedding fra live-indeksen til versjon from_version + 1"""
+
+    def __init__(self, service, provider_name: str, rate_limit: Optional[float] = None, batch_size: int = 64):
+        self.service = service
+        self.provider_name = provider_name
+        self.rate_limit = rate_limit  # chunks per sekund, None = ubegrenset
+        self.batch_size = batch_size
+        self.from_version = service.index_version
+        self.to_version = service.index_version + 1
+
+        self.state = "pending"
+        self.error: Optional[str] = None
+        self.total_documents = 0
+        self.done_documents = 0
+        self.total_chunks = 0
+        self.done_chunks = 0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        self.sizes: Dict[str, int] = {}  # minneregnskap per dokument i den nye indeksen
+
+    @property
+    def running(self) -> bool:
+        return self.state in ("pending", "running")
+
+    def start(self) -> "ReindexJob":
+        self.task = asyncio.create_task(self.run())
+        return self
+
+    def cancel(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+
+    def status(self) -> Dict[str, Any]:
+        elapsed = ((self.finished_at or time.time()) - self.started_at) if self.started_at else 0.0
+        rate = self.done_chunks / elapsed if elapsed > 0 else 0.0
+        remaining = max(self.total_chunks - self.done_chunks, 0)
+        return {
+            "state": self.state,
+            "provider": self.provider_name,
+            "from_version": self.from_version,
+            "to_version": self.to_version,
+            "documents": {"done": self.done_documents, "total": self.total_documents},
+            "chunks": {"done": self.done_chunks, "total": self.total_chunks},
+            "progress": round(self.done_chunks / self.total_chunks, 4) if self.total_chunks else (1.0 if self.state == "completed" else 0.0),
+            "chunks_per_second": round(rate, 2),
+            "eta_seconds": round(remaining / rate, 1) if rate > 0 and self.running else None,
+            "elapsed_seconds": round(elapsed, 1),
+            "error": self.error
+        }
+
+    def _live_documents(self) -> Dict[str, Dict[str, Any]]:
+        """Dokumentene i live-indeksen akkurat nå (centroid-collection har én rad per dokument)"""
+        results = self.service.document_collection.get(include=["metadatas"])
+        return dict(zip(results["ids"], results["metadatas"]))
+
+    async def _throttle(self):
+        """Holder tempoet på rate_limit chunks per sekund så live-trafikken ikke sultes"""
+        if not self.rate_limit:
+            await asyncio.sleep(0)
+            return
+        ahead = self.done_chunks / self.rate_limit - (time.time() - self.started_at)
+        if ahead > 0:
+            await asyncio.sleep(ahead)
+
+    async def _copy_document(self, doc_id: str, metadata: Dict[str, Any], provider, collection, document_collection):
+        """Re-embedder ett dokuments chunks inn i skyggeindeksen"""
+        # Offloadede dokumenter leses fra segmentet på disk
+        chunks = self.service.memory.read_chunks(doc_id, self.service.collection)
+        rows = sorted(
+            zip(chunks["ids"], chunks["documents"], chunks["metadatas"]),
+            key=lambda row: row[2]["chunk_index"]
+        )
+
+        embeddings = []
+        for start in range(0, len(rows), self.batch_size):
+            batch = rows[start:start + self.batch_size]
+            with work_route("ingest"):
+                batch_embeddings = await provider.embed([text for _, text, _ in batch])
+            collection.add(
+                ids=[chunk_id for chunk_id, _, _ in batch],
+                embeddings=batch_embeddings,
+                metadatas=[chunk_metadata for _, _, chunk_metadata in batch],
+                documents=[text for _, text, _ in batch]
+            )
+            embeddings.extend(batch_embeddings)
+            self.done_chunks += len(batch)
+            await self._throttle()
+
+        texts = [text for _, text, _ in rows]
+        self.sizes[doc_id] = self.service.memory.estimate_bytes(
+            embeddings, texts, [chunk_metadata for _, _, chunk_metadata in rows],
+            text_bytes=collection.stored_text_bytes([chunk_id for chunk_id, _, _ in rows], texts)
+        )
+        if embeddings:
+            self.service._store_document_centroid(
+                doc_id, metadata["filename"], embeddings, metadata["uploaded_at"], document_collection
+            )
+        self.done_documents += 1
+
+    async def run(self):
+        service = self.service
+        provider = collection = document_collection = None
+        self.started_at = time.time()
+        self.state = "running"
+        logger.info(f"🔄 Re-embedding til indeksversjon {self.to_version} med {self.provider_name}")
+
+        try:
+            # Modell-lasting (ONNX) kan ta tid - ikke blokker event-loopen
+            provider = await asyncio.to_thread(
+                create_embedding_provider, self.provider_name, service.openai_api_key, service.openai_limiter, service.cpu_scheduler
+            )
+            collection, document_collection = service.create_index_collections(self.to_version)
+
+            copied: Set[str] = set()
+            while True:
+                # Dokumenter som lastes opp underveis havner i live-indeksen og plukkes opp i neste runde
+                live = self._live_documents()
+                pending = {doc_id: metadata for doc_id, metadata in live.items() if doc_id not in copied}
+                if not pending:
+                    break
+                self.total_documents = len(copied) + len(pending)
+                self.total_chunks = self.done_chunks + sum(int(m.get("chunk_count", 0)) for m in pending.values())
+                for doc_id, metadata in pending.items():
+                    await self._copy_document(doc_id, metadata, provider, collection, document_collection)
+                    copied.add(doc_id)
+
+            # Dokumenter som ble slettet underveis skal ikke følge med over i den nye indeksen
+            for doc_id in copied - live.keys():
+                collection.delete(where={"doc_id": doc_id})
+                document_collection.delete(ids=[doc_id])
+            copied &= live.keys()
+
+            # Ingen await mellom siste sjekk og byttet - ingen opplasting kan falle mellom
+            old_collection, old_document_collection, old_provider = service.activate_index(
+                self.to_version, collection, document_collection, provider
+            )
+
+            # Alt ligger nå i den nye indeksen; gamle segmenter har vektorer fra forrige modell
+            service.memory.rebuild(self.sizes)
+            # Identifikatorer som peker på chunks utenfor den nye indeksen gir ellers tomme treff
+            service.identifier_index.remove({
+                chunk_id for chunk_id in service.identifier_index.chunk_ids()
+                if doc_id_from_chunk_id(chunk_id) not in copied
+            })
+            service.memory.enforce(service.collection)
+
+            self.state = "completed"
+            try:
+                old_collection.drop()
+                service.client.delete_collection(old_document_collection.name)
+                await old_provider.close()
+            except Exception as e:
+                logger.warning(f"⚠️ Kunne ikke rydde indeksversjon {self.from_version}: {e}")
+
+            logger.info(f"✅ Re-embedding ferdig: {self.done_documents} dokumenter, {self.done_chunks} chunks")
+
+        except asyncio.CancelledError:
+            self.state = "cancelled"
+            self._discard_shadow(collection, document_collection)
+            if provider is not None:
+                await provider.close()
+            raise
+        except Exception as e:
+            logger.error(f"❌ Re-embedding feilet: {e}", exc_info=True)
+            self.state = "failed"
+            self.error = str(e)
+            self._discard_shadow(collection, document_collection)
+            if provider is not None:
+                await provider.close()
+        finally:
+            self.finished_at = time.time()
+
+    def _discard_shadow(self, collection, document_collection):
+        """Fjerner en halvferdig skyggeindeks; live-indeksen er urørt"""
+        try:
+            if collection is not None:
+                collection.drop()
+            if document_collection is not None:
+                self.service.client.delete_collection(document_collection.name)
+        except Exception as e:
+            logger.warning(f"⚠️ Kunne ikke rydde skyggeindeks: {e}")
@@ -0,0 +1,320 @@
+"""
+Sharded Collection - scatter-gather over flere ChromaDB collections
+Dokumenter fordeles på shards med rendezvous-hashing av doc_id, spørringer sendes
+til alle shards parallelt og topp-k per shard flettes med en heap.
+Med en ChunkStore ligger chunk-tekstene komprimert utenfor ChromaDB.
+
+Rebalansering kopierer dokumentene til de nye shardene mens spørringer fortsatt går mot
+det gamle shard-kartet, og bytter så kart og trådpool i ett låst steg.
+"""
+
+import contextlib
+import hashlib
+import heapq
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def doc_id_from_chunk_id(chunk_id: str) -> str:
+    """Chunk-id-er er på formen {doc_id}_chunk_{i}"""
+    return chunk_id.rsplit("_chunk_", 1)[0]
+
+
+def _shard_weight(doc_id: str, shard_name: str) -> int:
+    digest = hashlib.blake2b(f"{shard_name}:{doc_id}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def _owner(doc_id: str, shard_names) -> str:
+    """Rendezvous-hashing: sharden med høyest vekt for doc_id eier dokumentet"""
+    return max(shard_names, key=lambda shard_name: _shard_weight(doc_id, shard_name))
+
+
+class ShardError(Exception):
+    """En shard feilet under en scatter-gather - resultatet ville vært ufullstendig"""
+
+
+class _ReadWriteLock:
+    """Mange lesere samtidig, én skriver alene; en ventende skriver slipper foran nye lesere"""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextlib.contextmanager
+    def read(self):
+        with self._condition:
+            while self._writer or self._writers_waiting:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        with self._condition:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._condition.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer = False
+                self._condition.notify_all()
+
+
+class ShardedCollection:
+    """
+    Tilbyr den delen av ChromaDB Collection-API-et som RAG-tjenesten bruker
+    (add, get, query, delete, count), fordelt på N collections.
+
+    Rendezvous-hashing gjør at når en shard legges til, flyttes kun dokumentene
+    som nå hører til den nye sharden (~1/N av korpuset).
+
+    Lesinger holder leselåsen mens de bruker shard-kartet og trådpoolen; bytte av kart
+    tar skrivelåsen. Endringer (add, delete, rebalansering) kjøres én om gangen.
+    """
+
+    def __init__(self, client, name: str, num_shards: int = 1, metadata: Optional[Dict[str, Any]] = None, chunk_store=None):
+        self.client = client
+        self.name = name
+        self.metadata = metadata
+        # Tekstene lagres komprimert her i stedet for som ChromaDB-documents
+        self.chunk_store = chunk_store
+        self._lock = _ReadWriteLock()
+        self._mutation_lock = threading.Lock()
+        self.shards: Dict[str, Any] = {}
+        # Shard 0 beholder det opprinnelige navnet, så N=1 er identisk med én collection
+        for index in range(max(num_shards, 1)):
+            self.shards[self._shard_name(index)] = self._create_shard(index)
+        self._executor = ThreadPoolExecutor(max_workers=max(num_shards, 1), thread_name_prefix="chroma-shard")
+
+    def _shard_name(self, index: int) -> str:
+        return self.name if index == 0 else f"{self.name}_shard_{index}"
+
+    def _create_shard(self, index: int):
+        return self.client.get_or_create_collection(name=self._shard_name(index), metadata=self.metadata)
+
+    def shard_for(self, doc_id: str):
+        """Sharden som eier doc_id"""
+        return self.shards[_owner(doc_id, self.shards)]
+
+    def _fan_out(self, call) -> List[Any]:
+        """Kjører call(shard) på alle shards parallelt; ShardError hvis noen av dem feiler"""
+        if len(self.shards) == 1:
+            return [call(next(iter(self.shards.values())))]
+
+        futures = {shard_name: self._executor.submit(call, shard) for shard_name, shard in self.shards.items()}
+        results, failures = [], []
+        for shard_name, future in futures.items():
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.error(f"❌ Shard {shard_name} feilet: {e}")
+                failures.append((shard_name, e))
+        if failures:
+            shard_name, error = failures[0]
+            raise ShardError(f"{len(failures)} av {len(futures)} shards feilet ({shard_name}: {error})") from error
+        return results
+
+    def _chroma_include(self, include: List[str]) -> List[str]:
+        if self.chunk_store is None:
+            return include
+        return [key for key in include if key != "documents"]
+
+    def _by_shard(self, ids: List[str]) -> Dict[str, List[str]]:
+        by_shard: Dict[str, List[str]] = {}
+        for chunk_id in ids:
+            by_shard.setdefault(_owner(doc_id_from_chunk_id(chunk_id), self.shards), []).append(chunk_id)
+        return by_shard
+
+    def count(self) -> int:
+        with self._lock.read():
+            return sum(shard.count() for shard in self.shards.values())
+
+    def add(self, ids: List[str], embeddings: List[List[float]], metadatas: List[Dict[str, Any]], documents: List[str]):
+        """Legger chunks i sharden som eier dokumentet deres"""
+        with self._mutation_lock, self._lock.read():
+            if self.chunk_store is not None:
+                self.chunk_store.put_many(ids, documents)
+            batches: Dict[str, Dict[str, list]] = {}
+            for chunk_id, embedding, metadata, document in zip(ids, embeddings, metadatas, documents):
+                batch = batches.setdefault(
+                    _owner(metadata["doc_id"], self.shards),
+                    {"ids": [], "embeddings": [], "metadatas": [], "documents": []}
+                )
+                batch["ids"].append(chunk_id)
+                batch["embeddings"].append(embedding)
+                batch["metadatas"].append(metadata)
+                batch["documents"].append(document)
+
+            for shard_name, batch in batches.items():
+                if self.chunk_store is not None:
+                    del batch["documents"]
+                self.shards[shard_name].add(**batch)
+
+    def get(self, ids: Optional[List[str]] = None, where: Optional[Dict[str, Any]] = None, include: Optional[List[str]] = None) -> Dict[str, list]:
+        """Henter chunks; med ids rutes oppslaget direkte til riktig shard"""
+        with self._lock.read():
+            return self._get(ids, where, include)
+
+    def _get(self, ids: Optional[List[str]], where: Optional[Dict[str, Any]], include: Optional[List[str]]) -> Dict[str, list]:
+        include = include or ["documents", "metadatas"]
+        chroma_include = self._chroma_include(include)
+        merged: Dict[str, list] = {"ids": [], **{key: [] for key in chroma_include}}
+
+        if ids is not None:
+            partials = [
+                self.shards[name].get(ids=shard_ids, where=where, include=chroma_include)
+                for name, shard_ids in self._by_shard(ids).items()
+            ]
+        else:
+            partials = self._fan_out(lambda shard: shard.get(where=where, include=chroma_include))
+
+        for partial in partials:
+            merged["ids"].extend(partial["ids"])
+            for key in chroma_include:
+                merged[key].extend(partial[key] or [])
+        if "documents" in include and self.chunk_store is not None:
+            merged["documents"] = self.chunk_store.get_many(merged["ids"])
+        return merged
+
+    def query(
+        self,
+        query_embeddings: List[List[float]],
+        n_results: int = 10,
+        where: Optional[Dict[str, Any]] = None,
+        include: Optional[List[str]] = None
+    ) -> Dict[str, list]:
+        """Scatter-gather: topp n_results fra hver shard, flettet globalt på distanse"""
+        include = include or ["documents", "metadatas", "distances"]
+        chroma_include = self._chroma_include(include)
+        shard_include = chroma_include if "distances" in chroma_include else chroma_include + ["distances"]
+
+        def query_shard(shard):
+            if shard.count() == 0:
+                return None
+            return shard.query(query_embeddings=query_embeddings, n_results=n_results, where=where, include=shard_include)
+
+        with self._lock.read():
+            partials = [p for p in self._fan_out(query_shard) if p is not None]
+        if len(partials) == 1 and shard_include == include:
+            return partials[0]
+
+        merged: Dict[str, list] = {"ids": [], **{key: [] for key in chroma_include}}
+        for query_index in range(len(query_embeddings)):
+            candidates = []
+            for partial in partials:
+                for position, distance in enumerate(partial["distances"][query_index]):
+                    candidates.append((distance, id(partial), position, partial))
+            best = heapq.nsmallest(n_results, candidates, key=lambda candidate: candidate[0])
+
+            merged["ids"].append([partial["ids"][query_index][position] for _, _, position, partial in best])
+            for key in chroma_include:
+                merged[key].append([partial[key][query_index][position] for _, _, position, partial in best])
+        if "documents" in include and self.chunk_store is not None:
+            merged["documents"] = [self.chunk_store.get_many(row_ids) for row_ids in merged["ids"]]
+        return merged
+
+    def delete(self, ids: Optional[List[str]] = None, where: Optional[Dict[str, Any]] = None):
+        with self._mutation_lock, self._lock.read():
+            if ids is None and self.chunk_store is not None:
+                ids = self._get(None, where, [])["ids"]
+            if ids is not None:
+                if self.chunk_store is not None:
+                    self.chunk_store.remove_many(ids)
+                for shard_name, shard_ids in self._by_shard(ids).items():
+                    self.shards[shard_name].delete(ids=shard_ids)
+            else:
+                self._fan_out(lambda shard: shard.delete(where=where))
+
+    def add_shards(self, count: int = 1) -> Dict[str, int]:
+        """
+        Legger til shards og flytter dokumentene som nå eies av en ny shard. Chunkene
+        kopieres mens lesinger fortsatt bruker det gamle kartet; så byttes kart og trådpool,
+        og de gamle kopiene slettes, mens skrivelåsen holdes.
+        """
+        with self._mutation_lock:
+            first_new = len(self.shards)
+            new_shards = {self._shard_name(index): self._create_shard(index) for index in range(first_new, first_new + count)}
+            shards = {**self.shards, **new_shards}
+
+            moved_chunks = 0
+            moved_docs = set()
+            stale: Dict[str, List[str]] = {}
+            for shard_name, shard in self.shards.items():
+                existing = shard.get(include=self._chroma_include(["embeddings", "metadatas", "documents"]))
+                to_move: Dict[str, Dict[str, list]] = {}
+                for i, chunk_id in enumerate(existing["ids"]):
+                    owner = _owner(existing["metadatas"][i]["doc_id"], shards)
+                    if owner == shard_name:
+                        continue
+                    batch = to_move.setdefault(owner, {"ids": [], "embeddings": [], "metadatas": [], "documents": []})
+                    batch["ids"].append(chunk_id)
+                    batch["embeddings"].append(existing["embeddings"][i])
+                    batch["metadatas"].append(existing["metadatas"][i])
+                    # Komprimerte tekster ligger i chunk_store på tvers av shards og flyttes ikke
+                    if self.chunk_store is None:
+                        batch["documents"].append(existing["documents"][i])
+                    moved_docs.add(existing["metadatas"][i]["doc_id"])
+
+                for owner_name, batch in to_move.items():
+                    if self.chunk_store is not None:
+                        del batch["documents"]
+                    shards[owner_name].add(**batch)
+                    stale.setdefault(shard_name, []).extend(batch["ids"])
+                    moved_chunks += len(batch["ids"])
+
+            executor = ThreadPoolExecutor(max_workers=len(shards), thread_name_prefix="chroma-shard")
+            with self._lock.write():
+                old_executor = self._executor
+                self.shards, self._executor = shards, executor
+                # Ingen leser ser chunkene to ganger: de gamle kopiene er borte før låsen slippes
+                for shard_name, shard_ids in stale.items():
+                    shards[shard_name].delete(ids=shard_ids)
+            old_executor.shutdown(wait=False)
+
+        logger.info(f"🔀 Rebalansert til {len(shards)} shards: flyttet {len(moved_docs)} dokumenter ({moved_chunks} chunks)")
+        return {"shards": len(shards), "moved_documents": len(moved_docs), "moved_chunks": moved_chunks}
+
+    def drop(self):
+        """Sletter alle shard-collections (brukes når en gammel indeksversjon ryddes bort)"""
+        with self._mutation_lock, self._lock.write():
+            for shard_name in list(self.shards):
+                self.client.delete_collection(shard_name)
+            self.shards.clear()
+            self._executor.shutdown(wait=False)
+            if self.chunk_store is not None:
+                self.chunk_store.clear()
+
+    def texts(self, ids: List[str]) -> List[Optional[str]]:
+        """Teksten til ids i samme rekkefølge - kun disse pakkes ut"""
+        if self.chunk_store is not None:
+            return self.chunk_store.get_many(ids)
+        results = self.get(ids=ids, include=["documents"])
+        by_id = dict(zip(results["ids"], results["documents"]))
+        return [by_id.get(chunk_id) for chunk_id in ids]
+
+    def stored_text_bytes(self, ids: List[str], documents: List[str]) -> int:
+        """Bytes tekstene faktisk bruker i minnet (komprimert når chunk_store er på)"""
+        if self.chunk_store is not None:
+            return self.chunk_store.stored_size(ids)
+        return sum(len(document.encode("utf-8")) for document in documents)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock.read():
+            return {shard_name: shard.count() for shard_name, shard in self.shards.items()}
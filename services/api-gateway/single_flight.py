@@ -0,0 +1,128 @@
+"""
+Single Flight - samler identiske samtidige spørsmål til én beregning
+Når mange spør om det samme i løpet av sekunder (demoer, hendelser), kjøres embedding,
+søk og LLM-generering bare én gang. De andre venter på den samme beregningen og får
+samme svar; strømmende abonnenter får tokenene som allerede er kommet og resten fortløpende.
+"""
+
+import asyncio
+import json
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_question(question: str) -> str:
+    """Små bokstaver, sammenslått whitespace og uten avsluttende tegnsetting"""
+    return " ".join(question.lower().split()).rstrip("?!. ")
+
+
+class Flight:
+    """Én pågående beregning og abonnentene som venter på den"""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.task: Optional[asyncio.Task] = None
+        self.subscribers = 0
+        self.tokens: List[str] = []
+        self._listeners: List[asyncio.Queue] = []
+
+    def publish(self, token: str):
+        """Kalles av beregningen for hvert token fra LLM-strømmen"""
+        self.tokens.append(token)
+        for queue in self._listeners:
+            queue.put_nowait(token)
+
+    def _close(self):
+        for queue in self._listeners:
+            queue.put_nowait(None)
+
+    async def stream(self) -> AsyncIterator[str]:
+        """Tokenene som allerede er publisert, så resten etter hvert som de kommer"""
+        # Ingen await mellom kopien og registreringen, så ingen tokens faller mellom
+        replay = list(self.tokens)
+        queue: asyncio.Queue = asyncio.Queue()
+        self._listeners.append(queue)
+        try:
+            for token in replay:
+                yield token
+            if self.task.done():
+                return
+            while True:
+                token = await queue.get()
+                if token is None:
+                    return
+                yield token
+        finally:
+            self._listeners.remove(queue)
+
+
+class SingleFlight:
+    """
+    Nøkkel -> pågående Flight. Beregningen kjører som en egen task, så én klient som
+    kobler fra avbryter den ikke for de andre; den kanselleres først når ingen venter.
+    Ferdige resultater caches ikke - neste spørsmål etter at svaret er levert kjøres på nytt.
+    """
+
+    def __init__(self):
+        self.flights: Dict[str, Flight] = {}
+        self.requests = 0
+        self.executions = 0
+        self.coalesced = 0
+        self.cancelled = 0
+
+    @staticmethod
+    def make_key(question: str, filters: Optional[Dict[str, Any]] = None, **params) -> str:
+        return json.dumps(
+            {"question": normalize_question(question), "filters": filters or {}, **params},
+            sort_keys=True,
+            default=str
+        )
+
+    def acquire(self, key: str, compute: Callable[[Flight], Awaitable[Any]]) -> Flight:
+        """Blir med i en pågående beregning for key, eller starter en ny"""
+        self.requests += 1
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = Flight(key)
+            flight.task = asyncio.create_task(compute(flight))
+            flight.task.add_done_callback(lambda _task: self._finish(flight))
+            self.flights[key] = flight
+            self.executions += 1
+        else:
+            self.coalesced += 1
+            logger.info(f"🔗 Slo sammen med pågående beregning ({flight.subscribers} venter allerede)")
+        flight.subscribers += 1
+        return flight
+
+    def release(self, flight: Flight):
+        flight.subscribers -= 1
+        if flight.subscribers == 0 and not flight.task.done():
+            # Ingen venter lenger på svaret - stopp embedding/søk/LLM
+            flight.task.cancel()
+            self.cancelled += 1
+
+    def _finish(self, flight: Flight):
+        if self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
+        flight._close()
+
+    async def run(self, key: str, compute: Callable[[Flight], Awaitable[Any]]) -> Any:
+        """Resultatet av beregningen for key, delt med alle samtidige kallere"""
+        flight = self.acquire(key, compute)
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            self.release(flight)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+            "coalesced_ratio": round(self.coalesced / self.requests, 4) if self.requests else 0.0,
+            "cancelled": self.cancelled,
+            "in_flight": len(self.flights),
+            "waiting": sum(flight.subscribers for flight in self.flights.values())
+        }
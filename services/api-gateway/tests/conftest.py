@@ -0,0 +1,9 @@
+"""
+Gatewayen bruker flate imports (from single_flight import ...), så tjenestemappen må
+ligge på sys.path når testene kjøres fra rot: pytest services/api-gateway/tests
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,74 @@
+"""
+Den delen av ChromaDB-klienten og Collection-API-et som gatewayen bruker, i minnet -
+for tester som ikke skal trenge chromadb. where støtter bare likhet på metadata-felt.
+"""
+
+import threading
+import time
+
+import numpy as np
+
+
+class InMemoryCollection:
+    """Den delen av ChromaDB Collection som ShardedCollection bruker, med valgfri forsinkelse i add"""
+
+    def __init__(self, name, add_delay=0.0):
+        self.name = name
+        self.add_delay = add_delay
+        self.rows = {}
+        self._lock = threading.Lock()
+
+    def _matches(self, metadata, where):
+        return not where or all(metadata.get(key) == value for key, value in where.items())
+
+    def count(self):
+        return len(self.rows)
+
+    def add(self, ids, embeddings, metadatas, documents=None):
+        time.sleep(self.add_delay)
+        with self._lock:
+            for i, chunk_id in enumerate(ids):
+                self.rows[chunk_id] = (list(embeddings[i]), metadatas[i], documents[i] if documents else None)
+
+    def get(self, ids=None, where=None, include=()):
+        with self._lock:
+            selected = [
+                (chunk_id, row) for chunk_id, row in self.rows.items()
+                if (ids is None or chunk_id in ids) and self._matches(row[1], where)
+            ]
+        return {
+            "ids": [chunk_id for chunk_id, _ in selected],
+            "embeddings": [row[0] for _, row in selected],
+            "metadatas": [row[1] for _, row in selected],
+            "documents": [row[2] for _, row in selected]
+        }
+
+    def query(self, query_embeddings, n_results, where=None, include=()):
+        with self._lock:
+            rows = list(self.rows.items())
+        result = {"ids": [], "distances": [], "metadatas": [], "embeddings": [], "documents": []}
+        for query in query_embeddings:
+            scored = sorted(rows, key=lambda item: float(np.sum((np.asarray(item[1][0]) - query) ** 2)))[:n_results]
+            result["ids"].append([chunk_id for chunk_id, _ in scored])
+            result["distances"].append([float(np.sum((np.asarray(row[0]) - query) ** 2)) for _, row in scored])
+            result["metadatas"].append([row[1] for _, row in scored])
+            result["embeddings"].append([row[0] for _, row in scored])
+            result["documents"].append([row[2] for _, row in scored])
+        return result
+
+    def delete(self, ids=None, where=None):
+        with self._lock:
+            for chunk_id in [c for c, row in self.rows.items() if (ids is None or c in ids) and self._matches(row[1], where)]:
+                del self.rows[chunk_id]
+
+
+class InMemoryClient:
+    def __init__(self, add_delay=0.0):
+        self.add_delay = add_delay
+        self.collections = {}
+
+    def get_or_create_collection(self, name, metadata=None):
+        return self.collections.setdefault(name, InMemoryCollection(name, self.add_delay))
+
+    def delete_collection(self, name):
+        del self.collections[name]
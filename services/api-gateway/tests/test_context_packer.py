@@ -0,0 +1,96 @@
+import pytest
+
+import context_packer
+from context_packer import count_tokens, pack_context, strip_overlap
+
+
+class CharacterEncoding:
+    """Ett token per tegn - samme grensesnitt som tiktoken, uten å laste cl100k_base fra nett"""
+
+    def encode(self, text):
+        return [ord(ch) for ch in text]
+
+    def decode(self, tokens):
+        return "".join(chr(token) for token in tokens)
+
+
+@pytest.fixture(autouse=True)
+def encoding(monkeypatch):
+    monkeypatch.setattr(context_packer, "_ENCODING", CharacterEncoding())
+
+
+def _hit(text, score, source="doc1", position=None, filename="manual.pdf"):
+    return {"text": text, "score": score, "source": source, "filename": filename, "position": position}
+
+
+def test_strip_overlap_removes_repeated_window():
+    previous = "UART1 bruker 9600 baud som standard. Protokollen kan endres med CFG-PRT."
+    following = "Protokollen kan endres med CFG-PRT. Lagre med CFG-CFG etterpå."
+    assert strip_overlap(previous, following) == "Lagre med CFG-CFG etterpå."
+
+
+def test_strip_overlap_keeps_short_coincidental_match():
+    assert strip_overlap("see table 12", "12 messages are listed") == "12 messages are listed"
+
+
+def test_strip_overlap_respects_min_overlap():
+    previous, following = "slutten er abcdef", "abcdef og videre"
+    assert strip_overlap(previous, following, min_overlap=6) == "og videre"
+    assert strip_overlap(previous, following, min_overlap=7) == following
+
+
+def test_strip_overlap_without_match_returns_following():
+    assert strip_overlap("helt annen tekst", "ingenting felles her") == "ingenting felles her"
+
+
+def test_pack_context_empty():
+    packed = pack_context([], token_budget=100)
+    assert packed["context"] == ""
+    assert packed["blocks"] == []
+    assert packed["stats"]["chunks_in"] == 0
+
+
+def test_pack_context_merges_adjacent_chunks_and_strips_overlap():
+    overlap = "Protokollen kan endres med CFG-PRT."
+    hits = [
+        _hit(f"UART1 bruker 9600 baud som standard. {overlap}", 0.9, position=0),
+        _hit(f"{overlap} Lagre med CFG-CFG etterpå.", 0.8, position=1),
+    ]
+    packed = pack_context(hits, token_budget=1000)
+
+    assert packed["stats"]["chunks_merged"] == 1
+    assert len(packed["blocks"]) == 1
+    assert packed["blocks"][0]["positions"] == [0, 1]
+    assert packed["blocks"][0]["score"] == 0.9
+    assert packed["context"].count(overlap) == 1
+    assert packed["context"].endswith("Lagre med CFG-CFG etterpå.")
+
+
+def test_pack_context_does_not_merge_gaps_or_other_documents():
+    hits = [
+        _hit("Første avsnitt om UART.", 0.9, position=0),
+        _hit("Tredje avsnitt om UART.", 0.8, position=2),
+        _hit("Avsnitt i et annet dokument.", 0.7, source="doc2", position=1),
+    ]
+    packed = pack_context(hits, token_budget=1000)
+    assert packed["stats"]["chunks_merged"] == 0
+    assert len(packed["blocks"]) == 3
+
+
+def test_pack_context_fills_budget_by_score():
+    best = _hit("Høyest score: standard baud rate er 9600.", 0.9, source="a")
+    worst = _hit("Lavest score: " + "fyll " * 50, 0.2, source="b")
+    budget = count_tokens(context_packer._format_block("manual.pdf", best["text"])) + 5
+
+    packed = pack_context([worst, best], token_budget=budget)
+
+    assert [block["source"] for block in packed["blocks"]] == ["a"]
+    assert packed["stats"]["chunks_dropped"] == 1
+    assert packed["stats"]["tokens_used"] <= budget
+
+
+def test_pack_context_truncates_single_oversized_block():
+    packed = pack_context([_hit("ord " * 200, 0.9)], token_budget=10)
+    assert len(packed["blocks"]) == 1
+    assert packed["stats"]["tokens_used"] == 10
+    assert count_tokens(packed["context"]) <= 10
@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+
+from idempotency import IdempotencyConflict, IdempotencyStore, request_fingerprint
+
+
+def _counter():
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"answer": len(calls)}
+
+    return calls, compute
+
+
+def test_request_fingerprint_is_stable_and_content_sensitive():
+    assert request_fingerprint("chat", {"a": 1, "b": 2}) == request_fingerprint("chat", {"b": 2, "a": 1})
+    assert request_fingerprint("chat", {"a": 1}) != request_fingerprint("chat", {"a": 2})
+
+
+def test_completed_result_is_replayed():
+    async def scenario():
+        store = IdempotencyStore()
+        calls, compute = _counter()
+        first = await store.run("key", "fp", compute)
+        second = await store.run("key", "fp", compute)
+        return store, calls, first, second
+
+    store, calls, first, second = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert first == ({"answer": 1}, False)
+    assert second == ({"answer": 1}, True)
+    assert store.stats()["replayed"] == 1
+    assert store.stats()["stored"] == 1
+
+
+def test_concurrent_retry_attaches_to_running_call():
+    async def scenario():
+        store = IdempotencyStore()
+        calls, compute = _counter()
+        results = await asyncio.gather(store.run("key", "fp", compute), store.run("key", "fp", compute))
+        return calls, results
+
+    calls, results = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert sorted(replayed for _, replayed in results) == [False, True]
+
+
+def test_same_key_with_other_request_conflicts():
+    async def scenario():
+        store = IdempotencyStore()
+        _, compute = _counter()
+        await store.run("key", "fp", compute)
+        with pytest.raises(IdempotencyConflict):
+            await store.run("key", "annet", compute)
+        return store
+
+    assert asyncio.run(scenario()).conflicts == 1
+
+
+def test_failures_are_not_remembered():
+    async def scenario():
+        store = IdempotencyStore()
+        attempts = []
+
+        async def compute():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise RuntimeError("LLM nede")
+            return "ok"
+
+        with pytest.raises(RuntimeError):
+            await store.run("key", "fp", compute)
+        return await store.run("key", "fp", compute), attempts
+
+    result, attempts = asyncio.run(scenario())
+    assert result == ("ok", False)
+    assert len(attempts) == 2
+
+
+def test_results_expire_after_ttl():
+    async def scenario():
+        store = IdempotencyStore(ttl=0.0)
+        calls, compute = _counter()
+        await store.run("key", "fp", compute)
+        return await store.run("key", "fp", compute), calls
+
+    result, calls = asyncio.run(scenario())
+    assert result == ({"answer": 2}, False)
+    assert len(calls) == 2
+
+
+def test_abandoned_call_is_cancelled_after_grace():
+    async def scenario():
+        store = IdempotencyStore(grace=0.01)
+
+        async def compute():
+            await asyncio.sleep(10)
+
+        client = asyncio.create_task(store.run("key", "fp", compute))
+        await asyncio.sleep(0)
+        client.cancel()
+        await asyncio.gather(client, return_exceptions=True)
+        await asyncio.sleep(0.05)
+        return store
+
+    store = asyncio.run(scenario())
+    assert store.abandoned == 1
+    assert "key" not in store.entries
@@ -0,0 +1,135 @@
+import time
+
+import pytest
+
+from in_memory_chroma import InMemoryCollection
+from memory_manager import MemoryManager
+
+
+def _add_document(memory, collection, doc_id, chunks=3, last_retrieved=None, filename=None):
+    ids = [f"{doc_id}_chunk_{i}" for i in range(chunks)]
+    # Verdier som er eksakte i float32, så rundturen kan sammenlignes direkte
+    embeddings = [[float(i), 0.5, -1.0, 2.0] for i in range(chunks)]
+    metadatas = [{"doc_id": doc_id, "chunk_index": i, "filename": filename or f"{doc_id}.pdf"} for i in range(chunks)]
+    documents = [f"{doc_id} tekst {i}" for i in range(chunks)]
+    collection.add(ids=ids, embeddings=embeddings, metadatas=metadatas, documents=documents)
+    size = memory.estimate_bytes(embeddings, documents, metadatas)
+    memory.register(doc_id, filename or f"{doc_id}.pdf", uploaded_at=1_700_000_000, size_bytes=size, chunk_count=chunks)
+    if last_retrieved is not None:
+        memory.documents[doc_id]["last_retrieved"] = last_retrieved
+    return {"ids": ids, "embeddings": embeddings, "documents": documents, "size": size}
+
+
+def _rows(collection, doc_id):
+    rows = collection.get(where={"doc_id": doc_id})
+    return sorted(zip(rows["ids"], rows["embeddings"], rows["documents"]))
+
+
+class FakeCache:
+    def __init__(self, bytes_used, max_bytes=10_000):
+        self.bytes_used = bytes_used
+        self.max_bytes = max_bytes
+
+    def shrink(self, target_bytes):
+        freed = max(self.bytes_used - target_bytes, 0)
+        self.bytes_used -= freed
+        return freed
+
+
+def test_offload_and_reload_restore_vectors_and_texts(tmp_path):
+    memory = MemoryManager(str(tmp_path))
+    collection = InMemoryCollection("chunks")
+    _add_document(memory, collection, "doc1")
+    before = _rows(collection, "doc1")
+
+    memory.offload("doc1", collection)
+    assert collection.count() == 0
+    assert memory.offloaded_ids() == {"doc1"}
+    assert sorted(memory.read_chunks("doc1", collection)["ids"]) == [row[0] for row in before]
+
+    assert memory.reload(["doc1"], collection) == ["doc1"]
+    assert _rows(collection, "doc1") == before
+    assert memory.offloaded_ids() == set()
+    assert list(tmp_path.iterdir()) == []
+    assert (memory.offload_count, memory.reload_count) == (1, 1)
+
+
+def test_enforce_offloads_least_recently_retrieved_until_within_budget(tmp_path):
+    memory = MemoryManager(str(tmp_path))
+    collection = InMemoryCollection("chunks")
+    now = time.time()
+    sizes = {doc_id: _add_document(memory, collection, doc_id, last_retrieved=now - age)["size"]
+             for doc_id, age in (("old", 300), ("middle", 200), ("new", 100))}
+    memory.budget_bytes = sizes["new"] + sizes["middle"]
+
+    assert memory.enforce(collection) == ["old"]
+    assert memory.resident_bytes <= memory.budget_bytes
+    assert _rows(collection, "old") == []
+    assert len(_rows(collection, "new")) == 3
+
+
+def test_enforce_keeps_protected_documents(tmp_path):
+    memory = MemoryManager(str(tmp_path))
+    collection = InMemoryCollection("chunks")
+    now = time.time()
+    sizes = {doc_id: _add_document(memory, collection, doc_id, last_retrieved=now - age)["size"]
+             for doc_id, age in (("old", 300), ("new", 100))}
+    memory.budget_bytes = sizes["old"]
+
+    assert memory.enforce(collection, protected={"old"}) == ["new"]
+    assert memory.offloaded_ids() == {"new"}
+
+
+def test_enforce_shrinks_caches_before_offloading(tmp_path):
+    memory = MemoryManager(str(tmp_path))
+    collection = InMemoryCollection("chunks")
+    size = _add_document(memory, collection, "doc1")["size"]
+    cache = FakeCache(bytes_used=500)
+    memory.register_cache("working_sets", cache)
+    memory.budget_bytes = size + 200
+
+    assert memory.enforce(collection) == []
+    assert cache.bytes_used == 200
+    assert memory.stats()["cache_bytes"] == 200
+
+
+def test_filters_find_and_reload_offloaded_documents(tmp_path):
+    memory = MemoryManager(str(tmp_path))
+    collection = InMemoryCollection("chunks")
+    _add_document(memory, collection, "doc1", filename="NEO-M8.pdf")
+    _add_document(memory, collection, "doc2", filename="ZED-F9P.pdf")
+    memory.offload("doc1", collection)
+    memory.offload("doc2", collection)
+
+    matches = memory.matching_offloaded({"filename": "ZED-F9P.pdf"}, to_timestamp=float)
+    assert matches == {"doc2"}
+    memory.reload(matches, collection)
+    assert memory.offloaded_ids() == {"doc1"}
+    assert memory.matching_offloaded({"uploaded_after": 1_800_000_000}, to_timestamp=float) == set()
+
+
+def test_forget_removes_segment(tmp_path):
+    memory = MemoryManager(str(tmp_path))
+    collection = InMemoryCollection("chunks")
+    _add_document(memory, collection, "doc1")
+    memory.offload("doc1", collection)
+    assert len(list(tmp_path.iterdir())) == 2
+
+    memory.forget("doc1")
+    assert list(tmp_path.iterdir()) == []
+    assert "doc1" not in memory.documents
+
+
+def test_no_budget_means_no_offload(tmp_path):
+    memory = MemoryManager(str(tmp_path))
+    collection = InMemoryCollection("chunks")
+    _add_document(memory, collection, "doc1")
+    assert memory.enforce(collection) == []
+    assert memory.relieve_caches() == 0
+
+
+@pytest.mark.parametrize("hnsw_m", [8, 16])
+def test_estimate_counts_graph_edges(tmp_path, hnsw_m):
+    memory = MemoryManager(str(tmp_path), hnsw_m=hnsw_m)
+    base = MemoryManager(str(tmp_path), hnsw_m=0).estimate_bytes([[0.0] * 4] * 2, ["ab", "cd"], [{}, {}])
+    assert memory.estimate_bytes([[0.0] * 4] * 2, ["ab", "cd"], [{}, {}]) == base + 2 * 2 * hnsw_m * 8
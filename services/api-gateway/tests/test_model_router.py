@@ -0,0 +1,113 @@
+import pytest
+
+from model_router import (
+    EXTRACTIVE, FAST, GENERAL, LOOKUP, STRONG, SYNTHESIS,
+    ModelRouter, classify_question, extract_answer
+)
+
+BAUD_CHUNK = {
+    "text": "The default baud rate for UART1 on the NEO-M8 is 9600. Other rates can be set with CFG-PRT.",
+    "score": 0.82,
+    "filename": "NEO-M8_DataSheet.pdf",
+    "page": 12
+}
+
+
+@pytest.mark.parametrize("question, expected", [
+    ("What is the default baud rate for NEO-M8?", LOOKUP),
+    ("Hvor mange kanaler har NEO-M8?", LOOKUP),
+    ("How many satellites can it track?", LOOKUP),
+    ("How much current does it draw?", LOOKUP),
+    ("How do I configure UART1 on NEO-M8?", GENERAL),
+    ("Hvordan konfigurerer jeg UART1?", GENERAL),
+    ("Which steps enable SBAS?", GENERAL),
+    ("What is needed to set up RTK?", GENERAL),
+    ("Aktiver NMEA på USB", GENERAL),
+    ("NEO-M8N UBX-CFG-PRT", GENERAL),
+    ("Tell me about the receiver", GENERAL),
+    ("Compare NEO-M8 and ZED-F9P", SYNTHESIS),
+    ("Forklar forskjellen på UART og I2C", SYNTHESIS),
+    ("What is RTK? Which modules support it?", SYNTHESIS),
+])
+def test_classify_question(question, expected):
+    assert classify_question(question) == expected
+
+
+def test_lookup_with_confident_hit_is_extractive():
+    decision = ModelRouter().route("What is the default baud rate for UART1 on NEO-M8?", [BAUD_CHUNK])
+    assert decision["tier"] == EXTRACTIVE
+    assert decision["model"] is None
+    assert "9600" in decision["answer"]
+    assert "NEO-M8_DataSheet.pdf" in decision["answer"]
+
+
+def test_lookup_with_low_score_is_not_extractive():
+    decision = ModelRouter().route("What is the default baud rate for UART1 on NEO-M8?", [{**BAUD_CHUNK, "score": 0.5}])
+    assert decision["tier"] == FAST
+
+
+def test_procedural_question_never_extractive():
+    decision = ModelRouter().route("How do I configure the baud rate for UART1 on NEO-M8?", [BAUD_CHUNK])
+    assert decision["question_type"] == GENERAL
+    assert decision["tier"] != EXTRACTIVE
+
+
+def test_scoreless_hits_are_neither_confident_nor_weak():
+    router = ModelRouter()
+    decision = router.route("What is the default baud rate for UART1 on NEO-M8?", [{**BAUD_CHUNK, "score": None}])
+    assert decision["top_score"] is None
+    assert decision["tier"] == FAST
+    assert decision["difficulty"] == 0.1
+
+
+def test_raw_cosine_ignores_scoreless_hits():
+    candidates = [{**BAUD_CHUNK, "score": None}, {**BAUD_CHUNK, "score": 0.2}]
+    decision = ModelRouter().route("Tell me about UART1 on NEO-M8", candidates)
+    assert decision["top_score"] == 0.2
+    assert decision["difficulty"] == pytest.approx(0.7)
+    assert decision["tier"] == STRONG
+
+
+def test_synthesis_goes_to_strong_model():
+    router = ModelRouter(strong_model="gpt-4o")
+    decision = router.route("Compare NEO-M8 and ZED-F9P", [BAUD_CHUNK])
+    assert decision["tier"] == STRONG
+    assert decision["model"] == "gpt-4o"
+
+
+def test_disabled_router_always_uses_fast_model():
+    router = ModelRouter(enabled=False, fast_model="gpt-3.5-turbo")
+    decision = router.route("Compare NEO-M8 and ZED-F9P", [BAUD_CHUNK])
+    assert decision["tier"] == FAST
+    assert decision["model"] == "gpt-3.5-turbo"
+
+
+def test_extract_answer_handles_missing_scores():
+    extract = extract_answer("default baud rate UART1", [{**BAUD_CHUNK, "score": None}])
+    assert extract is not None
+    assert any("9600" in sentence for sentence in extract["sentences"])
+
+
+def test_stats_reports_share_per_tier():
+    router = ModelRouter()
+    router.record(FAST, 0.5)
+    router.record(FAST, 0.7)
+    router.record(EXTRACTIVE, 0.01)
+    stats = router.stats()
+    assert stats["tiers"][FAST]["count"] == 2
+    assert stats["tiers"][EXTRACTIVE]["share"] == pytest.approx(0.333)
+    assert stats["tiers"][STRONG]["latency_p50_ms"] is None
+
+
+def test_exact_identifier_hit_without_cosine_can_be_extractive():
+    # Identifikator-hurtigsporet gir ingen cosinus, men treffet inneholder NEO-M8
+    exact = {**BAUD_CHUNK, "score": None, "exact": True}
+    decision = ModelRouter().route("default baud rate of NEO-M8", [exact])
+    assert decision["top_score"] is None
+    assert decision["tier"] == EXTRACTIVE
+    assert "9600" in decision["answer"]
+
+
+def test_scoreless_hit_without_exact_flag_is_not_extractive():
+    decision = ModelRouter().route("default baud rate of NEO-M8", [{**BAUD_CHUNK, "score": None}])
+    assert decision["tier"] == FAST
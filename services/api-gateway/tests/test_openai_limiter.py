@@ -0,0 +1,164 @@
+import asyncio
+import types
+
+import httpx
+import pytest
+
+import openai_limiter
+from openai_limiter import OpenAILimiter
+
+_real_sleep = asyncio.sleep
+
+
+class FakeClock:
+    """monotonic() og sleep() for limiteren; tiden går bare når testen kaller advance()"""
+
+    def __init__(self, now=100.0):
+        self.now = now
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, delay):
+        wake_at = self.now + delay
+        while self.now < wake_at:
+            await _real_sleep(0)
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(openai_limiter, "time", types.SimpleNamespace(monotonic=clock.monotonic))
+    monkeypatch.setattr(openai_limiter, "asyncio", types.SimpleNamespace(sleep=clock.sleep, Lock=asyncio.Lock))
+    return clock
+
+
+async def settle(rounds=20):
+    for _ in range(rounds):
+        await _real_sleep(0)
+
+
+def http_error(status, headers=None):
+    request = httpx.Request("POST", "https://api.openai.com/v1/embeddings")
+    response = httpx.Response(status, headers=headers or {}, request=request)
+    return httpx.HTTPStatusError(f"{status}", request=request, response=response)
+
+
+def test_burst_of_429s_halves_the_limit_once(clock):
+    limiter = OpenAILimiter(initial_concurrency=8, max_retries=0, jitter=0.0)
+    pool = limiter.pools["chat"]
+
+    async def throttled():
+        raise http_error(429)
+
+    async def burst():
+        return await asyncio.gather(*(limiter.run(10, throttled, route="chat") for _ in range(6)), return_exceptions=True)
+
+    async def scenario():
+        results = await burst()
+        assert all(isinstance(result, httpx.HTTPStatusError) for result in results)
+        assert pool.concurrency.limit == 4
+        assert limiter.routes["chat"].throttled == 6
+
+        # Et nytt overtrekk etter cooldown halverer igjen
+        clock.advance(pool.concurrency.decrease_cooldown)
+        await burst()
+        assert pool.concurrency.limit == 2
+
+    asyncio.run(scenario())
+
+
+def test_success_grows_limit_additively(clock):
+    limiter = OpenAILimiter(initial_concurrency=4)
+
+    async def ok():
+        return "ok"
+
+    async def scenario():
+        for _ in range(4):
+            await limiter.run(10, ok, route="chat")
+
+    asyncio.run(scenario())
+    assert limiter.pools["chat"].concurrency.limit == pytest.approx(5.0, abs=0.1)
+
+
+def test_retry_after_pauses_the_whole_pool(clock):
+    limiter = OpenAILimiter(jitter=0.0)
+    calls = []
+
+    async def throttled_once():
+        calls.append(("chat", clock.now))
+        if len(calls) == 1:
+            raise http_error(429, {"retry-after": "2"})
+        return "svar"
+
+    async def other():
+        calls.append(("other", clock.now))
+        return "annet"
+
+    async def scenario():
+        first = asyncio.create_task(limiter.run(10, throttled_once, route="chat"))
+        await settle()
+        assert limiter.pools["chat"].paused_until == 102.0
+        second = asyncio.create_task(limiter.run(10, other, route="chat"))
+        await settle()
+        clock.advance(1.0)
+        await settle()
+        assert [name for name, _ in calls] == ["chat"]
+        clock.advance(1.0)
+        return await asyncio.gather(first, second)
+
+    assert asyncio.run(scenario()) == ["svar", "annet"]
+    assert all(at >= 102.0 for _, at in calls[1:])
+    assert limiter.routes["chat"].retries == 1
+
+
+def test_retry_after_ms_header_is_used(clock):
+    limiter = OpenAILimiter(jitter=0.0)
+    assert limiter._retry_delay(httpx.Headers({"retry-after-ms": "250"}), attempt=0) == 0.25
+    assert limiter._retry_delay(httpx.Headers({"retry-after": "3"}), attempt=0) == 3.0
+
+
+def test_non_retryable_errors_are_raised_immediately(clock):
+    limiter = OpenAILimiter()
+
+    async def bad_request():
+        raise http_error(400)
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(limiter.run(10, bad_request, route="chat"))
+    assert limiter.routes["chat"].retries == 0
+    assert limiter.routes["chat"].failures == 1
+
+
+def test_ingest_is_capped_at_its_share_while_queries_get_through(clock):
+    limiter = OpenAILimiter(embed_rpm=60, ingest_share=0.5, initial_concurrency=64, max_concurrency=64)
+    done = {"ingest": 0, "query": 0}
+
+    def counting(route):
+        async def call():
+            done[route] += 1
+        return call
+
+    async def scenario():
+        ingest = [asyncio.create_task(limiter.run(1, counting("ingest"), route="ingest")) for _ in range(40)]
+        await settle(200)
+        assert done["ingest"] == 30
+        await limiter.run(1, counting("query"), route="query")
+        assert done["query"] == 1
+        for task in ingest:
+            task.cancel()
+        await asyncio.gather(*ingest, return_exceptions=True)
+
+    asyncio.run(scenario())
+
+
+def test_observe_lowers_buckets_to_remaining_quota(clock):
+    limiter = OpenAILimiter(chat_rpm=100)
+    limiter.observe(httpx.Headers({"x-ratelimit-remaining-requests": "7"}), route="chat")
+    assert limiter.pools["chat"].requests.level == 7
+    limiter.observe(httpx.Headers({"x-ratelimit-remaining-requests": "70"}), route="chat")
+    assert limiter.pools["chat"].requests.level == 7
@@ -0,0 +1,117 @@
+import asyncio
+
+from priority_scheduler import BULK, INTERACTIVE, PriorityScheduler, route_class, work_route
+
+
+async def settle(rounds=5):
+    for _ in range(rounds):
+        await asyncio.sleep(0)
+
+
+def test_route_class_follows_work_route():
+    assert route_class("chat") == INTERACTIVE
+    assert route_class() == INTERACTIVE
+    with work_route("ingest"):
+        assert route_class() == BULK
+
+
+def test_waiting_interactive_goes_before_waiting_bulk():
+    async def scenario():
+        scheduler = PriorityScheduler("test", capacity=1, min_bulk_share=0.0)
+        order = []
+        await scheduler.acquire(BULK)
+
+        async def worker(cls, name):
+            await scheduler.acquire(cls)
+            order.append(name)
+
+        tasks = [asyncio.create_task(worker(BULK, "bulk")), asyncio.create_task(worker(INTERACTIVE, "chat"))]
+        await settle()
+        scheduler.release(BULK)
+        await settle()
+        scheduler.release(INTERACTIVE)
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(scenario()) == ["chat", "bulk"]
+
+
+def test_bulk_is_not_starved_by_constant_interactive_load():
+    async def scenario():
+        scheduler = PriorityScheduler("test", capacity=1, min_bulk_share=0.2, window=50)
+        granted = []
+
+        async def worker(cls):
+            await scheduler.acquire(cls)
+            granted.append(cls)
+            await asyncio.sleep(0)
+            scheduler.release(cls)
+
+        # Hele tiden mer interaktivt arbeid i køen enn det er plass til
+        tasks = [asyncio.create_task(worker(BULK)) for _ in range(50)]
+        tasks += [asyncio.create_task(worker(INTERACTIVE)) for _ in range(200)]
+        await asyncio.gather(*tasks)
+        return granted
+
+    granted = asyncio.run(scenario())
+    first_window = granted[:100]
+    assert first_window.count(BULK) >= 0.2 * len(first_window) - 1
+    assert granted.count(BULK) == 50
+
+
+def test_reserved_interactive_slot_holds_under_bulk_backlog():
+    async def scenario():
+        scheduler = PriorityScheduler("test", capacity=4, reserved_interactive=1)
+        bulk = [asyncio.create_task(scheduler.acquire(BULK)) for _ in range(10)]
+        await settle()
+        running_bulk, queued_bulk = scheduler.running[BULK], len(scheduler.queues[BULK])
+
+        chat = asyncio.create_task(scheduler.acquire(INTERACTIVE))
+        await settle()
+        chat_granted = chat.done()
+
+        for task in bulk:
+            task.cancel()
+        await asyncio.gather(*bulk, return_exceptions=True)
+        return running_bulk, queued_bulk, chat_granted
+
+    running_bulk, queued_bulk, chat_granted = asyncio.run(scenario())
+    assert running_bulk == 3
+    assert queued_bulk == 7
+    assert chat_granted
+
+
+def test_cancelled_waiter_does_not_leak_a_slot():
+    async def scenario():
+        scheduler = PriorityScheduler("test", capacity=1)
+        await scheduler.acquire(INTERACTIVE)
+        waiter = asyncio.create_task(scheduler.acquire(INTERACTIVE))
+        await settle()
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        scheduler.release(INTERACTIVE)
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert scheduler.in_flight == 0
+    assert not scheduler.queues[INTERACTIVE]
+
+
+def test_shrinking_capacity_lets_running_work_finish():
+    async def scenario():
+        scheduler = PriorityScheduler("test", capacity=4)
+        for _ in range(4):
+            await scheduler.acquire(INTERACTIVE)
+        scheduler.set_capacity(2)
+        waiter = asyncio.create_task(scheduler.acquire(INTERACTIVE))
+        await settle()
+        blocked = not waiter.done()
+        scheduler.release(INTERACTIVE)
+        scheduler.release(INTERACTIVE)
+        await settle()
+        blocked_at_limit = not waiter.done()
+        scheduler.release(INTERACTIVE)
+        await waiter
+        return blocked, blocked_at_limit
+
+    assert asyncio.run(scenario()) == (True, True)
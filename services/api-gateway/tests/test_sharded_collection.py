@@ -0,0 +1,77 @@
+import threading
+
+import numpy as np
+import pytest
+
+from in_memory_chroma import InMemoryClient
+from sharded_collection import ShardedCollection, ShardError
+
+
+def _fill(collection, documents=20, chunks=3):
+    rng = np.random.default_rng(0)
+    ids, embeddings, metadatas, texts = [], [], [], []
+    for doc in range(documents):
+        for chunk in range(chunks):
+            ids.append(f"doc{doc}_chunk_{chunk}")
+            embeddings.append(rng.normal(size=4).tolist())
+            metadatas.append({"doc_id": f"doc{doc}", "chunk_index": chunk})
+            texts.append(f"tekst {doc}/{chunk}")
+    collection.add(ids=ids, embeddings=embeddings, metadatas=metadatas, documents=texts)
+    return ids
+
+
+def test_add_shards_moves_only_documents_owned_by_new_shards():
+    collection = ShardedCollection(InMemoryClient(), "chunks", num_shards=2)
+    ids = _fill(collection)
+
+    result = collection.add_shards(2)
+
+    assert result["shards"] == 4
+    assert collection.count() == len(ids)
+    for shard_name, shard in collection.shards.items():
+        for metadata in shard.get()["metadatas"]:
+            assert collection.shard_for(metadata["doc_id"]).name == shard_name
+    assert sorted(collection.get(ids=ids)["ids"]) == sorted(ids)
+
+
+def test_queries_during_rebalance_see_every_chunk_exactly_once():
+    collection = ShardedCollection(InMemoryClient(add_delay=0.02), "chunks", num_shards=2)
+    ids = _fill(collection)
+    errors, seen = [], []
+    done = threading.Event()
+
+    def reader():
+        while not done.is_set():
+            try:
+                results = collection.query(query_embeddings=[[0.0, 0.0, 0.0, 0.0]], n_results=len(ids))
+                seen.append(sorted(results["ids"][0]))
+                assert sorted(collection.get(ids=ids, include=["metadatas"])["ids"]) == sorted(ids)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=reader) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    try:
+        collection.add_shards(3)
+    finally:
+        done.set()
+        for thread in threads:
+            thread.join()
+
+    assert errors == []
+    assert seen
+    assert all(row == sorted(ids) for row in seen)
+
+
+def test_shard_failure_is_raised_not_dropped():
+    collection = ShardedCollection(InMemoryClient(), "chunks", num_shards=2)
+    _fill(collection)
+    broken = next(iter(collection.shards.values()))
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("shard nede")
+
+    broken.query = fail
+    with pytest.raises(ShardError):
+        collection.query(query_embeddings=[[0.0, 0.0, 0.0, 0.0]], n_results=5)
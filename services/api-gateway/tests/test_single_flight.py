@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+
+from single_flight import SingleFlight, normalize_question
+
+
+def test_normalize_question():
+    assert normalize_question("  Hva er  standard BAUD rate?? ") == "hva er standard baud rate"
+    assert normalize_question("NEO-M8N.") == "neo-m8n"
+
+
+def test_make_key_ignores_wording_noise_but_not_filters_or_params():
+    key = SingleFlight.make_key("Hva er baud rate?", {"filename": "a.pdf"}, top_k=5)
+    assert key == SingleFlight.make_key("hva er   baud rate", {"filename": "a.pdf"}, top_k=5)
+    assert key != SingleFlight.make_key("hva er baud rate", {"filename": "b.pdf"}, top_k=5)
+    assert key != SingleFlight.make_key("hva er baud rate", {"filename": "a.pdf"}, top_k=10)
+
+
+def test_concurrent_calls_share_one_execution():
+    async def scenario():
+        flights = SingleFlight()
+        calls = 0
+
+        async def compute(flight):
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "svar"
+
+        key = flights.make_key("Hva er baud rate?")
+        results = await asyncio.gather(*(flights.run(key, compute) for _ in range(5)))
+        return flights, calls, results
+
+    flights, calls, results = asyncio.run(scenario())
+    assert calls == 1
+    assert results == ["svar"] * 5
+    stats = flights.stats()
+    assert stats["executions"] == 1
+    assert stats["coalesced"] == 4
+    assert stats["in_flight"] == 0
+
+
+def test_finished_results_are_not_cached():
+    async def scenario():
+        flights = SingleFlight()
+        calls = 0
+
+        async def compute(flight):
+            nonlocal calls
+            calls += 1
+            return calls
+
+        return [await flights.run("key", compute) for _ in range(2)]
+
+    assert asyncio.run(scenario()) == [1, 2]
+
+
+def test_late_subscriber_replays_published_tokens():
+    async def scenario():
+        flights = SingleFlight()
+        release = asyncio.Event()
+
+        async def compute(flight):
+            flight.publish("Hei")
+            await release.wait()
+            flight.publish(" der")
+            return "Hei der"
+
+        flight = flights.acquire("key", compute)
+        await asyncio.sleep(0)
+        late = flights.acquire("key", compute)
+        assert late is flight
+
+        async def collect():
+            return [token async for token in late.stream()]
+
+        collector = asyncio.create_task(collect())
+        await asyncio.sleep(0)
+        release.set()
+        tokens = await collector
+        await flight.task
+        return tokens
+
+    assert asyncio.run(scenario()) == ["Hei", " der"]
+
+
+def test_computation_cancelled_only_when_last_caller_leaves():
+    async def scenario():
+        flights = SingleFlight()
+
+        async def compute(flight):
+            await asyncio.sleep(10)
+
+        first = asyncio.create_task(flights.run("key", compute))
+        second = asyncio.create_task(flights.run("key", compute))
+        await asyncio.sleep(0)
+        flight = flights.flights["key"]
+
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        assert not flight.task.cancelled()
+
+        second.cancel()
+        await asyncio.gather(second, return_exceptions=True)
+        with pytest.raises(asyncio.CancelledError):
+            await flight.task
+        return flights
+
+    flights = asyncio.run(scenario())
+    assert flights.cancelled == 1
+    assert flights.stats()["in_flight"] == 0
@@ -0,0 +1,162 @@
+"""
+Session Working Set - oppfølgingsspørsmål rangeres mot forrige turs kandidater
+Et oppfølgingsspørsmål ("og hva med UART2-porten?") handler som regel om de samme
+dokumentene som forrige spørsmål. Per sesjon huskes kandidatene (chunk-id, metadata og
+embedding) fra siste ferske søk. Neste spørsmål rangeres først mot dem; bare når de
+dekker spørsmålet dårlig, kjøres et nytt søk i ChromaDB.
+
+Dekning måles relativt: snittlikheten til de beste treffene i working set, delt på den
+samme likheten forrige spørsmål hadde mot sine egne treff. Da fungerer terskelen likt
+for OpenAI- og MiniLM-embeddings.
+
+Minnet er begrenset av max_bytes, og working sets teller med i MemoryManager-budsjettet:
+ved minnepress krymper de (minst nylig brukte sesjoner først) før dokumenter offloades.
+"""
+
+import collections
+import json
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+HIT = "hit"
+MISS = "miss"
+
+
+def _normalize(vectors) -> np.ndarray:
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1.0, norms)
+
+
+class SessionWorkingSets:
+    """Kandidatene fra siste ferske søk per sesjon (LRU over sesjoner, med TTL)"""
+
+    def __init__(
+        self,
+        max_sessions: int = 1000,
+        ttl: float = 1800.0,
+        min_coverage: float = 0.9,
+        max_bytes: int = 64 * 1024 * 1024
+    ):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.min_coverage = min_coverage
+        self.max_bytes = max_bytes
+        self.sessions: "collections.OrderedDict[str, Dict[str, Any]]" = collections.OrderedDict()
+        self.bytes_used = 0
+        # Tellere for metrikker
+        self.hits = 0
+        self.misses = 0
+        self.refreshed = 0
+        self.evicted = 0
+
+    @staticmethod
+    def _filters_key(filters: Optional[Dict[str, Any]]) -> str:
+        return json.dumps(filters or {}, sort_keys=True, default=str)
+
+    def _drop(self, session_id: str):
+        entry = self.sessions.pop(session_id, None)
+        if entry is not None:
+            self.bytes_used -= entry["bytes"]
+
+    def shrink(self, target_bytes: int) -> int:
+        """Kaster minst nylig brukte sesjoner til bytes_used <= target_bytes; returnerer frigjorte bytes"""
+        before = self.bytes_used
+        while self.sessions and self.bytes_used > target_bytes:
+            self._drop(next(iter(self.sessions)))
+            self.evicted += 1
+        return before - self.bytes_used
+
+    def has(self, session_id: Optional[str]) -> bool:
+        entry = self.sessions.get(session_id) if session_id else None
+        return entry is not None and entry["expires_at"] > time.monotonic()
+
+    def remember(self, session_id: str, filters: Optional[Dict[str, Any]], results: Dict[str, list], top_k: int):
+        """Lagrer rad 0 av et ChromaDB query-svar (med embeddings) som sesjonens working set"""
+        if not results["ids"] or len(results["ids"][0]) == 0:
+            return
+        similarities = sorted((1 - distance for distance in results["distances"][0]), reverse=True)
+        entry = {
+            "filters_key": self._filters_key(filters),
+            "ids": list(results["ids"][0]),
+            "metadatas": list(results["metadatas"][0]),
+            "embeddings": _normalize(results["embeddings"][0]),
+            # Likheten forrige spørsmål hadde mot sine egne beste treff
+            "baseline": max(float(np.mean(similarities[:top_k])), 1e-6),
+            "expires_at": time.monotonic() + self.ttl
+        }
+        entry["bytes"] = (
+            entry["embeddings"].nbytes
+            + sum(len(chunk_id) for chunk_id in entry["ids"])
+            + len(json.dumps(entry["metadatas"], default=str))
+        )
+        self._drop(session_id)
+        self.sessions[session_id] = entry
+        self.bytes_used += entry["bytes"]
+        self.refreshed += 1
+        while len(self.sessions) > self.max_sessions:
+            self._drop(next(iter(self.sessions)))
+            self.evicted += 1
+        self.shrink(self.max_bytes)
+
+    def match(
+        self,
+        session_id: str,
+        query_embedding: List[float],
+        top_k: int,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> Tuple[Optional[Dict[str, list]], Dict[str, Any]]:
+        """
+        (resultater, info). Ved god nok dekning er resultatene working set rangert for
+        query_embedding, på samme form som et ChromaDB query-svar; ellers None.
+        info beskriver turen: status (hit/miss), reason, coverage og size.
+        """
+        entry = self.sessions.get(session_id)
+        if entry is None or entry["expires_at"] <= time.monotonic():
+            self._drop(session_id)
+            self.misses += 1
+            return None, {"status": MISS, "reason": "empty"}
+        if entry["filters_key"] != self._filters_key(filters):
+            self.misses += 1
+            return None, {"status": MISS, "reason": "filters_changed", "size": len(entry["ids"])}
+
+        similarities = entry["embeddings"] @ _normalize(query_embedding)
+        best = np.sort(similarities)[::-1][:top_k]
+        coverage = float(np.mean(best)) / entry["baseline"]
+        info = {"coverage": round(coverage, 3), "size": len(entry["ids"])}
+        if coverage < self.min_coverage:
+            self.misses += 1
+            return None, {"status": MISS, "reason": "weak_coverage", **info}
+
+        self.hits += 1
+        entry["expires_at"] = time.monotonic() + self.ttl
+        self.sessions.move_to_end(session_id)
+        order = np.argsort(-similarities)
+        results = {
+            "ids": [[entry["ids"][i] for i in order]],
+            "metadatas": [[entry["metadatas"][i] for i in order]],
+            "distances": [[float(1 - similarities[i]) for i in order]],
+            "embeddings": [[entry["embeddings"][i] for i in order]]
+        }
+        return results, {"status": HIT, **info}
+
+    def clear(self):
+        """Indeksen er endret - kandidatene (og embeddingene) kan være utdaterte"""
+        self.sessions.clear()
+        self.bytes_used = 0
+
+    def stats(self) -> Dict[str, Any]:
+        turns = self.hits + self.misses
+        return {
+            "sessions": len(self.sessions),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / turns, 3) if turns else 0.0,
+            "refreshed": self.refreshed,
+            "evicted": self.evicted,
+            "bytes": self.bytes_used,
+            "max_bytes": self.max_bytes,
+            "min_coverage": self.min_coverage
+        }
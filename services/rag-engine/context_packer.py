@@ -0,0 +1,139 @@
+"""
+Context Packer - bygger LLM-kontekst innenfor et token-budsjett
+Slår sammen nabo-chunks fra samme dokument, fjerner overlapp og fyller budsjettet grådig etter score.
+"""
+
+import logging
+from typing import List, Dict, Any, Optional
+
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+# Lastes første gang den trengs - tiktoken henter cl100k_base fra nett hvis den ikke er cachet
+_ENCODING = None
+
+
+def _encoding():
+    global _ENCODING
+    if _ENCODING is None:
+        _ENCODING = tiktoken.get_encoding("cl100k_base")
+    return _ENCODING
+
+
+def count_tokens(text: str) -> int:
+    """Teller tokens med samme encoding som chat-modellene"""
+    return len(_encoding().encode(text))
+
+
+def strip_overlap(previous: str, following: str, max_overlap: int = 400, min_overlap: int = 20) -> str:
+    """
+    Fjerner starten av following som allerede står på slutten av previous. Kortere
+    sammenfall enn min_overlap er tilfeldige ("se tabell 12" + "12 meldinger") og beholdes.
+    """
+    limit = min(max_overlap, len(previous), len(following))
+    for size in range(limit, max(min_overlap, 1) - 1, -1):
+        if previous.endswith(following[:size]):
+            return following[size:].lstrip()
+    return following
+
+
+def _format_block(filename: str, text: str) -> str:
+    return f"Fra {filename}:\n{text}"
+
+
+def _merge_adjacent(hits: List[Dict[str, Any]], max_overlap: int, min_overlap: int) -> List[Dict[str, Any]]:
+    """Slår sammen treff med påfølgende posisjon i samme dokument til blokker"""
+    blocks: List[Dict[str, Any]] = []
+    ordered = sorted(
+        hits,
+        key=lambda h: (str(h["source"]), h["position"] if h.get("position") is not None else -1)
+    )
+
+    for hit in ordered:
+        last = blocks[-1] if blocks else None
+        if (
+            last is not None
+            and hit.get("position") is not None
+            and last["source"] == hit["source"]
+            and last["positions"][-1] + 1 == hit["position"]
+        ):
+            last["text"] = f"{last['text']} {strip_overlap(last['text'], hit['text'], max_overlap, min_overlap)}".strip()
+            last["positions"].append(hit["position"])
+            last["score"] = max(last["score"], hit["score"])
+            continue
+
+        blocks.append({
+            "source": hit["source"],
+            "filename": hit["filename"],
+            "text": hit["text"],
+            "score": hit["score"],
+            "positions": [hit["position"]] if hit.get("position") is not None else []
+        })
+
+    return blocks
+
+
+def pack_context(
+    hits: List[Dict[str, Any]],
+    token_budget: int,
+    max_overlap: int = 400,
+    min_overlap: int = 20,
+    separator: str = "\n\n"
+) -> Dict[str, Any]:
+    """
+    Pakker søketreff inn i en kontekststreng som holder seg innenfor token_budget.
+
+    Hvert treff er en dict med text, score, source (dokument-id), filename og
+    position (chunk_index, eller None når rekkefølgen ikke er kjent).
+    """
+    if not hits:
+        return {"context": "", "blocks": [], "stats": {
+            "tokens_used": 0, "tokens_unpacked": 0, "tokens_saved": 0,
+            "chunks_in": 0, "chunks_merged": 0, "chunks_dropped": 0, "token_budget": token_budget
+        }}
+
+    # Det en naiv join av alle treffene ville kostet - grunnlaget for "saved"
+    tokens_unpacked = count_tokens(separator.join(_format_block(h["filename"], h["text"]) for h in hits))
+
+    blocks = _merge_adjacent(hits, max_overlap, min_overlap)
+    separator_tokens = count_tokens(separator)
+
+    packed: List[Dict[str, Any]] = []
+    tokens_used = 0
+    chunks_dropped = 0
+
+    for block in sorted(blocks, key=lambda b: b["score"], reverse=True):
+        block_text = _format_block(block["filename"], block["text"])
+        block_tokens = count_tokens(block_text) + (separator_tokens if packed else 0)
+
+        if tokens_used + block_tokens <= token_budget:
+            packed.append({**block, "context": block_text, "tokens": block_tokens})
+            tokens_used += block_tokens
+        elif not packed:
+            # Beste blokk alene er større enn budsjettet - ta med så mye som får plass
+            truncated = _encoding().decode(_encoding().encode(block_text)[:token_budget])
+            packed.append({**block, "context": truncated, "tokens": token_budget})
+            tokens_used = token_budget
+        else:
+            chunks_dropped += max(len(block["positions"]), 1)
+
+    stats = {
+        "tokens_used": tokens_used,
+        "tokens_unpacked": tokens_unpacked,
+        "tokens_saved": max(tokens_unpacked - tokens_used, 0),
+        "chunks_in": len(hits),
+        "chunks_merged": len(hits) - len(blocks),
+        "chunks_dropped": chunks_dropped,
+        "token_budget": token_budget
+    }
+    logger.info(
+        f"📦 Kontekst pakket: {tokens_used}/{token_budget} tokens "
+        f"(spart {stats['tokens_saved']}, slått sammen {stats['chunks_merged']}, droppet {chunks_dropped})"
+    )
+
+    return {
+        "context": separator.join(block["context"] for block in packed),
+        "blocks": packed,
+        "stats": stats
+    }
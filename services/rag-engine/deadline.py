@@ -0,0 +1,88 @@
+"""
+Deadline - tidsbudsjett for én forespørsel på tvers av trinnene i en chat-tur
+Fristen følger forespørselen fra API-et via rag-engine/gateway helt ned til LLM-kallet.
+Hvert trinn får det som er igjen (begrenset av sitt eget tak), og når tiden ikke
+strekker til degraderes trinnene i stedet for at hele forespørselen feiler.
+"""
+
+import asyncio
+import os
+import time
+from typing import Any, Awaitable, Dict, List, Optional
+
+# Legges til et svar som ble stoppet av fristen etter at brukeren har sett starten av det
+TRUNCATION_MARKER = " … [svaret ble avkortet]"
+
+
+def stage_budgets() -> Dict[str, int]:
+    """Tak og terskler per trinn i millisekunder (RAG_DEADLINE_MS og RAG_STAGE_*_MS)"""
+    return {
+        "deadline": int(os.getenv("RAG_DEADLINE_MS", "4000")),
+        # Maks tid for embedding av spørringen
+        "embed": int(os.getenv("RAG_STAGE_EMBED_MS", "800")),
+        # Maks tid for vektorsøket
+        "search": int(os.getenv("RAG_STAGE_SEARCH_MS", "1000")),
+        # Gjenstående tid som kreves for full k; ellers halveres k
+        "full_k": int(os.getenv("RAG_STAGE_FULL_K_MS", "2500")),
+        # Gjenstående tid som kreves for å kjøre MMR/rerank; ellers brukes rå vektorrekkefølge
+        "rerank": int(os.getenv("RAG_STAGE_RERANK_MS", "1800")),
+        # Gjenstående tid som kreves for å kalle LLM; ellers ekstraktivt svar
+        "llm": int(os.getenv("RAG_STAGE_LLM_MS", "1200")),
+    }
+
+
+class Deadline:
+    """Absolutt frist (monotonic) og listen over degraderinger som er gjort underveis"""
+
+    def __init__(self, budget_ms: Optional[float] = None):
+        self.budgets = stage_budgets()
+        self.budget_ms = float(budget_ms if budget_ms is not None else self.budgets["deadline"])
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + self.budget_ms / 1000
+        self.degradations: List[str] = []
+
+    def remaining(self) -> float:
+        """Sekunder igjen, aldri negativt"""
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def remaining_ms(self) -> int:
+        return int(self.remaining() * 1000)
+
+    def elapsed_ms(self) -> int:
+        return int((time.monotonic() - self.started_at) * 1000)
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def allows(self, stage: str) -> bool:
+        """Om det er nok tid igjen til å kjøre trinnet i full versjon"""
+        return self.remaining_ms() >= self.budgets[stage]
+
+    def stage_timeout(self, stage: Optional[str] = None, reserve_ms: int = 0) -> float:
+        """Timeout i sekunder for et trinn: trinnets tak, men aldri forbi fristen minus reserve"""
+        available = max(self.remaining_ms() - reserve_ms, 0)
+        if stage is not None:
+            available = min(available, self.budgets[stage])
+        return available / 1000
+
+    def degrade(self, name: str):
+        if name not in self.degradations:
+            self.degradations.append(name)
+
+    async def run(self, awaitable: Awaitable, stage: Optional[str] = None, reserve_ms: int = 0):
+        """Venter på awaitable innenfor trinnets budsjett; asyncio.TimeoutError når tiden er ute"""
+        timeout = self.stage_timeout(stage, reserve_ms)
+        if timeout <= 0:
+            if asyncio.iscoroutine(awaitable):
+                awaitable.close()
+            raise asyncio.TimeoutError()
+        return await asyncio.wait_for(awaitable, timeout)
+
+    def metadata(self) -> Dict[str, Any]:
+        return {
+            "budget_ms": int(self.budget_ms),
+            "elapsed_ms": self.elapsed_ms(),
+            "remaining_ms": self.remaining_ms(),
+            "degradations": list(self.degradations)
+        }
@@ -1,7 +1,8 @@
 """
 RAG Engine Service - Håndterer RAG-spørringer og AI-respons
 """
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
@@ -9,14 +10,35 @@ import logging
 import weaviate
 import openai
 import os
-from datetime import datetime
+from datetime import datetime, timezone
 import uuid
 import json
 import re
+import time
+import asyncio
+import hashlib
+import heapq
+import threading
+import numpy as np
 from urllib.parse import urlparse
-from weaviate.classes.config import Configure
+from weaviate.classes.config import Configure, Property, DataType
 from weaviate.classes.query import MetadataQuery, Filter
 
+from context_packer import pack_context
+from embedding_providers import create_embedding_provider
+from vector_index import vector_index_config, migrate_vector_index, current_compression, settings_from_env
+from deadline import TRUNCATION_MARKER, Deadline
+from disconnect import CLIENT_CLOSED_REQUEST, ClientDisconnected, cancel_on_disconnect
+from model_router import EXTRACTIVE, model_router_from_env
+from mmr import maximal_marginal_relevance
+
+try:
+    import msgpack
+except ImportError:  # Valgfri - uten msgpack svarer vi alltid med JSON
+    msgpack = None
+
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+
 # Konfigurer logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -53,17 +75,74 @@ except Exception as e:
     logger.error(f"Failed to connect to Weaviate: {e}")
     weaviate_client = None
 
+# "weaviate" lar text2vec-transformers lage vektorene; "onnx" lager samme MiniLM-vektorer
+# i prosess og sender dem som bring-your-own (ingen rundtur til transformers-inference)
+EMBEDDING_PROVIDER = os.getenv("RAG_EMBEDDING_PROVIDER", "weaviate").lower()
+embedding_provider = None
+if EMBEDDING_PROVIDER == "onnx":
+    try:
+        embedding_provider = create_embedding_provider("onnx")
+    except Exception as e:
+        logger.error(f"Failed to load ONNX embedding model, using Weaviate vectorizer: {e}")
+
+# MMR: over-hent kandidater og velg et variert sett (overlappende chunks gir lite ny kontekst)
+MMR_ENABLED = os.getenv("RAG_MMR_ENABLED", "true").lower() == "true"
+MMR_LAMBDA = float(os.getenv("RAG_MMR_LAMBDA", "0.7"))
+MMR_FETCH_MULTIPLIER = int(os.getenv("RAG_MMR_FETCH_MULTIPLIER", "4"))
+
+# Token-budsjett for konteksten som sendes til LLM
+CONTEXT_TOKEN_BUDGET = int(os.getenv("RAG_CONTEXT_TOKEN_BUDGET", "1500"))
+
+# Modellnivå per spørsmål: ekstraktivt svar, rask modell eller stor modell
+model_router = model_router_from_env()
+
+# To-trinns søk: "flat", "hierarchical" eller "auto" (hierarkisk når korpuset blir stort)
+RETRIEVAL_MODE = os.getenv("RAG_RETRIEVAL_MODE", "auto").lower()
+HIERARCHICAL_TOP_DOCS = int(os.getenv("RAG_HIERARCHICAL_TOP_DOCS", "5"))
+HIERARCHICAL_MIN_CHUNKS = int(os.getenv("RAG_HIERARCHICAL_MIN_CHUNKS", "20000"))
+_chunk_count_cache = {"value": 0, "checked_at": 0.0}
+
+# Chunks fordeles på flere Document-klasser etter hash av document_id; søk går til alle parallelt
+SHARD_COUNT = max(int(os.getenv("RAG_SHARD_COUNT", "1")), 1)
+
 class DocumentProcessRequest(BaseModel):
     document_id: str
     text: str
     filename: str
     metadata: Dict[str, Any] = {}
+    pages: Optional[List[str]] = None  # Tekst per side; gir sidenummer på hver chunk
+
+class QueryFilters(BaseModel):
+    document_id: Optional[str] = None
+    filename: Optional[str] = None
+    page_from: Optional[int] = None
+    page_to: Optional[int] = None
+    uploaded_after: Optional[datetime] = None
+    uploaded_before: Optional[datetime] = None
+
+class HistoryMessage(BaseModel):
+    role: str
+    content: str
+
+class ConversationHistory(BaseModel):
+    summary: str = ""  # Rullerende sammendrag av det som kom før recent
+    recent: List[HistoryMessage] = []  # De siste turene ordrett (avkortet av API-et)
+
+class SummarizeRequest(BaseModel):
+    summary: str = ""
+    messages: List[HistoryMessage]
+    max_chars: int = 1200
 
 class QueryRequest(BaseModel):
     question: str
     session_id: str = None
     include_sources: bool = True
     max_results: int = 5
+    mmr_lambda: Optional[float] = None
+    filters: Optional[QueryFilters] = None
+    retrieval_mode: Optional[str] = None
+    deadline_ms: Optional[int] = None  # Gjenstående tidsbudsjett fra kalleren; standard RAG_DEADLINE_MS
+    history: Optional[ConversationHistory] = None  # Samtalen så langt, med fast størrelse
 
 class DocumentSource(BaseModel):
     filename: str
@@ -94,27 +173,43 @@ async def process_document(request: DocumentProcessRequest):
         if not weaviate_client:
             raise HTTPException(status_code=503, detail="Weaviate ikke tilgjengelig")
         
-        # Split tekst i chunks
-        chunks = split_text_into_chunks(request.text, chunk_size=500, overlap=50)
+        # Split tekst i chunks (per side når sidene er kjent, slik at hver chunk får sidenummer)
+        if request.pages:
+            chunks = [
+                (page_number, chunk)
+                for page_number, page_text in enumerate(request.pages, start=1)
+                if page_text.strip()
+                for chunk in split_text_into_chunks(page_text, chunk_size=500, overlap=50)
+            ]
+        else:
+            chunks = [(None, chunk) for chunk in split_text_into_chunks(request.text, chunk_size=500, overlap=50)]
         
         # Opprett schema hvis det ikke eksisterer
         ensure_document_schema()
         
-        # Lagre chunks i Weaviate
-        documents = weaviate_client.collections.get("Document")
+        # Lagre chunks i sharden som eier dokumentet
+        documents = weaviate_client.collections.get(shard_for_document(request.document_id))
+        uploaded_at = datetime.now(timezone.utc)
+        
+        # Egne vektorer for alle chunks i ett kall når ONNX-provideren er aktiv
+        vectors = await embedding_provider.embed([chunk for _, chunk in chunks]) if embedding_provider else None
         
         # Individual insert instead of batch to avoid timeout
         successful_inserts = 0
-        for i, chunk in enumerate(chunks):
+        for i, (page_number, chunk) in enumerate(chunks):
             try:
-                documents.data.insert({
+                properties = {
                     "document_id": request.document_id,
                     "filename": request.filename,
                     "chunk_index": i,
                     "content": chunk,
                     "metadata": json.dumps(request.metadata),
-                    "created_at": datetime.utcnow().isoformat()
-                })
+                    "created_at": datetime.utcnow().isoformat(),
+                    "uploaded_at": uploaded_at
+                }
+                if page_number is not None:
+                    properties["page"] = page_number
+                documents.data.insert(properties, vector=vectors[i] if vectors else None)
                 successful_inserts += 1
             except Exception as e:
                 logger.error(f"Error storing chunk {i}: {e}")
@@ -122,6 +217,10 @@ async def process_document(request: DocumentProcessRequest):
         
         logger.info(f"Processed document {request.filename}: {successful_inserts}/{len(chunks)} chunks stored successfully")
         
+        # Dokument-vektor for trinn 1 i hierarkisk søk
+        if successful_inserts:
+            store_document_centroid(request.document_id, request.filename, uploaded_at)
+        
         return {
             "document_id": request.document_id,
             "chunks_created": successful_inserts,
@@ -134,9 +233,25 @@ async def process_document(request: DocumentProcessRequest):
         raise HTTPException(status_code=500, detail=f"Kunne ikke prosessere dokument: {str(e)}")
 
 @app.post("/query", response_model=QueryResponse)
-async def query_documents(request: QueryRequest):
-    """Gjør en RAG-spørring mot dokumentene"""
+async def query_documents(request: QueryRequest, http_request: Request):
+    """Gjør en RAG-spørring mot dokumentene; avbrytes hvis kalleren kobler fra"""
     
+    try:
+        result = await cancel_on_disconnect(http_request, answer_query(request))
+    except ClientDisconnected:
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+    return encode_response(result, http_request)
+
+def encode_response(result: BaseModel, http_request: Request):
+    """msgpack når kalleren ber om det (interne kall fra API-et), ellers vanlig JSON"""
+    if msgpack is None or MSGPACK_MEDIA_TYPE not in http_request.headers.get("accept", ""):
+        return result
+    return Response(content=msgpack.packb(jsonable_encoder(result)), media_type=MSGPACK_MEDIA_TYPE)
+
+async def answer_query(request: QueryRequest) -> QueryResponse:
+    """Søk og svar innenfor forespørselens frist"""
+    
+    deadline = Deadline(request.deadline_ms)
     try:
         # Hvis Weaviate ikke er tilgjengelig, gi fallback-svar
         if not weaviate_client:
@@ -146,19 +261,75 @@ async def query_documents(request: QueryRequest):
                 metadata={"fallback": True, "reason": "weaviate_unavailable"}
             )
         
+        # Lite tid igjen: færre chunks gir kortere prompt og raskere LLM-kall
+        max_results = request.max_results
+        if not deadline.allows("full_k"):
+            max_results = max(1, max_results // 2)
+            deadline.degrade("top_k_reduced")
+        
         # Søk i Weaviate
-        search_results = search_documents(request.question, max_results=request.max_results)
+        search_results = await search_documents(
+            request.question,
+            max_results=max_results,
+            mmr_lambda=request.mmr_lambda,
+            filters=request.filters,
+            retrieval_mode=request.retrieval_mode,
+            deadline=deadline
+        )
         
         # Hvis ingen relevante dokumenter funnet
         if not search_results:
             return QueryResponse(
                 answer=generate_fallback_answer(request.question),
                 sources=[],
-                metadata={"fallback": True, "reason": "no_relevant_documents"}
+                metadata={"fallback": True, "reason": "no_relevant_documents", "deadline": deadline.metadata()}
             )
         
-        # Generer svar med OpenAI (eller fallback)
-        answer = generate_answer_with_context(request.question, search_results)
+        # Pakk konteksten innenfor token-budsjettet (nabo-chunks slås sammen, overlapp fjernes)
+        packed = pack_context(
+            [
+                {
+                    "text": result["content"],
+                    "score": result["score"],
+                    "source": result["document_id"],
+                    "filename": result["filename"],
+                    "position": result.get("chunk_index")
+                }
+                for result in search_results
+            ],
+            token_budget=CONTEXT_TOKEN_BUDGET
+        )
+        
+        # Velg nivå: sikre oppslag besvares ekstraktivt, vanskelige spørsmål går til den store modellen
+        answer_started = time.perf_counter()
+        route = model_router.route(request.question, [
+            # Weaviate-certainty er (1 + cosinus) / 2; routeren forventer cosinus-likhet
+            {"text": result["content"], "score": 2 * result["score"] - 1, "filename": result["filename"], "page": result.get("page")}
+            for result in search_results
+        ])
+        tier = route["tier"]
+        
+        # Generer svar med OpenAI (eller fallback); uten nok tid igjen svares det ekstraktivt
+        if tier == EXTRACTIVE:
+            answer = route["answer"]
+        elif deadline.allows("llm"):
+            # Tråden kan ikke kanselleres, men lukker OpenAI-strømmen ved neste token når cancelled settes
+            cancelled = threading.Event()
+            try:
+                answer = await asyncio.to_thread(
+                    generate_answer_with_context,
+                    request.question, search_results, packed["context"], deadline, cancelled, route["model"], request.history
+                )
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+        else:
+            deadline.degrade("extractive_answer")
+            tier = EXTRACTIVE
+            answer = generate_contextual_fallback(request.question, search_results)
+        model_router.record(tier, time.perf_counter() - answer_started)
+        if deadline.degradations:
+            logger.info(f"Query degraded within {deadline.budget_ms:.0f}ms: {', '.join(deadline.degradations)}")
         
         # Formater kilder
         sources = [
@@ -176,7 +347,10 @@ async def query_documents(request: QueryRequest):
             sources=sources,
             metadata={
                 "total_results": len(search_results),
-                "query_timestamp": datetime.utcnow().isoformat()
+                "query_timestamp": datetime.utcnow().isoformat(),
+                "context": packed["stats"],
+                "routing": {key: value for key, value in route.items() if key != "answer"},
+                "deadline": deadline.metadata()
             }
         )
         
@@ -185,7 +359,7 @@ async def query_documents(request: QueryRequest):
         return QueryResponse(
             answer=generate_fallback_answer(request.question),
             sources=[],
-            metadata={"fallback": True, "error": str(e)}
+            metadata={"fallback": True, "error": str(e), "deadline": deadline.metadata()}
         )
 
 def split_text_into_chunks(text: str, chunk_size: int = 500, overlap: int = 50) -> List[str]:
@@ -225,20 +399,53 @@ def split_text_into_chunks(text: str, chunk_size: int = 500, overlap: int = 50)
     
     return chunks
 
+# Egenskaper som er lagt til etter at Document-klassen først ble opprettet
+DOCUMENT_FILTER_PROPERTIES = [
+    Property(name="page", data_type=DataType.INT, description="Page number the chunk was taken from"),
+    Property(name="uploaded_at", data_type=DataType.DATE, description="Upload timestamp for date filters"),
+]
+
+def document_shard_names() -> List[str]:
+    """Navnene på Document-shardene; shard 0 beholder det opprinnelige klassenavnet"""
+    return ["Document"] + [f"Document_shard_{i}" for i in range(1, SHARD_COUNT)]
+
+def _shard_weight(document_id: str, shard_name: str) -> int:
+    digest = hashlib.blake2b(f"{shard_name}:{document_id}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+def shard_for_document(document_id: str) -> str:
+    """Rendezvous-hashing: en ny shard tar bare over ~1/N av dokumentene"""
+    return max(document_shard_names(), key=lambda shard_name: _shard_weight(document_id, shard_name))
+
 def ensure_document_schema():
-    """Sørg for at Weaviate schema eksisterer"""
+    """Sørg for at Weaviate schema eksisterer for alle shards"""
     
     try:
-        # Sjekk om klassen allerede eksisterer
-        if weaviate_client.collections.exists("Document"):
-            logger.info("Document schema already exists")
-            return
+        created = []
+        for shard_name in document_shard_names():
+            # Sjekk om klassen allerede eksisterer
+            if weaviate_client.collections.exists(shard_name):
+                migrate_document_schema(shard_name)
+                continue
+            if create_document_collection(shard_name):
+                created.append(shard_name)
+        
+        # Nye shards ved siden av eksisterende data: flytt dokumentene som nå hører til dem
+        if created and len(created) < SHARD_COUNT:
+            rebalance_document_shards()
             
-        # Opprett Document-klassen med v4 API
+    except Exception as e:
+        logger.error(f"Schema creation error: {e}")
+
+def create_document_collection(name: str) -> bool:
+    """Opprett en Document-klasse med v4 API"""
+    
+    try:
         weaviate_client.collections.create(
-            name="Document",
+            name=name,
             description="Document chunks for RAG system",
             vectorizer_config=Configure.Vectorizer.text2vec_transformers(),
+            vector_index_config=vector_index_config(),
             properties=[
                 {
                     "name": "document_id",
@@ -269,71 +476,391 @@ def ensure_document_schema():
                     "name": "created_at",
                     "dataType": ["text"],
                     "description": "Creation timestamp"
+                },
+                {
+                    "name": "page",
+                    "dataType": ["int"],
+                    "description": "Page number the chunk was taken from"
+                },
+                {
+                    "name": "uploaded_at",
+                    "dataType": ["date"],
+                    "description": "Upload timestamp for date filters"
                 }
             ]
         )
-        logger.info("Created Document schema in Weaviate")
+        logger.info(f"Created {name} schema in Weaviate")
+        return True
             
     except Exception as e:
         logger.error(f"Schema creation error: {e}")
+        return False
+
+def migrate_document_schema(name: str = "Document"):
+    """Legg til filter-egenskaper på en Document-klasse som ble opprettet før de fantes"""
+    
+    try:
+        documents = weaviate_client.collections.get(name)
+        existing = {prop.name for prop in documents.config.get().properties}
+        for prop in DOCUMENT_FILTER_PROPERTIES:
+            if prop.name not in existing:
+                documents.config.add_property(prop)
+                logger.info(f"Added property {prop.name} to {name} schema")
+        # Kompresjon og ef følger RAG_VECTOR_COMPRESSION / RAG_HNSW_* også for eksisterende klasser
+        migrate_vector_index(documents)
+    except Exception as e:
+        logger.error(f"Schema migration error: {e}")
+
+def rebalance_document_shards() -> Dict[str, int]:
+    """Flytt chunks som ligger i feil shard (etter at RAG_SHARD_COUNT er økt) til riktig shard"""
+    
+    moved_chunks = 0
+    moved_documents = set()
+    for shard_name in document_shard_names():
+        if not weaviate_client.collections.exists(shard_name):
+            continue
+        source = weaviate_client.collections.get(shard_name)
+        misplaced = [
+            obj for obj in source.iterator(include_vector=True)
+            if shard_for_document(obj.properties.get("document_id", "")) != shard_name
+        ]
+        for obj in misplaced:
+            try:
+                owner = shard_for_document(obj.properties.get("document_id", ""))
+                # Samme uuid og vektor i ny shard, så slettes originalen
+                weaviate_client.collections.get(owner).data.insert(
+                    properties=obj.properties,
+                    vector=_object_vector(obj),
+                    uuid=obj.uuid
+                )
+                source.data.delete_by_id(obj.uuid)
+                moved_chunks += 1
+                moved_documents.add(obj.properties.get("document_id"))
+            except Exception as e:
+                logger.error(f"Error moving chunk {obj.uuid} from {shard_name}: {e}")
+    
+    logger.info(f"Rebalanced {SHARD_COUNT} shards: moved {len(moved_documents)} documents ({moved_chunks} chunks)")
+    return {"shards": SHARD_COUNT, "moved_documents": len(moved_documents), "moved_chunks": moved_chunks}
+
+def build_weaviate_filter(filters: Optional[QueryFilters], include_pages: bool = True, extra: Optional[List] = None):
+    """Oversett søkefiltre til et Weaviate Filter som kjøres sammen med ANN-søket"""
+    
+    conditions = list(extra or [])
+    if filters is not None:
+        if filters.document_id:
+            conditions.append(Filter.by_property("document_id").equal(filters.document_id))
+        if filters.filename:
+            conditions.append(Filter.by_property("filename").equal(filters.filename))
+        if include_pages and filters.page_from is not None:
+            conditions.append(Filter.by_property("page").greater_or_equal(filters.page_from))
+        if include_pages and filters.page_to is not None:
+            conditions.append(Filter.by_property("page").less_or_equal(filters.page_to))
+        if filters.uploaded_after is not None:
+            conditions.append(Filter.by_property("uploaded_at").greater_or_equal(_as_utc(filters.uploaded_after)))
+        if filters.uploaded_before is not None:
+            conditions.append(Filter.by_property("uploaded_at").less_or_equal(_as_utc(filters.uploaded_before)))
+    
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else Filter.all_of(conditions)
+
+def _as_utc(value: datetime) -> datetime:
+    """Weaviate krever tidssone på date-filtre"""
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
 
-def search_documents(query: str, max_results: int = 5) -> List[Dict]:
-    """Søk i dokumenter med Weaviate"""
+def ensure_summary_schema():
+    """Sørg for at DocumentSummary-klassen (én vektor per dokument) eksisterer"""
     
     try:
-        # Get collection
-        documents = weaviate_client.collections.get("Document")
-        
-        # Perform nearText search with v4 API
-        result = documents.query.near_text(
-            query=query,
-            limit=max_results,
-            return_metadata=MetadataQuery(certainty=True)
+        if weaviate_client.collections.exists("DocumentSummary"):
+            return
+        
+        # Samme vectorizer som Document, slik at near_text-spørringer havner i samme vektorrom.
+        # Vektorene settes eksplisitt (centroid av chunkene) ved insert.
+        weaviate_client.collections.create(
+            name="DocumentSummary",
+            description="Document-level centroid vectors for two-stage retrieval",
+            vectorizer_config=Configure.Vectorizer.text2vec_transformers(),
+            properties=[
+                {
+                    "name": "document_id",
+                    "dataType": ["text"],
+                    "description": "Unique document identifier"
+                },
+                {
+                    "name": "filename",
+                    "dataType": ["text"],
+                    "description": "Original filename"
+                },
+                {
+                    "name": "chunk_count",
+                    "dataType": ["int"],
+                    "description": "Number of chunks in the document"
+                },
+                {
+                    "name": "uploaded_at",
+                    "dataType": ["date"],
+                    "description": "Upload timestamp for date filters"
+                }
+            ]
+        )
+        logger.info("Created DocumentSummary schema in Weaviate")
+        
+    except Exception as e:
+        logger.error(f"Summary schema creation error: {e}")
+
+def _object_vector(obj) -> List[float]:
+    """Hent standardvektoren fra et Weaviate-objekt (v4 returnerer navngitte vektorer som dict)"""
+    return obj.vector.get("default") if isinstance(obj.vector, dict) else obj.vector
+
+def store_document_centroid(document_id: str, filename: str, uploaded_at: datetime):
+    """Beregn gjennomsnittsvektoren av dokumentets chunks og lagre den i DocumentSummary"""
+    
+    try:
+        ensure_summary_schema()
+        documents = weaviate_client.collections.get(shard_for_document(document_id))
+        summaries = weaviate_client.collections.get("DocumentSummary")
+        
+        chunks = documents.query.fetch_objects(
+            filters=Filter.by_property("document_id").equal(document_id),
+            include_vector=True,
+            limit=10000
+        )
+        vectors = [_object_vector(obj) for obj in chunks.objects]
+        if not vectors:
+            return
+        
+        centroid = np.mean(np.asarray(vectors, dtype=np.float32), axis=0)
+        norm = np.linalg.norm(centroid)
+        if norm > 0:
+            centroid = centroid / norm
+        
+        summaries.data.delete_many(where=Filter.by_property("document_id").equal(document_id))
+        summaries.data.insert(
+            properties={
+                "document_id": document_id,
+                "filename": filename,
+                "chunk_count": len(vectors),
+                "uploaded_at": uploaded_at
+            },
+            vector=centroid.tolist()
+        )
+        logger.info(f"Stored centroid for {filename} ({len(vectors)} chunks)")
+        
+    except Exception as e:
+        logger.error(f"Centroid storage error: {e}")
+
+def use_hierarchical_retrieval(retrieval_mode: Optional[str], filters: Optional[QueryFilters]) -> bool:
+    """Avgjør om søket skal gå via dokument-vektorene først"""
+    
+    mode = (retrieval_mode or RETRIEVAL_MODE).lower()
+    if filters is not None and filters.document_id:
+        return False  # Allerede begrenset til ett dokument
+    if mode == "hierarchical":
+        return True
+    if mode != "auto":
+        return False
+    
+    # Antall chunks caches et minutt for å slippe et aggregate-kall per spørring
+    if time.time() - _chunk_count_cache["checked_at"] > 60:
+        try:
+            _chunk_count_cache["value"] = sum(
+                weaviate_client.collections.get(shard_name).aggregate.over_all(total_count=True).total_count or 0
+                for shard_name in document_shard_names()
+                if weaviate_client.collections.exists(shard_name)
+            )
+        except Exception as e:
+            logger.error(f"Chunk count error: {e}")
+        _chunk_count_cache["checked_at"] = time.time()
+    return _chunk_count_cache["value"] >= HIERARCHICAL_MIN_CHUNKS
+
+def select_documents(query: str, filters: Optional[QueryFilters], query_vector: Optional[List[float]] = None) -> List[str]:
+    """Trinn 1: finn de mest relevante dokumentene via DocumentSummary"""
+    
+    if not weaviate_client.collections.exists("DocumentSummary"):
+        return []
+    
+    summaries = weaviate_client.collections.get("DocumentSummary")
+    search_args = dict(
+        limit=HIERARCHICAL_TOP_DOCS,
+        filters=build_weaviate_filter(filters, include_pages=False),
+        return_properties=["document_id"]
+    )
+    if query_vector is not None:
+        result = summaries.query.near_vector(near_vector=query_vector, **search_args)
+    else:
+        result = summaries.query.near_text(query=query, **search_args)
+    return [obj.properties.get("document_id") for obj in result.objects if obj.properties.get("document_id")]
+
+def search_shard(
+    shard_name: str,
+    query: str,
+    limit: int,
+    weaviate_filter,
+    include_vector: bool,
+    query_vector: Optional[List[float]] = None
+) -> List:
+    """Vektorsøk i én shard; en shard som feiler gir ingen treff i stedet for å felle hele søket"""
+    
+    try:
+        if not weaviate_client.collections.exists(shard_name):
+            return []
+        shard = weaviate_client.collections.get(shard_name)
+        search_args = dict(
+            limit=limit,
+            filters=weaviate_filter,
+            return_metadata=MetadataQuery(certainty=True),
+            include_vector=include_vector
+        )
+        if query_vector is not None:
+            result = shard.query.near_vector(near_vector=query_vector, **search_args)
+        else:
+            result = shard.query.near_text(query=query, **search_args)
+        return result.objects
+    except Exception as e:
+        logger.error(f"Search error in shard {shard_name}: {e}")
+        return []
+
+async def search_documents(
+    query: str,
+    max_results: int = 5,
+    mmr_lambda: Optional[float] = None,
+    filters: Optional[QueryFilters] = None,
+    retrieval_mode: Optional[str] = None,
+    deadline: Optional[Deadline] = None
+) -> List[Dict]:
+    """
+    Søk i dokumenter med Weaviate.
+
+    Med en deadline har embedding og shard-søket hvert sitt trinnbudsjett, og MMR
+    hoppes over når det ikke er nok tid igjen. Degraderingene registreres på deadline.
+    """
+    
+    try:
+        # Med lokal provider embeddes spørringen én gang her i stedet for i hver shard
+        query_vector = None
+        if embedding_provider:
+            try:
+                if deadline is not None:
+                    query_vector = (await deadline.run(embedding_provider.embed([query]), "embed"))[0]
+                else:
+                    query_vector = (await embedding_provider.embed([query]))[0]
+            except asyncio.TimeoutError:
+                if deadline is None:
+                    raise
+                # Weaviate-vektoriseringen tar over (near_text)
+                deadline.degrade("local_embedding_skipped")
+        
+        use_mmr = MMR_ENABLED
+        if use_mmr and deadline is not None and not deadline.allows("rerank"):
+            use_mmr = False
+            deadline.degrade("rerank_skipped")
+        
+        # To-trinns søk: begrens chunk-søket til de mest relevante dokumentene
+        document_scope = []
+        if use_hierarchical_retrieval(retrieval_mode, filters):
+            doc_ids = select_documents(query, filters, query_vector)
+            if doc_ids:
+                document_scope.append(Filter.by_property("document_id").contains_any(doc_ids))
+                logger.info(f"Hierarchical search scoped to {len(doc_ids)} documents")
+        
+        # Scatter-gather: vektorsøk i alle shards parallelt (vektorer trengs for MMR, filtre kjøres i Weaviate)
+        limit = max_results * MMR_FETCH_MULTIPLIER if use_mmr else max_results
+        weaviate_filter = build_weaviate_filter(filters, extra=document_scope)
+        shard_searches = asyncio.gather(*[
+            asyncio.to_thread(search_shard, shard_name, query, limit, weaviate_filter, use_mmr, query_vector)
+            for shard_name in document_shard_names()
+        ])
+        if deadline is not None:
+            try:
+                per_shard = await deadline.run(shard_searches, "search")
+            except asyncio.TimeoutError:
+                deadline.degrade("search_timeout")
+                logger.warning("Shard search exceeded its deadline budget")
+                return []
+        else:
+            per_shard = await shard_searches
+        # Flett topp-k fra hver shard til global topp-k
+        merged = heapq.nlargest(
+            limit,
+            (obj for objects in per_shard for obj in objects),
+            key=lambda obj: obj.metadata.certainty or 0.0
         )
         
         # Formater resultater
         formatted_results = []
-        for doc in result.objects:
+        vectors = []
+        for doc in merged:
             try:
                 formatted_results.append({
                     "document_id": doc.properties.get("document_id", ""),
                     "filename": doc.properties.get("filename", "Ukjent"),
+                    "chunk_index": doc.properties.get("chunk_index"),
+                    "page": doc.properties.get("page"),
                     "content": doc.properties.get("content", ""),
                     "score": doc.metadata.certainty if doc.metadata.certainty else 0.0,
                     "metadata": json.loads(doc.properties.get("metadata", "{}"))
                 })
+                if use_mmr:
+                    vectors.append(_object_vector(doc))
             except Exception as e:
                 logger.error(f"Error formatting search result: {e}")
                 continue
         
+        if use_mmr and len(formatted_results) > max_results:
+            selected = maximal_marginal_relevance(
+                vectors,
+                [r["score"] for r in formatted_results],
+                max_results,
+                MMR_LAMBDA if mmr_lambda is None else mmr_lambda
+            )
+            formatted_results = [formatted_results[i] for i in selected]
+        
         return formatted_results
         
     except Exception as e:
         logger.error(f"Search error: {e}")
         return []
 
-def generate_answer_with_context(question: str, context_docs: List[Dict]) -> str:
-    """Generer svar med OpenAI basert på kontekst"""
+def generate_answer_with_context(
+    question: str,
+    context_docs: List[Dict],
+    context: Optional[str] = None,
+    deadline: Optional[Deadline] = None,
+    cancelled: Optional[threading.Event] = None,
+    model: Optional[str] = None,
+    history: Optional[ConversationHistory] = None
+) -> str:
+    """
+    Generer svar med OpenAI basert på kontekst; innenfor deadline hvis den er gitt.
+    Svaret strømmes, så en avbrutt forespørsel (cancelled) stopper genereringen.
+    model er modellen routeren valgte (standard: den raske modellen). history
+    (sammendrag + siste turer) gjør at oppfølgingsspørsmål forstås.
+    """
     
     # Hvis OpenAI ikke er konfigurert, bruk fallback
     if openai.api_key == "demo-key":
         return generate_contextual_fallback(question, context_docs)
     
+    parts: List[str] = []
     try:
-        # Bygg kontekst fra dokumenter
-        context = "\n\n".join([
-            f"Fra {doc['filename']}:\n{doc['content']}"
-            for doc in context_docs[:3]
-        ])
+        # Bygg kontekst fra dokumenter hvis den ikke allerede er pakket
+        if context is None:
+            context = "\n\n".join([
+                f"Fra {doc['filename']}:\n{doc['content']}"
+                for doc in context_docs[:3]
+            ])
         
         # OpenAI prompt med ny API
         from openai import OpenAI
-        client = OpenAI(api_key=openai.api_key)
+        # Med en frist er det ikke tid til automatiske retries
+        client = OpenAI(api_key=openai.api_key, max_retries=0 if deadline is not None else 2)
         
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
+        stream = client.chat.completions.create(
+            model=model or model_router.fast_model,
             messages=[
                 {"role": "system", "content": "Du er en teknisk ekspert på GPS/GNSS og u-blox moduler. Svar på norsk basert på gitt dokumentasjon."},
+                *history_messages(history),
                 {"role": "user", "content": f"""Basert på følgende dokumenter, svar på spørsmålet på norsk. Vær spesifikk og teknisk korrekt.
 
 Dokumenter:
@@ -342,15 +869,61 @@ Dokumenter:
 Spørsmål: {question}"""}
             ],
             max_tokens=500,
-            temperature=0.3
+            temperature=0.3,
+            stream=True,
+            **({"timeout": deadline.stage_timeout()} if deadline is not None else {})
         )
         
-        return response.choices[0].message.content.strip()
+        truncated = False
+        try:
+            for chunk in stream:
+                if cancelled is not None and cancelled.is_set():
+                    logger.info("Query cancelled, closing OpenAI stream")
+                    break
+                # timeout over gjelder hver lesing, ikke hele strømmen - fristen sjekkes per chunk
+                if deadline is not None and deadline.expired:
+                    truncated = True
+                    break
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+        finally:
+            stream.close()
+        
+        if truncated:
+            deadline.degrade("llm_timeout")
+            if not parts:
+                deadline.degrade("extractive_answer")
+                return generate_contextual_fallback(question, context_docs)
+            logger.warning(f"Deadline reached during generation, truncating answer after {len(parts)} chunks")
+            deadline.degrade("llm_truncated")
+            return "".join(parts).strip() + TRUNCATION_MARKER
+        
+        return "".join(parts).strip()
         
     except Exception as e:
         logger.error(f"OpenAI error: {e}")
+        # En lesing som timer ut midt i strømmen - behold det som allerede er generert
+        if parts and deadline is not None:
+            deadline.degrade("llm_truncated")
+            return "".join(parts).strip() + TRUNCATION_MARKER
+        if deadline is not None:
+            deadline.degrade("extractive_answer")
         return generate_contextual_fallback(question, context_docs)
 
+def history_messages(history: Optional[ConversationHistory]) -> List[Dict[str, str]]:
+    """Sammendraget som system-melding og de siste turene som egne meldinger"""
+    if history is None:
+        return []
+    messages = []
+    if history.summary:
+        messages.append({"role": "system", "content": f"Sammendrag av samtalen så langt:\n{history.summary}"})
+    messages.extend(
+        {"role": message.role, "content": message.content}
+        for message in history.recent
+        if message.role in ("user", "assistant")
+    )
+    return messages
+
 def generate_contextual_fallback(question: str, context_docs: List[Dict]) -> str:
     """Generer svar basert på kontekst-dokumenter uten OpenAI"""
     
@@ -396,17 +969,20 @@ async def list_processed_documents():
         return {"documents": [], "status": "weaviate_unavailable"}
     
     try:
-        documents_collection = weaviate_client.collections.get("Document")
-        
-        # Get all documents with v4 API
-        result = documents_collection.query.fetch_objects(
-            limit=1000,
-            return_properties=["document_id", "filename"]
-        )
+        # Get all documents with v4 API, fra alle shards
+        objects = []
+        for shard_name in document_shard_names():
+            if not weaviate_client.collections.exists(shard_name):
+                continue
+            result = weaviate_client.collections.get(shard_name).query.fetch_objects(
+                limit=1000,
+                return_properties=["document_id", "filename"]
+            )
+            objects.extend(result.objects)
         
         # Group by document_id and filename
         documents_dict = {}
-        for obj in result.objects:
+        for obj in objects:
             doc_id = obj.properties.get("document_id")
             filename = obj.properties.get("filename")
             key = f"{doc_id}|{filename}"
@@ -434,12 +1010,16 @@ async def delete_processed_document(document_id: str):
         raise HTTPException(status_code=503, detail="Weaviate ikke tilgjengelig")
     
     try:
-        documents_collection = weaviate_client.collections.get("Document")
+        documents_collection = weaviate_client.collections.get(shard_for_document(document_id))
         
         # Delete all chunks for the document with v4 API
         documents_collection.data.delete_many(
             where=Filter.by_property("document_id").equal(document_id)
         )
+        if weaviate_client.collections.exists("DocumentSummary"):
+            weaviate_client.collections.get("DocumentSummary").data.delete_many(
+                where=Filter.by_property("document_id").equal(document_id)
+            )
         
         return {"message": f"Dokument {document_id} slettet fra RAG-systemet"}
         
@@ -447,6 +1027,81 @@ async def delete_processed_document(document_id: str):
         logger.error(f"Delete document error: {e}")
         raise HTTPException(status_code=500, detail="Kunne ikke slette dokument")
 
+@app.post("/summarize")
+async def summarize_conversation(request: SummarizeRequest):
+    """
+    Folder nye meldinger inn i et eksisterende samtalesammendrag (kalles i bakgrunnen
+    av API-et). 503 uten OpenAI - da komprimerer API-et selv.
+    """
+    if openai.api_key == "demo-key":
+        raise HTTPException(status_code=503, detail="OpenAI er ikke konfigurert")
+    
+    transcript = "\n".join(f"{message.role}: {message.content}" for message in request.messages)
+    from openai import AsyncOpenAI
+    client = AsyncOpenAI(api_key=openai.api_key)
+    completion = await client.chat.completions.create(
+        model=model_router.fast_model,
+        messages=[
+            {"role": "system", "content": (
+                "Du oppdaterer et kort sammendrag av en teknisk samtale om GPS/GNSS. Behold spørsmål, "
+                f"modellnavn, innstillinger og konklusjoner. Svar bare med sammendraget, høyst {request.max_chars} tegn."
+            )},
+            {"role": "user", "content": f"Sammendrag så langt:\n{request.summary or '(tomt)'}\n\nNye meldinger:\n{transcript}"}
+        ],
+        max_tokens=max(request.max_chars // 3, 64),
+        temperature=0.2
+    )
+    summary = (completion.choices[0].message.content or "").strip()
+    return {"summary": summary[:request.max_chars]}
+
+@app.get("/routing")
+async def routing_stats():
+    """Andel og svartid per modellnivå (extractive, fast, strong)"""
+    return model_router.stats()
+
+@app.get("/shards")
+async def shard_stats():
+    """Antall chunks per Document-shard"""
+    
+    if not weaviate_client:
+        raise HTTPException(status_code=503, detail="Weaviate ikke tilgjengelig")
+    
+    return {"shards": {
+        shard_name: weaviate_client.collections.get(shard_name).aggregate.over_all(total_count=True).total_count or 0
+        for shard_name in document_shard_names()
+        if weaviate_client.collections.exists(shard_name)
+    }}
+
+@app.get("/schema/vector-index")
+async def vector_index_status():
+    """Ønsket og faktisk HNSW-/kompresjonsoppsett per Document-shard"""
+    
+    if not weaviate_client:
+        raise HTTPException(status_code=503, detail="Weaviate ikke tilgjengelig")
+    
+    shards = {}
+    for shard_name in document_shard_names():
+        if not weaviate_client.collections.exists(shard_name):
+            continue
+        index_config = weaviate_client.collections.get(shard_name).config.get().vector_index_config
+        shards[shard_name] = {
+            "compression": current_compression(index_config),
+            "ef": index_config.ef,
+            "ef_construction": index_config.ef_construction,
+            "max_connections": index_config.max_connections
+        }
+    return {"desired": settings_from_env(), "shards": shards}
+
+@app.post("/shards/rebalance")
+async def rebalance_shards():
+    """Opprett manglende shards og flytt dokumenter til sharden som eier dem"""
+    
+    if not weaviate_client:
+        raise HTTPException(status_code=503, detail="Weaviate ikke tilgjengelig")
+    
+    ensure_document_schema()
+    return await asyncio.to_thread(rebalance_document_shards)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8002) 
\ No newline at end of file
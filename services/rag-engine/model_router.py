@@ -0,0 +1,231 @@
+"""
+Model Router - velger billigste nivå som kan svare godt nok
+Hvert spørsmål scores ut fra spørsmålstype (oppslag, generelt, sammenstilling), lengde
+og hvor sikkert søket er. Tre nivåer:
+
+- extractive: oppslagsspørsmål ("default baud rate for NEO-M8") med et sikkert treff
+  besvares med de beste setningene fra treffet - millisekunder, ingen LLM
+- fast: vanlige spørsmål går til en rask, billig modell
+- strong: sammenstilling, lange spørsmål eller usikre treff går til den store modellen
+
+Treffene gis som dicts med text, score (cosinus-likhet), filename og page. Treff uten
+en ekte cosinus (eksakte identifikatortreff) har score None; de gjør søket "sikkert" bare
+når exact er satt, dvs. at treffet inneholder alle identifikatorene i spørsmålet.
+Svartid og andel per nivå rapporteres av stats().
+"""
+
+import collections
+import os
+import re
+from typing import Any, Dict, List, Optional
+
+EXTRACTIVE = "extractive"
+FAST = "fast"
+STRONG = "strong"
+TIERS = (EXTRACTIVE, FAST, STRONG)
+
+LOOKUP = "lookup"
+GENERAL = "general"
+SYNTHESIS = "synthesis"
+
+_LOOKUP_PATTERN = re.compile(
+    r"\b(hva er|hva var|hvilken|hvilke|hvor mange|hvor mye|hvor stor|hvor lang|hvor høy|"
+    r"standard|default|verdi|what is|what's|which|how many|how much|value)\b",
+    re.IGNORECASE
+)
+_SYNTHESIS_PATTERN = re.compile(
+    r"\b(sammenlign|forskjell|forskjellen|forklar|hvorfor|beskriv|oppsummer|fordeler|ulemper|"
+    r"anbefal|compare|difference|explain|why|describe|summari[sz]e|pros|cons|recommend|versus|vs)\b",
+    re.IGNORECASE
+)
+# Fremgangsmåter ("hvordan konfigurerer jeg UART1") trenger et sammenhengende svar, ikke én setning
+_PROCEDURAL_PATTERN = re.compile(
+    r"\b(hvordan|how(?!\s+(?:many|much)\b)|konfigurer\w*|configur\w*|set\s+up|setup|sett\s+opp|"
+    r"enabl(?:e|es|ing)|disabl(?:e|es|ing)|(?:de)?aktiver(?:e|er|ing)?|install\w*|steps?|steg)\b",
+    re.IGNORECASE
+)
+_TERM_PATTERN = re.compile(r"[\wæøå][\wæøå\-.]*[\wæøå]|\w", re.IGNORECASE)
+_SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+|\n+")
+_STOPWORDS = {
+    "hva", "er", "var", "en", "et", "ei", "den", "det", "de", "som", "og", "i", "på", "til", "for", "med",
+    "av", "om", "fra", "jeg", "du", "vi", "kan", "skal", "har", "hvilken", "hvilke", "hvor", "mange",
+    "the", "a", "an", "is", "are", "of", "to", "in", "on", "for", "and", "or", "what", "which", "how",
+    "does", "do", "with", "by", "be", "it", "this", "that"
+}
+
+
+def classify_question(question: str) -> str:
+    """
+    lookup, general eller synthesis ut fra ordlyden. Et modulnavn eller en melding i
+    spørsmålet gjør det ikke til et oppslag, og fremgangsmåter er aldri oppslag.
+    """
+    if _SYNTHESIS_PATTERN.search(question) or question.count("?") > 1:
+        return SYNTHESIS
+    if _PROCEDURAL_PATTERN.search(question):
+        return GENERAL
+    if _LOOKUP_PATTERN.search(question):
+        return LOOKUP
+    return GENERAL
+
+
+def _terms(text: str) -> set:
+    return {term for term in (t.lower() for t in _TERM_PATTERN.findall(text)) if term not in _STOPWORDS}
+
+
+def split_sentences(text: str) -> List[str]:
+    return [s.strip() for s in _SENTENCE_SPLIT.split(text) if 15 <= len(s.strip()) <= 400]
+
+
+def extract_answer(question: str, candidates: List[Dict[str, Any]], max_sentences: int = 2, top_n: int = 3) -> Optional[Dict[str, Any]]:
+    """
+    Setningsnivå-ekstraksjon: setningene i de beste treffene scores etter hvor mange av
+    spørsmålets ord de dekker (og om de inneholder en verdi). Returnerer de beste
+    setningene fra ett treff med dekningsgrad, eller None.
+    """
+    query_terms = _terms(question)
+    if not query_terms or not candidates:
+        return None
+    best = None
+    for candidate in sorted(candidates, key=lambda c: c["score"] or 0.0, reverse=True)[:top_n]:
+        scored = []
+        for position, sentence in enumerate(split_sentences(candidate["text"])):
+            coverage = len(query_terms & _terms(sentence)) / len(query_terms)
+            # Oppslag besvares nesten alltid med et tall eller en enhet
+            value_bonus = 0.1 if re.search(r"\d", sentence) else 0.0
+            scored.append((coverage + value_bonus + 0.2 * (candidate["score"] or 0.0), coverage, position, sentence))
+        if not scored:
+            continue
+        scored.sort(reverse=True)
+        if best is None or scored[0][0] > best["rank"]:
+            # Nabosetninger tas med bare når de dekker spørsmålet nesten like godt
+            chosen = [scored[0]] + [s for s in scored[1:max_sentences] if s[1] > 0 and s[1] >= 0.5 * scored[0][1]]
+            best = {
+                "rank": scored[0][0],
+                "coverage": scored[0][1],
+                "sentences": [s[3] for s in sorted(chosen, key=lambda s: s[2])],
+                "filename": candidate.get("filename"),
+                "page": candidate.get("page"),
+                "score": candidate["score"]
+            }
+    return best
+
+
+def format_extractive_answer(extract: Dict[str, Any]) -> str:
+    source = f"\"{extract['filename']}\""
+    if extract.get("page"):
+        source += f", side {extract['page']}"
+    return f"{' '.join(extract['sentences'])}\n\nKilde: {source}"
+
+
+class ModelRouter:
+    """Velger nivå (og modell) per spørsmål og måler svartid per nivå"""
+
+    def __init__(
+        self,
+        fast_model: str = "gpt-3.5-turbo",
+        strong_model: str = "gpt-4o",
+        extractive_min_score: float = 0.6,
+        extractive_min_coverage: float = 0.6,
+        weak_score: float = 0.35,
+        long_question_words: int = 25,
+        strong_threshold: float = 0.7,
+        enabled: bool = True,
+        window: int = 500
+    ):
+        self.fast_model = fast_model
+        self.strong_model = strong_model
+        self.extractive_min_score = extractive_min_score
+        self.extractive_min_coverage = extractive_min_coverage
+        self.weak_score = weak_score
+        self.long_question_words = long_question_words
+        self.strong_threshold = strong_threshold
+        self.enabled = enabled
+        # Metrikker
+        self.routed = {tier: 0 for tier in TIERS}
+        self.latencies = {tier: collections.deque(maxlen=window) for tier in TIERS}
+
+    def model_for(self, tier: str) -> Optional[str]:
+        return {FAST: self.fast_model, STRONG: self.strong_model}.get(tier)
+
+    def route(self, question: str, candidates: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Beslutning for ett spørsmål: tier, model, question_type, difficulty og (for
+        extractive) answer. Uten router går alt til den raske modellen som før.
+        """
+        question_type = classify_question(question)
+        # Bare ekte cosinus-likheter sier noe om hvor sikkert søket er
+        top_score = max((c["score"] for c in candidates if c.get("score") is not None), default=None)
+        confident = (top_score is not None and top_score >= self.extractive_min_score) or any(c.get("exact") for c in candidates)
+        decision = {
+            "tier": FAST,
+            "question_type": question_type,
+            "top_score": round(top_score, 3) if top_score is not None else None
+        }
+        if not self.enabled:
+            decision["model"] = self.fast_model
+            return decision
+
+        if question_type == LOOKUP and confident:
+            extract = extract_answer(question, candidates)
+            if extract is not None and extract["coverage"] >= self.extractive_min_coverage:
+                decision.update(
+                    tier=EXTRACTIVE,
+                    model=None,
+                    difficulty=0.0,
+                    coverage=round(extract["coverage"], 3),
+                    answer=format_extractive_answer(extract)
+                )
+                return decision
+
+        difficulty = {LOOKUP: 0.1, GENERAL: 0.4, SYNTHESIS: 0.8}[question_type]
+        if len(question.split()) > self.long_question_words:
+            difficulty += 0.3
+        if top_score is not None and top_score < self.weak_score:
+            difficulty += 0.3
+        # Svaret må settes sammen fra flere dokumenter
+        if len({c.get("filename") for c in candidates[:3]}) >= 3:
+            difficulty += 0.2
+        tier = STRONG if difficulty >= self.strong_threshold else FAST
+        decision.update(tier=tier, model=self.model_for(tier), difficulty=round(difficulty, 2))
+        return decision
+
+    def record(self, tier: str, seconds: float):
+        self.routed[tier] += 1
+        self.latencies[tier].append(seconds)
+
+    @staticmethod
+    def _quantile_ms(samples, percentile: float) -> Optional[float]:
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        return round(ordered[min(int(len(ordered) * percentile / 100.0), len(ordered) - 1)] * 1000, 2)
+
+    def stats(self) -> Dict[str, Any]:
+        total = sum(self.routed.values())
+        return {
+            "enabled": self.enabled,
+            "models": {FAST: self.fast_model, STRONG: self.strong_model},
+            "tiers": {
+                tier: {
+                    "count": self.routed[tier],
+                    "share": round(self.routed[tier] / total, 3) if total else 0.0,
+                    "latency_p50_ms": self._quantile_ms(self.latencies[tier], 50.0),
+                    "latency_p95_ms": self._quantile_ms(self.latencies[tier], 95.0)
+                }
+                for tier in TIERS
+            }
+        }
+
+
+def model_router_from_env() -> ModelRouter:
+    """RAG_MODEL_ROUTER=false sender alt til den raske modellen (som før)"""
+    return ModelRouter(
+        fast_model=os.getenv("RAG_FAST_MODEL", "gpt-3.5-turbo"),
+        strong_model=os.getenv("RAG_STRONG_MODEL", "gpt-4o"),
+        extractive_min_score=float(os.getenv("RAG_EXTRACTIVE_MIN_SCORE", "0.6")),
+        extractive_min_coverage=float(os.getenv("RAG_EXTRACTIVE_MIN_COVERAGE", "0.6")),
+        weak_score=float(os.getenv("RAG_ROUTER_WEAK_SCORE", "0.35")),
+        long_question_words=int(os.getenv("RAG_ROUTER_LONG_QUESTION_WORDS", "25")),
+        strong_threshold=float(os.getenv("RAG_ROUTER_STRONG_THRESHOLD", "0.7")),
+        enabled=os.getenv("RAG_MODEL_ROUTER", "true").lower() == "true"
+    )
@@ -0,0 +1,164 @@
+"""
+Vector Index - HNSW- og kompresjonsoppsett for Document-klassene i Weaviate
+PQ/BQ/SQ, ef og maxConnections styres fra miljøvariabler og brukes både ved opprettelse
+og ved migrering av eksisterende klasser.
+"""
+
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from weaviate.classes.config import Configure, Reconfigure
+
+logger = logging.getLogger(__name__)
+
+COMPRESSION_TYPES = ("none", "pq", "bq", "sq")
+
+# HNSW-parametre anbefalt av scripts/tune_ann_index.py; miljøvariablene overstyrer
+ANN_CONFIG_PATH = Path(os.getenv("RAG_ANN_CONFIG_PATH") or Path(__file__).parent / "ann_index_config.json")
+
+
+def _optional_int(name: str) -> Optional[int]:
+    value = os.getenv(name)
+    return int(value) if value not in (None, "") else None
+
+
+def load_tuned_config() -> Dict[str, Any]:
+    """Leser anbefalt ef/maxConnections/efConstruction fra tuning-verktøyet, hvis filen finnes"""
+    if not ANN_CONFIG_PATH.exists():
+        return {}
+    try:
+        tuned = json.loads(ANN_CONFIG_PATH.read_text())
+        return {
+            "ef": int(tuned["ef"]),
+            "max_connections": int(tuned["M"]),
+            "ef_construction": int(tuned["ef_construction"])
+        }
+    except Exception as e:
+        logger.warning(f"Could not read {ANN_CONFIG_PATH}, using defaults: {e}")
+        return {}
+
+
+def settings_from_env() -> Dict[str, Any]:
+    """Leser indeksoppsettet; None betyr Weaviate sin standardverdi"""
+    compression = os.getenv("RAG_VECTOR_COMPRESSION", "none").lower()
+    if compression not in COMPRESSION_TYPES:
+        logger.warning(f"Unknown RAG_VECTOR_COMPRESSION={compression}, using none")
+        compression = "none"
+
+    tuned = load_tuned_config()
+    return {
+        "compression": compression,
+        "ef": _optional_int("RAG_HNSW_EF") or tuned.get("ef"),
+        "max_connections": _optional_int("RAG_HNSW_MAX_CONNECTIONS") or tuned.get("max_connections"),
+        "ef_construction": _optional_int("RAG_HNSW_EF_CONSTRUCTION") or tuned.get("ef_construction"),
+        "pq_segments": _optional_int("RAG_PQ_SEGMENTS"),
+        "training_limit": _optional_int("RAG_QUANTIZER_TRAINING_LIMIT"),
+        "rescore_limit": _optional_int("RAG_QUANTIZER_RESCORE_LIMIT"),
+    }
+
+
+def _quantizer(settings: Dict[str, Any]):
+    compression = settings["compression"]
+    if compression == "pq":
+        return Configure.VectorIndex.Quantizer.pq(
+            segments=settings.get("pq_segments"),
+            training_limit=settings.get("training_limit")
+        )
+    if compression == "bq":
+        return Configure.VectorIndex.Quantizer.bq(rescore_limit=settings.get("rescore_limit"))
+    if compression == "sq":
+        return Configure.VectorIndex.Quantizer.sq(
+            training_limit=settings.get("training_limit"),
+            rescore_limit=settings.get("rescore_limit")
+        )
+    return None
+
+
+def vector_index_config(settings: Optional[Dict[str, Any]] = None):
+    """HNSW-konfigurasjon for en ny Document-klasse"""
+    settings = settings or settings_from_env()
+    return Configure.VectorIndex.hnsw(
+        ef=settings.get("ef"),
+        max_connections=settings.get("max_connections"),
+        ef_construction=settings.get("ef_construction"),
+        quantizer=_quantizer(settings)
+    )
+
+
+def _reconfigure_quantizer(settings: Dict[str, Any]):
+    compression = settings["compression"]
+    if compression == "pq":
+        return Reconfigure.VectorIndex.Quantizer.pq(
+            enabled=True,
+            segments=settings.get("pq_segments"),
+            training_limit=settings.get("training_limit")
+        )
+    if compression == "bq":
+        return Reconfigure.VectorIndex.Quantizer.bq(enabled=True, rescore_limit=settings.get("rescore_limit"))
+    if compression == "sq":
+        return Reconfigure.VectorIndex.Quantizer.sq(
+            enabled=True,
+            training_limit=settings.get("training_limit"),
+            rescore_limit=settings.get("rescore_limit")
+        )
+    return None
+
+
+def current_compression(index_config) -> str:
+    """Hvilken kvantisering en eksisterende HNSW-indeks bruker (none, pq, bq eller sq)"""
+    quantizer = getattr(index_config, "quantizer", None)
+    if quantizer is None:
+        return "none"
+    name = type(quantizer).__name__.lower()
+    for compression in ("pq", "bq", "sq"):
+        if compression in name:
+            return compression
+    return "none"
+
+
+def migrate_vector_index(collection, settings: Optional[Dict[str, Any]] = None) -> List[str]:
+    """
+    Oppdaterer en eksisterende klasse til ønsket indeksoppsett der Weaviate tillater det.
+
+    ef og å slå på PQ/SQ kan endres på en levende indeks (Weaviate komprimerer i bakgrunnen
+    når training_limit er nådd). maxConnections, efConstruction, BQ på en eksisterende
+    HNSW-indeks og bytte eller fjerning av kvantisering krever at klassen bygges på nytt.
+    Returnerer endringene som ikke kunne gjøres.
+    """
+    settings = settings or settings_from_env()
+    index_config = collection.config.get().vector_index_config
+    existing_compression = current_compression(index_config)
+    skipped = []
+
+    for key in ("max_connections", "ef_construction"):
+        wanted = settings.get(key)
+        if wanted is not None and getattr(index_config, key, None) != wanted:
+            skipped.append(f"{key} {getattr(index_config, key, None)} -> {wanted}")
+
+    quantizer = None
+    wanted_compression = settings["compression"]
+    if wanted_compression != existing_compression:
+        if existing_compression == "none" and wanted_compression in ("pq", "sq"):
+            quantizer = _reconfigure_quantizer(settings)
+        else:
+            skipped.append(f"compression {existing_compression} -> {wanted_compression}")
+
+    ef_changed = settings.get("ef") is not None and getattr(index_config, "ef", None) != settings["ef"]
+    if ef_changed or quantizer is not None:
+        collection.config.update(
+            vector_index_config=Reconfigure.VectorIndex.hnsw(
+                ef=settings.get("ef") if ef_changed else None,
+                quantizer=quantizer
+            )
+        )
+        logger.info(
+            f"Updated vector index for {collection.name}: ef={settings.get('ef')}, "
+            f"compression={wanted_compression if quantizer is not None else existing_compression}"
+        )
+
+    for change in skipped:
+        logger.warning(f"Vector index for {collection.name} needs a rebuild to apply {change}")
+    return skipped